@@ -2,14 +2,18 @@ import app_config
 import app_utils
 import datetime
 import logging
+import math
+import profiler
 import static
 
 from app_utils import comma_filter, percent_filter, open_db, close_db, never_cache_preview
-from flask import Flask, make_response, render_template
+from flask import Flask, abort, make_response, render_template
 from flask_admin import Admin
 from flask_admin.contrib.peewee import ModelView
 from models import models
+from peewee import fn
 from render_utils import make_context, smarty_filter, urlencode_filter
+from urllib.parse import urlencode
 from werkzeug.debug import DebuggedApplication
 
 app = Flask(__name__)
@@ -34,10 +38,17 @@ app.register_blueprint(static.static, url_prefix='/%s' % app_config.PROJECT_SLUG
 app.add_template_filter(smarty_filter, name='smarty')
 app.add_template_filter(urlencode_filter, name='urlencode')
 
+app_profiler = profiler.SamplingProfiler('admin', stage_of=models.db.stats.site_of)
+
 admin = Admin(app, url='/%s/admin' % app_config.PROJECT_SLUG)
 admin.add_view(ModelView(models.Result))
 admin.add_view(ModelView(models.Call))
 
+CALL_STATUS_FILTERS = {
+    'called': True,
+    'uncalled': False
+}
+
 SLUG_TO_OFFICENAME = {
     'senate': 'U.S. Senate',
     'house': 'U.S. House',
@@ -48,17 +59,46 @@ SLUG_TO_OFFICENAME = {
 # Example application views
 @app.route('/%s/calls/<office>/' % app_config.PROJECT_SLUG, methods=['GET'])
 def calls_admin(office):
+    from flask import request
+
     officename = SLUG_TO_OFFICENAME[office]
-    results = app_utils.filter_results(officename)
+
+    filters = {
+        'statepostal': request.args.get('state') or None,
+        'poll_closing': request.args.get('closing') or None,
+        'called': CALL_STATUS_FILTERS.get(request.args.get('status')),
+        'competitive': request.args.get('competitive') == '1',
+        'search': request.args.get('q') or None
+    }
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    race_keys, total = app_utils.filter_races(officename, page=page, **filters)
+    results = app_utils.filter_results(officename, race_keys)
     grouped = app_utils.group_results_by_race(results, officename)
+    pages = max(int(math.ceil(total / app_config.CALLS_ADMIN_PAGE_SIZE)), 1)
 
     context = make_context(asset_depth=1)
     context.update({
-        'races': grouped
+        'races': grouped,
+        'filters': request.args,
+        'filter_options': app_utils.get_filter_options(officename),
+        'total': total,
+        'page': page,
+        'pages': pages,
+        'prev_url': _calls_page_url(request.args, page - 1) if page > 1 else None,
+        'next_url': _calls_page_url(request.args, page + 1) if page < pages else None
     })
 
     return make_response(render_template('calls.html', **context))
 
+def _calls_page_url(args, page):
+    """
+    Link to another page of the calls admin, keeping the current filters
+    """
+    params = args.to_dict()
+    params['page'] = page
+    return '?{0}'.format(urlencode(params))
+
 @app.route('/%s/calls/<office>/call-npr' % app_config.PROJECT_SLUG, methods=['POST'])
 def call_npr(office):
     from flask import request
@@ -66,37 +106,24 @@ def call_npr(office):
     result_id = request.form.get('result_id')
 
     result = models.Result.get(models.Result.id == result_id)
-    call = result.call[0]
-    if call.override_winner:
-        call.override_winner = False
-    else:
-        call.override_winner = True
-
-    call.save()
-
-    race_id = result.raceid
-    statepostal = result.statepostal
-    officename = result.officename
-    level = result.level
-    reportingunitname = result.reportingunitname
-
-    race_results = models.Result.select().where(
-        models.Result.level == level,
-        models.Result.raceid == race_id,
-        models.Result.officename == officename,
-        models.Result.statepostal == statepostal,
-        models.Result.reportingunitname == reportingunitname
+    override_winner = not result.call[0].override_winner
+
+    race_results = models.Result.select(models.Result.id).where(
+        models.Result.level == result.level,
+        models.Result.raceid == result.raceid,
+        models.Result.officename == result.officename,
+        models.Result.statepostal == result.statepostal,
+        models.Result.reportingunitname == result.reportingunitname
     )
 
-    for race_result in race_results:
-        race_call = race_result.call[0]
-        if call.override_winner:
-            race_call.accept_ap = False
-
-        if race_call.call_id != call.call_id:
-            race_call.override_winner = False
+    # one statement for the race; race_status and the aggregates pick the
+    # call up on the daemon's next load
+    if override_winner:
+        update = models.Call.update(override_winner=(models.Call.call_id == result.id), accept_ap=False)
+    else:
+        update = models.Call.update(override_winner=False)
 
-        race_call.save()
+    update.where(models.Call.call_id << race_results).execute()
 
     return 'Success', 200
 
@@ -112,7 +139,7 @@ def accept_ap(office):
     level = request.form.get('level')
 
     if level == 'district':
-        results = models.Result.select().where(
+        results = models.Result.select(models.Result.id).where(
             models.Result.level == 'district',
             models.Result.raceid == race_id,
             models.Result.officename == officename,
@@ -120,24 +147,38 @@ def accept_ap(office):
             models.Result.reportingunitname == reportingunit
         )
     else:
-        results = models.Result.select().where(
+        results = models.Result.select(models.Result.id).where(
             (models.Result.level == 'state') | (models.Result.level == 'national'),
             models.Result.raceid == race_id,
             models.Result.officename == officename,
             models.Result.statepostal == statepostal,
         )
 
-    for result in results:
-        call = result.call[0]
-        if call.accept_ap:
-            call.accept_ap = False
-        else:
-            call.accept_ap = True
-        call.save()
+    models.Call.update(
+        accept_ap=~fn.COALESCE(models.Call.accept_ap, False)
+    ).where(models.Call.call_id << results).execute()
 
     return 'Success', 200
 
 
+@app.route('/%s/admin/profile/' % app_config.PROJECT_SLUG, methods=['POST'])
+def start_profiler():
+    """
+    Profile this worker for `seconds`, see profiler.py. Needs the
+    PROFILER_TOKEN secret as `token`.
+    """
+    from flask import request
+
+    token = secrets.get('PROFILER_TOKEN')
+    if not token or request.form.get('token') != token:
+        abort(403)
+
+    seconds = min(request.form.get('seconds', app_config.PROFILER_SECONDS, type=int), app_config.PROFILER_MAX_SECONDS)
+    if not app_profiler.start(seconds):
+        return 'Already profiling', 409
+
+    return 'Profiling for {0}s'.format(seconds), 202
+
 @app.route('/%s/test/' % app_config.PROJECT_SLUG, methods=['GET'])
 def _test_app():
     """
@@ -159,7 +200,7 @@ def index():
 
 
 app.before_request(open_db)
-app.after_request(close_db)
+app.teardown_request(close_db)
 app.after_request(never_cache_preview)
 
 # Enable Werkzeug debug pages
@@ -99,6 +99,12 @@ COPY_PATH = 'data/copy.xlsx'
 CALENDAR_GOOGLE_DOC_KEY = '1Rs2qSw00DYECHummasktOa6zLfrifusJWh-uP-GFgvc'
 CALENDAR_PATH = 'data/calendar.xlsx'
 
+# Parsed workbooks, see copy_cache.py
+COPY_CACHE_FOLDER = '.copy_cache'
+
+# County reference data, see models/county_index.py
+COUNTY_INDEX_PATH = 'data/counties.idx'
+
 """
 SHARING
 """
@@ -143,6 +149,23 @@ Logging
 LOG_FORMAT = '%(levelname)s:%(name)s:%(asctime)s: %(message)s'
 
 
+"""
+Database connection pooling
+"""
+# Each process (app worker, render worker) keeps its own pool
+DATABASE_POOL = True
+DATABASE_POOL_MAX_CONNECTIONS = 8
+DATABASE_POOL_STALE_TIMEOUT = 300
+
+# Queries slower than this many milliseconds are logged with their plan
+SLOW_QUERY_THRESHOLD = 500
+
+# Sampling profiler, see profiler.py. A signal profiles for
+# PROFILER_SECONDS, the admin route for up to PROFILER_MAX_SECONDS.
+PROFILER_INTERVAL = 0.01
+PROFILER_SECONDS = 30
+PROFILER_MAX_SECONDS = 300
+
 """
 elex config
 """
@@ -155,6 +178,16 @@ ELEX_INIT_FLAGS = '--national-only --results-level ru'
 LOAD_RESULTS_INTERVAL = 10
 DATA_OUTPUT_FOLDER = '.rendered'
 
+CALLS_ADMIN_PAGE_SIZE = 25
+
+# Where the big board and state documents are built: 'python' serializes
+# rows in the render workers, 'postgres' has the database build the JSON
+RENDER_BACKEND = 'python'
+
+# Add each county's demographics, unemployment, 2012 margin and shift
+# since 2012 to the county files as "extra", from COUNTY_INDEX_PATH
+RENDER_COUNTY_EXTRA = False
+
 SELECTED_HOUSE_RACES = [15038, 47019, 10031, 10019, 10041, 11586, 15999, 20645, 30015, 31211, 39015, 3004, 6618, 17009, 23805, 23811, 24028, 24010, 24013, 28385, 36581, 36604, 36599, 36602, 45893, 50068, 17073, 17071, 30155, 30992, 49548, 5715, 8514, 5741, 5697, 39023, 5711, 2015, 3006, 5714, 6615, 10025, 16001, 15038, 30155, 30992, 36603, 36583, 39013, 47007, 47009]
 
 """
@@ -1,16 +1,153 @@
+import app_config
+import operator
+
 from collections import OrderedDict
+from datetime import datetime
 from decimal import Decimal, ROUND_DOWN
+from functools import reduce
 from models import models
-from peewee import fn
+from peewee import fn, JOIN
+from playhouse.shortcuts import case
+
+CALLABLE_LEVELS = ['state', 'national', 'district']
+SEARCH_FIELDS = ['last', 'first', 'seatname', 'statename']
+
+def _npr_winner():
+    """
+    The race_status npr_winner flag, read from the live calls. The view
+    only catches up with the admin's calls on the daemon's next load.
+    """
+    won = case(models.Result.level, (('district', models.Result.electwon > 0),), models.Result.winner)
+
+    return fn.COALESCE(models.Call.override_winner, False) | fn.COALESCE(won & models.Call.accept_ap, False)
 
-def filter_results(name):
-    results = models.Result.select().where(
-        (models.Result.level == 'state') | (models.Result.level == 'national') | (models.Result.level == 'district'),
+def filter_races(name, statepostal=None, poll_closing=None, called=None, competitive=False, search=None, page=1):
+    """
+    Select one page of races for an office. Returns the
+    (statepostal, raceid, reportingunitname) keys on the page
+    and the total number of races matching the filters.
+    """
+    races = models.Result.select(
+        models.Result.statepostal,
+        models.Result.raceid,
+        models.Result.reportingunitname
+    ).join(models.RaceStatus, on=(models.RaceStatus.result_id == models.Result.id)).switch(models.Result).join(
+        models.Call, on=(models.Call.call_id == models.Result.id)
+    ).where(
+        models.Result.level << CALLABLE_LEVELS,
         models.Result.officename == name
-    ).order_by(models.Result.statepostal, models.Result.seatname, -models.Result.votecount, models.Result.last)
+    )
+
+    if statepostal:
+        races = races.where(models.Result.statepostal == statepostal)
+
+    if poll_closing:
+        races = races.where(models.RaceStatus.poll_closing == poll_closing)
+
+    if competitive:
+        races = races.where(models.RaceStatus.expected == 'competitive')
+
+    if search:
+        races = races.where(_search_clause(search))
+
+    races = races.group_by(
+        models.Result.statepostal,
+        models.Result.raceid,
+        models.Result.reportingunitname
+    )
+
+    if called is not None:
+        races = races.having(fn.bool_or(_npr_winner()) == called)
+
+    total = races.count()
+
+    races = races.order_by(
+        models.Result.statepostal,
+        fn.MIN(models.Result.seatname),
+        models.Result.raceid,
+        models.Result.reportingunitname
+    ).paginate(page, app_config.CALLS_ADMIN_PAGE_SIZE)
+
+    return list(races.tuples()), total
+
+def _search_clause(search):
+    """
+    Case-insensitive prefix match on the search fields, which the
+    lower(field) text_pattern_ops indexes in models.INDEXES can serve.
+    """
+    pattern = '{0}%'.format(search.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+
+    return reduce(operator.or_, [fn.lower(getattr(models.Result, field)) % pattern for field in SEARCH_FIELDS])
+
+def filter_results(name, race_keys):
+    """
+    Select every candidate row, with its call, for a page of races
+    """
+    if not race_keys:
+        return []
+
+    clauses = []
+    for statepostal, raceid, reportingunitname in race_keys:
+        if reportingunitname is None:
+            reportingunit_clause = models.Result.reportingunitname >> None
+        else:
+            reportingunit_clause = models.Result.reportingunitname == reportingunitname
+
+        clauses.append(
+            (models.Result.statepostal == statepostal) &
+            (models.Result.raceid == raceid) &
+            reportingunit_clause
+        )
+
+    results = models.Result.select(
+        models.Result,
+        models.Call.accept_ap,
+        models.Call.override_winner,
+        _npr_winner().alias('npr_winner'),
+        models.RaceEstimate.expected_votes,
+        models.RaceEstimate.remaining_votes,
+        models.RaceEstimate.candidate_remaining,
+        models.RaceEstimate.lead_ratio
+    ).join(models.Call, on=(models.Call.call_id == models.Result.id)).switch(models.Result).join(
+        models.RaceEstimate, JOIN.LEFT_OUTER, on=(models.RaceEstimate.result_id == models.Result.id)
+    ).where(
+        models.Result.level << CALLABLE_LEVELS,
+        models.Result.officename == name,
+        reduce(operator.or_, clauses)
+    ).order_by(models.Result.statepostal, models.Result.seatname, -models.Result.votecount, models.Result.last).naive()
 
     return results
 
+def get_filter_options(name):
+    """
+    States and poll closing times available to the calls admin filters
+    """
+    states = models.Result.select(models.Result.statepostal).distinct().where(
+        models.Result.level << CALLABLE_LEVELS,
+        models.Result.officename == name
+    ).order_by(models.Result.statepostal)
+
+    poll_closings = models.RaceMeta.select(models.RaceMeta.poll_closing).distinct().where(
+        ~(models.RaceMeta.poll_closing >> None)
+    )
+
+    return {
+        'states': [state.statepostal for state in states],
+        'poll_closings': sorted([meta.poll_closing for meta in poll_closings], key=_poll_closing_sort_key)
+    }
+
+def _poll_closing_sort_key(poll_closing):
+    """
+    Sort poll closing times like '8:00 p.m.' in election night order,
+    with times after midnight last.
+    """
+    try:
+        closing = datetime.strptime(poll_closing.replace('.', '').upper(), '%I:%M %p')
+    except ValueError:
+        return (2, poll_closing)
+
+    return (1 if closing.hour < 12 else 0, closing.time())
+
 def group_results_by_race(results, name):
     grouped = OrderedDict()
     for result in results:
@@ -67,14 +204,28 @@ def never_cache_preview(response):
 
 def open_db():
     """
-    Open db connection
+    Open db connection and count the request's queries against its route
     """
+    from flask import g, request
+
     models.db.connect()
+    g.query_snapshot = models.db.stats.snapshot()
+    models.db.stats.push(request.endpoint or request.path)
 
 
-def close_db(response):
+def close_db(exception=None):
     """
-    Close db connection
+    Close db connection, returning it to the pool. Runs on teardown so
+    connections are released even when the request raised. Logs the
+    request's queries.
     """
-    models.db.close()
-    return response
+    from flask import g, request
+
+    if 'query_snapshot' in g:
+        models.db.stats.pop()
+        sites = models.db.stats.since(g.query_snapshot)
+        if sites:
+            models.db.stats.log_summary('{0} {1}'.format(request.method, request.path), sites)
+
+    if not models.db.is_closed():
+        models.db.close()
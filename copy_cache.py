@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Parsed copytext workbooks, cached.
+
+Parsing an xlsx with openpyxl takes longer than anything we do with the
+result, so each workbook is parsed once into JSON under
+app_config.COPY_CACHE_FOLDER, one file per workbook path, and reused
+while the file's mtime or SHA-1 still match. Any
+process can then load it without openpyxl. get_copy() also keeps the
+loaded copy in memory until the workbook changes on disk, for the web
+app. text.update refreshes the cache after downloading a new version.
+"""
+
+import app_config
+import copytext
+import hashlib
+import json
+import logging
+import os
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+# Loaded copies by workbook path: (mtime, CachedCopy)
+_copies = {}
+
+
+class CachedCopy(copytext.Copy):
+    """
+    copytext.Copy that reads and writes the parsed sheets from the cache
+    """
+    def __init__(self, filename):
+        self._json = None
+        super(CachedCopy, self).__init__(filename)
+
+    def load(self):
+        try:
+            mtime = os.path.getmtime(self._filename)
+        except OSError:
+            raise copytext.CopyException('"{0}" does not exist. Have you run "fab text.update"?'.format(self._filename))
+
+        cached = _read_cache(self._filename)
+        if cached and cached['mtime'] != mtime and cached['sha1'] == _sha1(self._filename):
+            # touched but unchanged, e.g. a fresh checkout
+            cached['mtime'] = mtime
+            _write_cache(self._filename, cached)
+
+        if cached and cached['mtime'] == mtime:
+            for name, columns, rows in cached['sheets']:
+                self._copy[name] = copytext.Sheet(name, [dict(zip(columns, row)) for row in rows], columns)
+            return
+
+        logger.info('parsing {0}'.format(self._filename))
+        super(CachedCopy, self).load()
+
+        _write_cache(self._filename, {
+            'mtime': mtime,
+            'sha1': _sha1(self._filename),
+            'sheets': [
+                [name, sheet._columns, [row._row for row in sheet]]
+                for name, sheet in self._copy.items()
+            ]
+        })
+
+    def json(self):
+        if self._json is None:
+            self._json = super(CachedCopy, self).json()
+
+        return self._json
+
+
+def get_copy(path):
+    """
+    The copy in the workbook at path, loaded once per process and again
+    whenever the workbook changes.
+    """
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    loaded = _copies.get(path)
+
+    if loaded is None or loaded[0] != mtime:
+        loaded = _copies[path] = (mtime, CachedCopy(path))
+
+    return loaded[1]
+
+
+def refresh(path):
+    """
+    Parse the workbook at path again, e.g. after downloading it
+    """
+    _copies.pop(path, None)
+
+    cache_path = _cache_path(path)
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+    return get_copy(path)
+
+
+def _cache_path(path):
+    # workbooks in different folders can share a name
+    path_hash = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(app_config.COPY_CACHE_FOLDER, '{0}.{1}.json'.format(os.path.basename(path), path_hash))
+
+
+def _read_cache(path):
+    try:
+        with open(_cache_path(path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_cache(path, cached):
+    os.makedirs(app_config.COPY_CACHE_FOLDER, exist_ok=True)
+
+    # written whole and then renamed, so readers never see half a file
+    temp_path = '{0}.{1}'.format(_cache_path(path), os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(cached, f)
+
+    os.rename(temp_path, _cache_path(path))
+
+
+def _sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
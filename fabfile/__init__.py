@@ -13,7 +13,9 @@ import app_config
 
 # Other fabfiles
 from . import daemons
+from . import bench
 from . import data
+from . import fixtures
 from . import issues
 from . import render
 from . import text
@@ -139,6 +141,11 @@ def deploy_all_data():
 
 @task
 def deploy_data_folder():
+    # replays publish to a local folder standing in for the bucket
+    if env.get('local_bucket'):
+        utils.deploy_to_folder(app_config.DATA_OUTPUT_FOLDER, env.local_bucket)
+        return
+
     local('aws s3 cp {0}/top-level-results.json s3://{1}/{2}/data/ --acl public-read --cache-control max-age=5'.format(app_config.DATA_OUTPUT_FOLDER, app_config.S3_BUCKET, app_config.PROJECT_SLUG))
     local('aws s3 sync {0} s3://{1}/{2}/data/ --acl public-read --cache-control max-age=5'.format(app_config.DATA_OUTPUT_FOLDER, app_config.S3_BUCKET, app_config.PROJECT_SLUG))
 
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+"""
+Commands that benchmark ingest, render and publish against a local
+database, a synthetic fixture (see fixtures.py) and a local folder that
+stands in for the S3 bucket.
+
+    fab bench.run                      everything, recorded to the history
+    fab bench.run:scale=5              on a 5x election
+    fab bench.compare:baseline=master  latest run against master's
+
+Every run rebuilds the local database from the fixture.
+"""
+
+import app_config
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import simplejson as json
+import tempfile
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from fabric.api import abort, hide, local, settings, task
+from models import models
+from time import time
+
+from . import data
+from . import fixtures
+from . import render
+from . import utils
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+FIXTURE_FOLDER = '.fixtures'
+HISTORY_PATH = '.bench/history.json'
+
+RENDER_TASKS = [
+    'render_top_level_numbers',
+    'render_presidential_state_results',
+    'render_presidential_county_results',
+    'render_presidential_big_board',
+    'render_senate_results',
+    'render_governor_results',
+    'render_ballot_measure_results',
+    'render_house_results',
+    'render_state_results',
+    'render_race_estimates',
+    'render_path_to_270'
+]
+
+# How far a metric can move against the baseline, by metric name or else
+# by metric suffix, before it counts as a regression: the better direction,
+# the relative tolerance and an absolute change small enough to be noise.
+# Metrics with neither are recorded but not compared.
+REGRESSION_THRESHOLDS = OrderedDict([
+    ('rows_per_s', ('higher', 0.10, 0)),
+    ('bytes_per_s', ('higher', 0.10, 0)),
+    ('ms', ('lower', 0.10, 25)),
+    ('seconds', ('lower', 0.15, 0.05)),
+    ('queries', ('lower', 0.0, 0)),
+    ('peak_rss_mb', ('lower', 0.20, 1)),
+    # one read of the whole race_estimate view, which varies more run to run
+    ('render.render_race_estimates.ms', ('lower', 0.15, 25)),
+    # about 30ms, so the default noise would hide it doubling
+    ('render.render_path_to_270.ms', ('lower', 0.10, 10))
+])
+
+
+@task
+def run(scale='1', runs='3', fixture=None, history=HISTORY_PATH, baseline=None):
+    """
+    Run every benchmark on a `scale` times election, record the results in
+    the history and compare them with the last run on `baseline` (a branch,
+    defaults to the last run with the same scale).
+    """
+    _require_local()
+    fixture = _ensure_fixture(fixture or '{0}-{1}x'.format(FIXTURE_FOLDER, scale), scale)
+    runs = int(runs)
+
+    setup(fixture)
+
+    metrics = OrderedDict()
+    metrics.update(ingest(fixture, runs))
+    metrics.update(render_tasks(runs))
+    metrics.update(write(runs))
+    metrics.update(publish(fixture))
+
+    entry = _record(history, fixture, metrics)
+    regressions = _compare(history, entry, baseline)
+
+    if regressions:
+        abort('{0} metric(s) regressed'.format(len(regressions)))
+
+@task
+def setup(fixture=None):
+    """
+    Rebuild the local database from the first step of the fixture.
+    """
+    _require_local()
+    fixture = fixture or '{0}-1x'.format(FIXTURE_FOLDER)
+
+    with fixtures.elex_flags(fixtures.step_folder(fixture, 0)):
+        data.bootstrap_db()
+
+@task
+def ingest(fixture=None, runs='3'):
+    """
+    Throughput of load_results for each mode, in result rows per second.
+    """
+    fixture = fixture or '{0}-1x'.format(FIXTURE_FOLDER)
+    metrics = OrderedDict()
+
+    with fixtures.elex_flags(fixtures.step_folder(fixture, 0)):
+        for mode in ['init', 'fast', 'slow']:
+            elapsed = []
+            for i in range(int(runs)):
+                start = time()
+                data.load_results(mode)
+                elapsed.append(time() - start)
+
+            rows = _count_rows('{0}/results.csv'.format(app_config.ELEX_OUTPUT_FOLDER))
+            metrics['ingest.{0}.rows'.format(mode)] = rows
+            metrics['ingest.{0}.rows_per_s'.format(mode)] = round(rows / min(elapsed), 1)
+            logger.info('load_results {0:<5} {1:>8} rows  {2:10.1f} rows/s'.format(mode, rows, rows / min(elapsed)))
+
+        # leave every result in place for the renders
+        data.load_results('init')
+
+    return metrics
+
+@task
+def render_tasks(runs='3'):
+    """
+    Time, queries issued and peak RSS of each render task. Each task runs
+    in a fresh child process and its peak RSS is counted above the size
+    the child started at, so it doesn't depend on what the benchmark did
+    before. Queries and memory include the task's render workers.
+    """
+    metrics = OrderedDict()
+
+    with _output_folder():
+        for name in RENDER_TASKS:
+            samples = [_measure_in_child(getattr(render, name)) for i in range(int(runs))]
+            elapsed, queries, peak_rss = min(samples)
+
+            metrics['render.{0}.ms'.format(name)] = round(elapsed * 1000, 1)
+            metrics['render.{0}.queries'.format(name)] = queries
+            metrics['render.{0}.peak_rss_mb'.format(name)] = round(peak_rss / 1024.0, 1)
+            logger.info('{0:<36} {1:10.1f}ms {2:6} queries {3:8.1f}MB'.format(name, elapsed * 1000, queries, peak_rss / 1024.0))
+
+    return metrics
+
+@task
+def write(runs='3'):
+    """
+    Throughput of _write_json_file on every state's county document.
+    """
+    states = [state.statepostal for state in models.Result.select(models.Result.statepostal).distinct()]
+    documents = []
+
+    for statepostal in states:
+        results = render._select_presidential_county_results(statepostal)
+        serialized_results = render._serialize_by_key(results, render.PRESIDENTIAL_COUNTY_SELECTIONS, 'fipscode', collate_other=True)
+        documents.append((serialized_results, 'presidential-{0}-counties.json'.format(statepostal.lower())))
+
+    with _output_folder() as output_folder:
+        elapsed = []
+        for i in range(int(runs)):
+            start = time()
+            for serialized_results, filename in documents:
+                render._write_json_file(serialized_results, filename)
+            elapsed.append(time() - start)
+
+        written = sum(os.path.getsize(os.path.join(output_folder, filename)) for serialized_results, filename in documents)
+
+    logger.info('_write_json_file {0} bytes  {1:.1f} MB/s'.format(written, written / min(elapsed) / 1024 / 1024))
+
+    return OrderedDict([
+        ('write.bytes', written),
+        ('write.bytes_per_s', round(written / min(elapsed), 1))
+    ])
+
+@task
+def publish(fixture=None):
+    """
+    A full cycle (every file into an empty bucket) and an incremental one
+    (the next step's fast results, national files, into the full bucket),
+    each timed as a whole and for the publish alone.
+    """
+    fixture = fixture or '{0}-1x'.format(FIXTURE_FOLDER)
+    bucket = tempfile.mkdtemp(prefix='bench-bucket-')
+    metrics = OrderedDict()
+
+    cycles = [
+        ('full', 0, 'init', render.render_all),
+        ('incremental', 1, 'fast', render.render_all_national)
+    ]
+
+    try:
+        with _output_folder() as output_folder:
+            for label, step, mode, render_files in cycles:
+                with fixtures.elex_flags(fixtures.step_folder(fixture, step)):
+                    start = time()
+                    data.load_results(mode)
+
+                    # deploy_*_data starts each cycle from an empty folder
+                    shutil.rmtree(output_folder)
+                    os.makedirs(output_folder)
+                    render_files()
+
+                    publish_start = time()
+                    files, written = utils.deploy_to_folder(output_folder, bucket)
+                    end = time()
+
+                metrics['publish.{0}.files'.format(label)] = files
+                metrics['publish.{0}.bytes'.format(label)] = written
+                metrics['publish.{0}.seconds'.format(label)] = round(end - publish_start, 3)
+                metrics['cycle.{0}.seconds'.format(label)] = round(end - start, 3)
+                logger.info('{0} cycle {1:.2f}s, publish {2:.2f}s for {3} files ({4} bytes)'.format(label, end - start, end - publish_start, files, written))
+    finally:
+        shutil.rmtree(bucket)
+
+    return metrics
+
+@task
+def compare(baseline=None, history=HISTORY_PATH):
+    """
+    Compare the latest run in the history with the last run on `baseline`.
+    """
+    entries = _read_history(history)
+    if not entries:
+        abort('no runs recorded in {0}'.format(history))
+
+    regressions = _compare(history, entries[-1], baseline)
+
+    if regressions:
+        abort('{0} metric(s) regressed'.format(len(regressions)))
+
+def _require_local():
+    if app_config.DEPLOYMENT_TARGET in ('production', 'staging'):
+        abort('benchmarks rebuild the database, run them locally')
+
+def _ensure_fixture(fixture, scale):
+    if not os.path.exists(os.path.join(fixture, 'manifest.json')):
+        fixtures.generate(fixture, scale=scale, steps='2')
+
+    return fixture
+
+@contextmanager
+def _output_folder():
+    output_folder = app_config.DATA_OUTPUT_FOLDER
+    app_config.DATA_OUTPUT_FOLDER = tempfile.mkdtemp(prefix='bench-render-')
+
+    try:
+        yield app_config.DATA_OUTPUT_FOLDER
+    finally:
+        shutil.rmtree(app_config.DATA_OUTPUT_FOLDER)
+        app_config.DATA_OUTPUT_FOLDER = output_folder
+
+def _count_rows(path):
+    with open(path) as f:
+        return sum(1 for line in f) - 1
+
+def _measure_in_child(function):
+    """
+    Run function in a forked child and return (seconds, queries, peak RSS
+    growth in KB). Render workers forked by the child count toward both.
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+
+    child = context.Process(target=_run_measured, args=(function, sender))
+    child.start()
+    sender.close()
+
+    try:
+        return receiver.recv()
+    except EOFError:
+        abort('{0} failed in the benchmark'.format(function.__name__))
+    finally:
+        child.join()
+
+def _run_measured(function, sender):
+    snapshot = models.db.stats.snapshot()
+
+    # a forked child starts out with the parent's resident size
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time()
+    function()
+    elapsed = time() - start
+
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    queries = sum(totals[0] for totals in models.db.stats.since(snapshot).values())
+    sender.send((elapsed, queries, peak_rss - start_rss))
+
+def _git(command):
+    with settings(warn_only=True), hide('output', 'running'):
+        output = local('git {0}'.format(command), capture=True)
+
+    return output if output.succeeded else None
+
+def _read_history(history):
+    if not os.path.exists(history):
+        return []
+
+    with open(history) as f:
+        return json.load(f)
+
+def _record(history, fixture, metrics):
+    manifest = fixtures.read_manifest(fixture)
+
+    entry = OrderedDict([
+        ('timestamp', datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+        ('branch', _git('rev-parse --abbrev-ref HEAD')),
+        ('commit', _git('rev-parse --short HEAD')),
+        ('scale', manifest['scale']),
+        ('render_backend', app_config.RENDER_BACKEND),
+        ('metrics', metrics)
+    ])
+
+    entries = _read_history(history)
+    entries.append(entry)
+
+    if os.path.dirname(history):
+        os.makedirs(os.path.dirname(history), exist_ok=True)
+
+    with open(history, 'w') as f:
+        json.dump(entries, f, indent=4)
+
+    logger.info('recorded run {0} on {1} to {2}'.format(entry['commit'], entry['branch'], history))
+    return entry
+
+def _compare(history, entry, baseline=None):
+    """
+    Log every metric that moved past its threshold against the baseline
+    run and return them as (metric, baseline value, value) tuples.
+    """
+    candidates = [
+        previous for previous in _read_history(history)
+        if previous['timestamp'] != entry['timestamp']
+        and previous['scale'] == entry['scale']
+        and previous.get('render_backend') == entry.get('render_backend')
+        and (baseline is None or previous['branch'] == baseline)
+    ]
+
+    if not candidates:
+        logger.info('no baseline run to compare with')
+        return []
+
+    previous = candidates[-1]
+    regressions = []
+
+    for metric, value in entry['metrics'].items():
+        threshold = REGRESSION_THRESHOLDS.get(metric, REGRESSION_THRESHOLDS.get(metric.rsplit('.', 1)[-1]))
+        if threshold is None or metric not in previous['metrics']:
+            continue
+
+        direction, tolerance, noise = threshold
+        baseline_value = previous['metrics'][metric]
+
+        if abs(value - baseline_value) <= noise:
+            regressed = False
+        elif direction == 'lower':
+            regressed = value > baseline_value * (1 + tolerance)
+        else:
+            regressed = value < baseline_value * (1 - tolerance)
+
+        if regressed:
+            regressions.append((metric, baseline_value, value))
+            logger.warning('{0} regressed: {1} on {2} ({3}), {4} now'.format(metric, baseline_value, previous['commit'], previous['branch'], value))
+
+    if not regressions:
+        logger.info('no regressions against {0} ({1})'.format(previous['commit'], previous['branch']))
+
+    return regressions
@@ -1,11 +1,22 @@
 from time import sleep, time
-from fabric.api import execute, require, settings, task
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from fabric.api import abort, execute, require, settings, task
 from fabric.state import env
 
 
 import app_config
 import logging
+import os
+import profiler
+import simplejson as json
 import sys
+import tempfile
+
+from models import models
+
+from . import data
+from . import fixtures
 
 logging.basicConfig(format=app_config.LOG_FORMAT)
 logger = logging.getLogger(__name__)
@@ -18,6 +29,13 @@ def deploy(run_once=False):
     Harvest data and deploy cards
     """
     require('settings', provided_by=['production', 'staging'])
+
+    # the index is a build output, so rebuild it from the checked out data
+    data.build_county_index()
+
+    # kill -USR2 <pid> profiles the next PROFILER_SECONDS
+    profiler.SamplingProfiler('deploy', stage_of=models.db.stats.site_of).install_signal()
+
     try:
         with settings(warn_only=True):
             main(run_once)
@@ -25,35 +43,179 @@ def deploy(run_once=False):
         sys.exit(0)
 
 
-def main(run_once=False):
+@task
+def replay(fixture='.fixtures', speedup='60', bucket=None, report=None, bootstrap='true'):
+    """
+    Replay a recorded election night (a fixture folder, see fixtures.py)
+    through ingest, render and publish, `speedup` times faster than it
+    happened, publishing to a local folder instead of S3. Logs cycle
+    latency, backlog and freshness, and writes them to `report` as JSON.
+    """
+    if app_config.DEPLOYMENT_TARGET in ('production', 'staging'):
+        abort('replay rebuilds the database, run it locally')
+
+    night = Replay(fixture, float(speedup))
+    bucket = bucket or tempfile.mkdtemp(prefix='replay-bucket-')
+
+    if bootstrap == 'true':
+        with fixtures.elex_flags(night.folders[0]):
+            data.bootstrap_db()
+
+    logger.info('replaying {0} steps at {1}x, publishing to {2}'.format(len(night.folders), night.speedup, bucket))
+
+    with settings(warn_only=True, local_bucket=bucket):
+        main(replay=night)
+
+    summary = night.summary()
+    logger.info('{cycles} cycles, latency p50 {latency_p50:.2f}s p95 {latency_p95:.2f}s max {latency_max:.2f}s, '
+                'backlog max {backlog_max} steps, freshness mean {freshness_mean:.0f}s max {freshness_max:.0f}s of election time'.format(**summary))
+
+    if report:
+        with open(report, 'w') as f:
+            json.dump({'summary': summary, 'cycles': night.cycles}, f, indent=4)
+
+    return summary
+
+
+def main(run_once=False, replay=None):
     """
-    Main loop
+    Main loop. With a replay, results come from the recorded steps due at
+    the replay's clock and the loop stops once the last step is published.
     """
     results_start = 0
     mode = 'fast'
 
+    interval = app_config.LOAD_RESULTS_INTERVAL
+    if replay:
+        interval = interval / replay.speedup
+
     while True:
         now = time()
 
-        if app_config.LOAD_RESULTS_INTERVAL and (now - results_start) > app_config.LOAD_RESULTS_INTERVAL:
+        if interval and (now - results_start) > interval:
             results_start = now
-            if mode == 'fast':
-                logger.info('loading all national results')
-                execute('data.load_results', mode)
-                execute('deploy_national_data')
-            
-            if mode == 'slow':
-                logger.info('loading all presidential results')
-                execute('data.load_results', mode)
-                execute('deploy_presidential_data')
+
+            if replay:
+                with replay.cycle(mode):
+                    _load_and_deploy(mode)
+            else:
+                _load_and_deploy(mode)
 
             if mode == 'fast':
                 mode = 'slow'
             elif mode == 'slow':
                 mode = 'fast'
-        
+
         if run_once:
             logger.info('run once specified, exiting')
             sys.exit(0)
 
-        sleep(1)
\ No newline at end of file
+        if replay and replay.finished:
+            return
+
+        sleep(min(1, interval) if interval else 1)
+
+
+@models.query_site('cycle')
+def _load_and_deploy(mode):
+    snapshot = models.db.stats.snapshot()
+
+    if mode == 'fast':
+        logger.info('loading all national results')
+        execute('data.load_results', mode)
+        execute('deploy_national_data')
+
+    if mode == 'slow':
+        logger.info('loading all presidential results')
+        execute('data.load_results', mode)
+        execute('deploy_presidential_data')
+
+    models.db.stats.log_summary('{0} cycle'.format(mode), models.db.stats.since(snapshot))
+
+
+class Replay(object):
+    """
+    A clock over a recorded election night. Election time runs `speedup`
+    times faster than the wall clock from the first step, and each cycle
+    loads the latest step that is due.
+
+    For every cycle it records latency (wall seconds to load, render and
+    publish), backlog (steps that came due during the cycle, which the
+    published files are already behind) and freshness (election seconds
+    the published files had been out of date when publishing ended, since
+    the step after theirs came due, or 0).
+    """
+    def __init__(self, fixture, speedup):
+        manifest = fixtures.read_manifest(fixture)
+
+        self.speedup = speedup
+        self.folders = [os.path.join(fixture, step['folder']) for step in manifest['steps']]
+        self.timestamps = [datetime.strptime(step['timestamp'], '%Y-%m-%dT%H:%M:%SZ') for step in manifest['steps']]
+        self.cycles = []
+        self.published = {}
+        self.started = None
+
+    @property
+    def finished(self):
+        last = len(self.folders) - 1
+        return set(self.published) == set(['fast', 'slow']) and all(step == last for step in self.published.values())
+
+    def now(self):
+        """
+        Election time on the replay clock
+        """
+        if self.started is None:
+            self.started = time()
+
+        return self.timestamps[0] + timedelta(seconds=(time() - self.started) * self.speedup)
+
+    def due_step(self, now):
+        return max(i for i, timestamp in enumerate(self.timestamps) if timestamp <= now)
+
+    @contextmanager
+    def cycle(self, mode):
+        """
+        Load from the step due now for the length of one cycle
+        """
+        start = time()
+        step = self.due_step(self.now())
+
+        with fixtures.elex_flags(self.folders[step]):
+            yield
+
+        end = time()
+        now = self.now()
+
+        backlog = self.due_step(now) - step
+        freshness = (now - self.timestamps[step + 1]).total_seconds() if backlog else 0
+
+        self.published[mode] = step
+        self.cycles.append({
+            'mode': mode,
+            'step': step,
+            'latency': round(end - start, 3),
+            'backlog': backlog,
+            'freshness': round(freshness, 1)
+        })
+
+    def summary(self):
+        latencies = sorted(cycle['latency'] for cycle in self.cycles)
+        freshness = [cycle['freshness'] for cycle in self.cycles]
+
+        return {
+            'speedup': self.speedup,
+            'cycles': len(self.cycles),
+            'latency_p50': _percentile(latencies, 0.5),
+            'latency_p95': _percentile(latencies, 0.95),
+            'latency_max': latencies[-1] if latencies else 0,
+            'backlog_max': max(cycle['backlog'] for cycle in self.cycles) if self.cycles else 0,
+            'freshness_mean': sum(freshness) / len(freshness) if freshness else 0,
+            'freshness_max': max(freshness) if freshness else 0
+        }
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0
+
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
@@ -4,24 +4,48 @@
 Commands that update or process the application data.
 """
 import app_config
-import copytext
+import copy_cache
 import csv
+import glob
 import logging
 import math
+import multiprocessing
+import os
+import threading
 import simplejson as json
 import yaml
 import requests
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from oauth import get_document
+from peewee import Param
 from fabric.api import execute, hide, local, task, settings, shell_env
 from fabric.state import env
-from models import models
-from time import sleep
+from joblib import Parallel, delayed
+from models import aggregates, county_index, models
+from time import sleep, time
 
 CENSUS_REPORTER_URL = 'http://api.censusreporter.org/1.0/data/show/acs2014_5yr'
 FIPS_TEMPLATE = '05000US{0}'
 CENSUS_TABLES = ['B01003', 'B02001', 'B03002', 'B19013', 'B15001']
 
+# Census Reporter takes several geo_ids a request. Fetched counties are
+# kept in CENSUS_CACHE_FOLDER, one file each.
+CENSUS_CACHE_FOLDER = '.census_cache'
+CENSUS_BATCH_SIZE = 10
+CENSUS_WORKERS = 4
+CENSUS_REQUESTS_PER_SECOND = 2
+CENSUS_RETRIES = 5
+CENSUS_RETRY_DELAY = 2
+
+# B15001 cells counting bachelor's and graduate degrees, men then women,
+# five age groups each
+BACHELORS_CELLS = ['B15001{0:03d}'.format(cell) for first in (9, 17, 25, 33, 41, 50, 58, 66, 74, 82) for cell in (first, first + 1)]
+
+RACE_META_FIELDS = ['result_id', 'poll_closing', 'full_poll_closing', 'first_results', 'current_party', 'expected']
+
 logging.basicConfig(format=app_config.LOG_FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(app_config.LOG_LEVEL)
@@ -36,6 +60,8 @@ def bootstrap_db():
     load_results('init')
     create_calls()
     create_race_meta()
+    create_indexes()
+    build_county_index()
 
 @task
 def create_db():
@@ -63,23 +89,185 @@ def create_tables():
     models.Result.create_table()
     models.Call.create_table()
     models.RaceMeta.create_table()
+    models.CollationException.create_table()
+    models.TurnoutBaseline.create_table()
+    load_collation_exceptions()
+    load_turnout_baseline()
+    create_race_status()
+    create_race_estimate()
+    aggregates.create_tables()
+    aggregates.rebuild_aggregates()
+
+@task
+def load_collation_exceptions():
+    """
+    Replace the candidates kept out of "Other" with data/collation_exceptions.csv.
+    """
+    with open('data/collation_exceptions.csv') as f:
+        exceptions = [{key: value or None for key, value in row.items()} for row in csv.DictReader(f)]
+
+    with models.db.transaction():
+        models.CollationException.delete().execute()
+
+        if exceptions:
+            models.CollationException.insert_many(exceptions).execute()
+
+@task
+def create_race_status():
+    """
+    Rebuild the race_status view, e.g. on a database created before it existed.
+    """
+    models.create_race_status()
+
+@task
+def load_turnout_baseline(path='data/turnout-2012.csv'):
+    """
+    Replace the 2012 turnout the vote estimates start from with path, a CSV
+    of statepostal, fipscode (empty for the state) and votes. Without it
+    the estimates extrapolate from precincts reporting. Takes effect at
+    the next results load.
+    """
+    if not os.path.exists(path):
+        logger.warning('no turnout baseline at {0}, vote estimates will use precincts reporting only'.format(path))
+        return
+
+    with open(path) as f:
+        baseline = [
+            {'statepostal': row['statepostal'], 'fipscode': row['fipscode'] or None, 'votes': int(row['votes'])}
+            for row in csv.DictReader(f)
+        ]
+
+    with models.db.transaction():
+        models.TurnoutBaseline.delete().execute()
+
+        for i in range(0, len(baseline), 500):
+            models.TurnoutBaseline.insert_many(baseline[i:i + 500]).execute()
+
+    logger.info('turnout baseline loaded for {0} states and counties'.format(len(baseline)))
+
+@task
+def create_race_estimate():
+    """
+    Rebuild the race_estimate view, e.g. on a database created before it existed.
+    """
+    models.create_race_estimate()
+
+@task
+def rebuild_aggregates():
+    """
+    Recompute the top-level totals from scratch.
+    """
+    changed = aggregates.rebuild_aggregates()
+    logger.info('aggregates rebuilt from {0} results'.format(changed))
+
+@task
+def verify_aggregates():
+    """
+    Check the incrementally maintained totals against a full recount.
+    """
+    from . import render
+
+    totals = aggregates.get_totals()
+    recount = deepcopy(aggregates.INITIAL_TOTALS)
+
+    for result in render._select_senate_results():
+        render._calculate_bop(result, recount['senate_bop'])
+
+    for result in render._select_all_house_results():
+        render._calculate_bop(result, recount['house_bop'])
+
+    recount['electoral_college'] = render._calculate_electoral_votes(render._select_presidential_state_results())
+
+    mismatches = 0
+    for name in recount:
+        if totals[name] != recount[name]:
+            mismatches += 1
+            logger.error('{0} differs: stored {1}, recounted {2}'.format(name, totals[name], recount[name]))
+
+    if mismatches:
+        logger.error('aggregates do not match a recount, run data.rebuild_aggregates')
+    else:
+        logger.info('aggregates match a full recount')
+
+    return mismatches == 0
+
+@task
+def create_indexes():
+    """
+    Create the query indexes without locking out results loading.
+    """
+    invalid = models.db.execute_sql(
+        'SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid'
+    ).fetchall()
+
+    with shell_env(**app_config.database), hide('output', 'running'):
+        # A failed concurrent build leaves an invalid index behind that
+        # IF NOT EXISTS would skip, so clear those out first
+        for row in invalid:
+            local('psql {0} -c "DROP INDEX CONCURRENTLY IF EXISTS {1};"'.format(app_config.database['PGDATABASE'], row[0]))
+
+        for name, definition in models.INDEXES:
+            local('psql {0} -c "CREATE INDEX CONCURRENTLY IF NOT EXISTS {1} ON {2};"'.format(app_config.database['PGDATABASE'], name, definition))
+
+        local('psql {0} -c "ANALYZE result; ANALYZE call; ANALYZE racemeta;"'.format(app_config.database['PGDATABASE']))
+
+    logger.info('indexes created')
+
+@task
+def index_usage():
+    """
+    Print how often each index has been scanned since stats were last reset.
+    """
+    cursor = models.db.execute_sql(
+        'SELECT relname, indexrelname, idx_scan, idx_tup_read, pg_size_pretty(pg_relation_size(indexrelid)) '
+        'FROM pg_stat_user_indexes ORDER BY relname, idx_scan DESC'
+    )
+
+    for row in cursor.fetchall():
+        print('{0}.{1}: {2} scans, {3} tuples read, {4}'.format(*row))
 
 @task
 def delete_results(mode):
     """
     Delete results without droppping database.
     """
+    where_clause = _get_delete_where_clause(mode)
+
+    with shell_env(**app_config.database), hide('output', 'running'):
+        local('psql {0} -c "set session_replication_role = replica; DELETE FROM result {1}; set session_replication_role = default;"'.format(app_config.database['PGDATABASE'], where_clause))
+
+def _get_delete_where_clause(mode):
     if mode == 'fast':
-        where_clause = "WHERE level = 'state' OR level = 'national' OR level = 'district'"
+        return "WHERE level = 'state' OR level = 'national' OR level = 'district'"
     elif mode == 'slow':
-        where_clause = "WHERE officename = 'President'"
+        return "WHERE officename = 'President'"
     else:
-        where_clause = ''
+        return ''
 
-    with shell_env(**app_config.database), hide('output', 'running'):
-        local('psql {0} -c "set session_replication_role = replica; DELETE FROM result {1}; set session_replication_role = default;"'.format(app_config.database['PGDATABASE'], where_clause))
+def _replace_results(mode, path):
+    """
+    Swap in the results in the CSV at path in one transaction, with
+    race_status and the aggregates, so readers see either the old load or
+    the new one and never the table half empty.
+    """
+    with models.db.transaction():
+        models.db.execute_sql('SET LOCAL session_replication_role = replica')
+        models.db.execute_sql('DELETE FROM result {0}'.format(_get_delete_where_clause(mode)))
+        models.db.execute_sql('SET LOCAL session_replication_role = DEFAULT')
+
+        with open(path) as f:
+            models.db.get_cursor().copy_expert("COPY result FROM stdin DELIMITER ',' CSV HEADER", f)
+
+        # a fresh database has no statistics until create_indexes, and
+        # without them the view refreshes are planned for an empty table
+        if not models.db.execute_sql("SELECT EXISTS (SELECT 1 FROM pg_stats WHERE tablename = 'result')").fetchone()[0]:
+            models.db.execute_sql('ANALYZE result')
+
+        models.refresh_race_status()
+        models.refresh_race_estimate()
 
 @task
+@models.query_site('load_results')
 def load_results(mode):
     """
     Load AP results. Defaults to next election, or specify a date as a parameter.
@@ -108,9 +296,10 @@ def load_results(mode):
                 district_cmd_output = local(districts_cmd, capture=True)
 
             if district_cmd_output.succeeded or district_cmd_output.return_code == 64:
-                delete_results(mode)
                 with hide('output', 'running'):
-                    local('csvstack {0}/first_query.csv {1}/districts.csv | psql {2} -c "COPY result FROM stdin DELIMITER \',\' CSV HEADER;"'.format(app_config.ELEX_OUTPUT_FOLDER, app_config.ELEX_OUTPUT_FOLDER, app_config.database['PGDATABASE']))
+                    local('csvstack {0}/first_query.csv {1}/districts.csv > {2}/results.csv'.format(app_config.ELEX_OUTPUT_FOLDER, app_config.ELEX_OUTPUT_FOLDER, app_config.ELEX_OUTPUT_FOLDER))
+
+                _replace_results(mode, '{0}/results.csv'.format(app_config.ELEX_OUTPUT_FOLDER))
 
             else:
                 print("ERROR GETTING DISTRICT RESULTS")
@@ -125,62 +314,100 @@ def load_results(mode):
 @task
 def create_calls():
     """
-    Create database of race calls for all races in results data.
+    Give every state, national and district result a call and drop calls
+    whose result is gone. Calls already made are kept, so this is safe to
+    run again during the night.
     """
-    models.Call.delete().execute()
+    called = models.Result.select(models.Result.id).where(models.Result.level << ['state', 'national', 'district'])
 
-    results = models.Result.select().where(
-        (models.Result.level == 'state') | (models.Result.level == 'national') | (models.Result.level == 'district')
-    )
+    missing = called.select(
+        models.Result.id,
+        Param(models.Call.accept_ap.default),
+        Param(models.Call.override_winner.default)
+    ).where(models.Result.id.not_in(models.Call.select(models.Call.call_id)))
+
+    insert = models.Call.insert_from([models.Call.call_id, models.Call.accept_ap, models.Call.override_winner], missing)
 
-    for result in results:
-        models.Call.create(call_id=result.id)
+    with models.db.transaction():
+        removed = models.Call.delete().where(models.Call.call_id.not_in(called)).execute()
+        created = models.db.execute_sql(*insert.sql()).rowcount
+
+    logger.info('calls: {0} created, {1} removed'.format(created, removed))
+
+    models.refresh_race_status()
 
 @task
 def create_race_meta():
-    models.RaceMeta.delete().execute()
+    """
+    Rebuild race metadata (poll closings, current party, expectations) for
+    state, national and district results from the calendar spreadsheet.
+    Races missing from the spreadsheet are logged and get what was found.
+    """
+    calendar = copy_cache.get_copy(app_config.CALENDAR_PATH)
+    poll_times = dict((row['key'], row) for row in calendar['poll_times'])
+    senate_seats = dict((row['state'], row) for row in calendar['senate_seats'])
+    house_seats = dict((row['seat'], row) for row in calendar['house_seats'])
+
+    results = models.ResultRowQuery(
+        models.Result,
+        models.Result.id,
+        models.Result.raceid,
+        models.Result.level,
+        models.Result.officename,
+        models.Result.statepostal,
+        models.Result.seatnum
+    ).where(models.Result.level << ['state', 'national', 'district'])
+
+    rows = []
+    missing = {}
+
+    with models.db.transaction():
+        for result in results.stream('race_meta_results'):
+            meta_obj = dict.fromkeys(RACE_META_FIELDS)
+            meta_obj['result_id'] = result.id
+
+            if result.level == 'state' or result.level == 'district':
+                calendar_row = poll_times.get(result.statepostal)
+
+                if calendar_row:
+                    meta_obj['poll_closing'] = calendar_row['time_est']
+                    meta_obj['first_results'] = calendar_row['first_results_est']
+                    meta_obj['full_poll_closing'] = calendar_row['time_all_est']
+                else:
+                    missing.setdefault(result.raceid, set()).add('no poll times for {0}'.format(result.statepostal))
 
-    calendar = copytext.Copy(app_config.CALENDAR_PATH)
-    calendar_sheet = calendar['poll_times']
-    senate_sheet = calendar['senate_seats']
-    house_sheet = calendar['house_seats']
+            if result.level == 'state' and result.officename == 'U.S. House':
+                seat = '{0}-{1}'.format(result.statepostal, result.seatnum)
+                _set_seat_meta(meta_obj, house_seats.get(seat), result, missing, 'no house seat {0}'.format(seat))
 
-    results = models.Result.select()
-    for result in results:
-        meta_obj = {
-            'result_id': result.id
-        }
+            if result.level == 'state' and result.officename == 'U.S. Senate':
+                _set_seat_meta(meta_obj, senate_seats.get(result.statepostal), result, missing, 'no senate seat for {0}'.format(result.statepostal))
 
-        if result.level == 'county' or result.level == 'township':
-            continue
+            rows.append(meta_obj)
 
-        if result.level == 'state' or result.level == 'district':
-            calendar_row = list(filter(lambda x: x['key'] == result.statepostal, calendar_sheet))[0]
+        models.RaceMeta.delete().execute()
 
-            meta_obj['poll_closing'] = calendar_row['time_est']
-            meta_obj['first_results'] = calendar_row['first_results_est']
-            meta_obj['full_poll_closing'] = calendar_row['time_all_est']
+        for i in range(0, len(rows), 500):
+            models.RaceMeta.insert_many(rows[i:i + 500]).execute()
 
-        if result.level == 'state' and result.officename == 'U.S. House':
-            seat = '{0}-{1}'.format(result.statepostal, result.seatnum)
-            house_row = list(filter(lambda x: x['seat'] == seat, house_sheet))[0]
-            meta_obj['current_party'] = house_row['party']
+    for raceid, reasons in sorted(missing.items()):
+        logger.warning('race meta for race {0} incomplete: {1}'.format(raceid, ', '.join(sorted(reasons))))
 
-            if 'competitive' in house_row['expected']:
-                meta_obj['expected'] = 'competitive'
-            else:
-                meta_obj['expected'] = house_row['expected']
+    logger.info('race meta created for {0} results, {1} races incomplete'.format(len(rows), len(missing)))
 
-        if result.level == 'state' and result.officename == 'U.S. Senate':
-            senate_row = list(filter(lambda x: x['state'] == result.statepostal, senate_sheet))[0]
-            meta_obj['current_party'] = senate_row['party']
+    models.refresh_race_status()
 
-            if 'competitive' in senate_row['expected']:
-                meta_obj['expected'] = 'competitive'
-            else:
-                meta_obj['expected'] = senate_row['expected']
+def _set_seat_meta(meta_obj, seat_row, result, missing, reason):
+    if not seat_row:
+        missing.setdefault(result.raceid, set()).add(reason)
+        return
+
+    meta_obj['current_party'] = seat_row['party']
 
-        models.RaceMeta.create(**meta_obj)
+    if 'competitive' in seat_row['expected']:
+        meta_obj['expected'] = 'competitive'
+    else:
+        meta_obj['expected'] = seat_row['expected']
 
 @task
 def copy_data_for_graphics():
@@ -233,47 +460,164 @@ def build_current_congress():
                 elif current_term['type'] == 'rep':
                     house_writer.writerow(obj)
 
+class TokenBucket(object):
+    """
+    Lets callers through at rate a second on average, in bursts of up to
+    capacity. Shared by threads.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            sleep(wait)
+
 @task
-def get_census_data(start_state='AA'):
-    state_results = models.Result.select(models.Result.statepostal).distinct().order_by(models.Result.statepostal)
+def get_census_data(url=CENSUS_REPORTER_URL, cache_folder=CENSUS_CACHE_FOLDER):
+    """
+    Fetch the census tables for every county into data/census/{state}.json.
+    Responses are cached, so an interrupted run picks up where it stopped.
+    """
+    counties = models.Result.select(models.Result.statepostal, models.Result.fipscode).distinct().where(
+        models.Result.fipscode != None
+    ).order_by(models.Result.statepostal, models.Result.fipscode)
 
-    for state_result in state_results:
-        state = state_result.statepostal
+    states = OrderedDict()
+    for county in counties.tuples():
+        states.setdefault(county[0], []).append(county[1])
 
-        sorts = sorted([start_state, state])
-        
-        if sorts[0] == state:
-            print('skipping', state)
-            continue
+    fetch_census_data(states, url, cache_folder)
+
+def fetch_census_data(states, url=CENSUS_REPORTER_URL, cache_folder=CENSUS_CACHE_FOLDER, output_folder='data/census'):
+    """
+    Fetch the census tables for states ({statepostal: [fipscodes]}),
+    CENSUS_BATCH_SIZE counties a request and CENSUS_WORKERS requests at a
+    time, at most CENSUS_REQUESTS_PER_SECOND. Counties already in
+    cache_folder are not fetched again. Returns the geo ids that failed.
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+
+    geo_ids = sorted(set(
+        _census_geo_id(fipscode) for fipscodes in states.values() for fipscode in fipscodes
+    ))
+    to_fetch = [geo_id for geo_id in geo_ids if not os.path.exists(_census_cache_path(cache_folder, geo_id))]
+    batches = [to_fetch[i:i + CENSUS_BATCH_SIZE] for i in range(0, len(to_fetch), CENSUS_BATCH_SIZE)]
+
+    logger.info('fetching {0} of {1} counties in {2} requests'.format(len(to_fetch), len(geo_ids), len(batches)))
 
-        print('getting', state)
+    bucket = TokenBucket(CENSUS_REQUESTS_PER_SECOND)
+    with ThreadPoolExecutor(CENSUS_WORKERS) as executor:
+        failed = sum(executor.map(lambda batch: _fetch_census_batch(url, batch, cache_folder, bucket), batches), [])
+
+    for geo_id in failed:
+        logger.error('census data for {0} failed'.format(geo_id))
+
+    for state, fipscodes in states.items():
         output = {}
-        fips_results = models.Result.select(models.Result.fipscode).distinct().where(models.Result.statepostal == state).order_by(models.Result.fipscode)
-        for result in fips_results:
-            if result.fipscode:
-                if result.fipscode == '02000':
-                    geo_id = '04000US02'
-                elif result.fipscode == '46102':
-                    geo_id = FIPS_TEMPLATE.format('46113')
-                else:
-                    geo_id = FIPS_TEMPLATE.format(result.fipscode)
-                params = {
-                    'geo_ids': geo_id,
-                    'table_ids': ','.join(CENSUS_TABLES)
-                }
-                response = requests.get(CENSUS_REPORTER_URL, params=params)
-                if response.status_code == 200:
-                    print('fipscode succeeded', result.fipscode)
-                    output[result.fipscode] = response.json()
-                    sleep(2)
-                else:
-                    print('fipscode failed:', result.fipscode, response.status_code)
-                    sleep(10)
-                    continue
+        for fipscode in fipscodes:
+            path = _census_cache_path(cache_folder, _census_geo_id(fipscode))
 
-        with open('data/census/{0}.json'.format(state), 'w') as f:
+            if os.path.exists(path):
+                with open(path) as f:
+                    output[fipscode] = json.load(f)
+
+        with open(os.path.join(output_folder, '{0}.json'.format(state)), 'w') as f:
             json.dump(output, f)
 
+    return failed
+
+def _fetch_census_batch(url, geo_ids, cache_folder, bucket):
+    params = {
+        'geo_ids': ','.join(geo_ids),
+        'table_ids': ','.join(CENSUS_TABLES)
+    }
+    response = _get_with_backoff(url, params, bucket)
+
+    if response is None:
+        return geo_ids
+
+    if response.status_code != 200:
+        if len(geo_ids) == 1:
+            logger.warning('census request for {0} failed: {1}'.format(geo_ids[0], response.status_code))
+            return geo_ids
+
+        # one bad geography fails the whole request, try them one by one
+        return sum((_fetch_census_batch(url, [geo_id], cache_folder, bucket) for geo_id in geo_ids), [])
+
+    payload = response.json()
+    failed = []
+
+    for geo_id in geo_ids:
+        if geo_id not in payload.get('data', {}):
+            failed.append(geo_id)
+            continue
+
+        # the same shape as a response for geo_id alone
+        geo_payload = {
+            'release': payload.get('release'),
+            'tables': payload.get('tables'),
+            'geography': {geo_id: payload.get('geography', {}).get(geo_id)},
+            'data': {geo_id: payload['data'][geo_id]}
+        }
+
+        path = _census_cache_path(cache_folder, geo_id)
+        with open('{0}.{1}'.format(path, threading.get_ident()), 'w') as f:
+            json.dump(geo_payload, f)
+
+        os.rename('{0}.{1}'.format(path, threading.get_ident()), path)
+
+    return failed
+
+def _get_with_backoff(url, params, bucket):
+    """
+    GET url, retrying connection errors, rate limiting and server errors
+    CENSUS_RETRIES times with exponential backoff. None if every try failed.
+    """
+    for attempt in range(CENSUS_RETRIES + 1):
+        if attempt:
+            sleep(CENSUS_RETRY_DELAY * 2 ** (attempt - 1))
+
+        bucket.acquire()
+
+        try:
+            response = requests.get(url, params=params, timeout=30)
+        except requests.exceptions.RequestException as e:
+            logger.warning('census request failed: {0}'.format(e))
+            continue
+
+        if response.status_code != 429 and response.status_code < 500:
+            return response
+
+        logger.warning('census request failed: {0}'.format(response.status_code))
+
+    return None
+
+def _census_geo_id(fipscode):
+    if fipscode == '02000':
+        return '04000US02'
+    elif fipscode == '46102':
+        return FIPS_TEMPLATE.format('46113')
+    else:
+        return FIPS_TEMPLATE.format(fipscode)
+
+def _census_cache_path(cache_folder, geo_id):
+    return os.path.join(cache_folder, '{0}.json'.format(geo_id))
+
 
 @task
 def extract_census_data(fipscode, census_json):
@@ -373,7 +717,6 @@ def calculate_percent_bachelors(education, education_error):
         math.pow(education_error['B15001034'], 2) +
         math.pow(education_error['B15001041'], 2) +
         math.pow(education_error['B15001042'], 2) +
-        math.pow(education_error['B15001049'], 2) +
         math.pow(education_error['B15001050'], 2) +
         math.pow(education_error['B15001051'], 2) +
         math.pow(education_error['B15001058'], 2) +
@@ -388,70 +731,180 @@ def calculate_percent_bachelors(education, education_error):
 
     return percent_bachelors, error
 
-def extract_2012_data(fipscode, filename):
-    with open(filename) as f:
-        reader = csv.DictReader(f)
-        obama_row = [row for row in reader if row['fipscode'] == fipscode and row['last'] == 'Obama' and row['level'] != 'township']
-        f.seek(0)
-        romney_row = [row for row in reader if row['fipscode'] == fipscode and row['last'] == 'Romney' and row['level'] != 'township']
+def load_census_data(folder='data/census'):
+    """
+    Census figures for every county in folder, keyed by FIPS code. Same
+    figures as extract_census_data, computed a column at a time across
+    all counties.
+    """
+    fipscodes = []
+    counties = []
 
+    for path in sorted(glob.glob(os.path.join(folder, '*.json'))):
+        with open(path) as f:
+            census_json = json.load(f)
 
-        if obama_row and romney_row:
-            obama_result = obama_row[0]['votepct']
-            romney_result = romney_row[0]['votepct']
+        for fipscode, fips_census in census_json.items():
+            if not fips_census.get('data'):
+                continue
 
-            difference = (float(obama_result) * 100) - (float(romney_result) * 100)
+            tables = next(iter(fips_census['data'].values()))
+            missing = [table for table in CENSUS_TABLES if table not in tables]
 
-            if difference > 0:
-                margin = 'D +{0}'.format(round(difference))
-            else:
-                margin = 'R +{0}'.format(round(abs(difference)))
+            if missing:
+                logger.warning('census data for {0} is missing {1}'.format(fipscode, ', '.join(missing)))
+                continue
 
-            return margin
-        
-        else:
-            return None
+            fipscodes.append(fipscode)
+            counties.append(tables)
+
+    def column(cell, kind='estimate'):
+        return [tables[cell[:6]][kind][cell] for tables in counties]
+
+    def share(part, total):
+        return [p / t for p, t in zip(column(part), column(total))]
+
+    ed_total_population = column('B15001001')
+    bachelors = [sum(cells) for cells in zip(*[column(cell) for cell in BACHELORS_CELLS])]
+    bachelors_error = [math.sqrt(sum(e * e for e in cells)) for cells in zip(*[column(cell, 'error') for cell in BACHELORS_CELLS])]
+
+    columns = {
+        'population': column('B01003001'),
+        'percent_white': share('B03002003', 'B03002001'),
+        'percent_black': share('B02001003', 'B02001001'),
+        'percent_hispanic': share('B03002012', 'B03002001'),
+        'median_income': column('B19013001'),
+        'percent_bachelors': [b / t for b, t in zip(bachelors, ed_total_population)],
+        'error': [e / t for e, t in zip(bachelors_error, ed_total_population)]
+    }
 
-def extract_unemployment_data(fipscode, filename):
+    return dict(
+        (fipscode, dict((name, values[i]) for name, values in columns.items()))
+        for i, fipscode in enumerate(fipscodes)
+    )
+
+def index_2012_margins(filename):
+    """
+    2012 presidential margins by county FIPS code, e.g. 'D +12'
+    """
+    votepct = {}
     with open(filename) as f:
-        reader = csv.DictReader(f)
-        state_fips = fipscode[:2]
-        county_fips = fipscode[-3:]
-        unemployment_row = [row for row in reader if row['State FIPS Code'] == state_fips and row['County FIPS Code'] == county_fips]
-        if unemployment_row:
-            unemployment_rate = unemployment_row[0]['Unemployment Rate (%)']
-            return float(unemployment_rate.strip())
+        for row in csv.DictReader(f):
+            if row['level'] != 'township' and row['last'] in ('Obama', 'Romney'):
+                votepct.setdefault((row['fipscode'], row['last']), row['votepct'])
+
+    margins = {}
+    for (fipscode, last), obama_result in votepct.items():
+        if last != 'Obama' or (fipscode, 'Romney') not in votepct:
+            continue
+
+        difference = (float(obama_result) * 100) - (float(votepct[(fipscode, 'Romney')]) * 100)
+
+        if difference > 0:
+            margins[fipscode] = 'D +{0}'.format(round(difference))
         else:
-            return None
+            margins[fipscode] = 'R +{0}'.format(round(abs(difference)))
+
+    return margins
+
+def index_unemployment(filename):
+    """
+    Unemployment rates by county FIPS code
+    """
+    rates = {}
+    with open(filename) as f:
+        for row in csv.DictReader(f):
+            fipscode = row['State FIPS Code'] + row['County FIPS Code']
+            rates.setdefault(fipscode, float(row['Unemployment Rate (%)'].strip()))
+
+    return rates
 
 @task
-def save_old_data():
-    state_results = models.Result.select(models.Result.statepostal).distinct().order_by(models.Result.statepostal)
+def build_county_index():
+    """
+    Pack the county names, demographics and past results from data/ into
+    app_config.COUNTY_INDEX_PATH, see models/county_index.py.
+    """
+    counties = {}
 
-    for state_result in state_results:
-        state = state_result.statepostal
-        print('getting', state)
-        output = {}
+    def county(fipscode):
+        return counties.setdefault(fipscode, {})
 
-        with open('data/census/{0}.json'.format(state)) as c:
-            census_json = json.load(c)
+    with open('data/flipscodes.json') as f:
+        units = [('{0:05d}'.format(row['fipscode']), row['reportingunitname'], row['statename']) for row in json.load(f)]
 
-        fips_results = models.Result.select(models.Result.fipscode).distinct().where(models.Result.statepostal == state, models.Result.fipscode != None).order_by(models.Result.fipscode)
-        for result in fips_results:
-            print('extracting', result.fipscode)
+    with open('data/fipscodes.csv') as f:
+        units += [(row['fipscode'], row['reportingunitname'], row['statename']) for row in csv.DictReader(f)]
 
-            unemployment = extract_unemployment_data(result.fipscode, 'data/unemployment.csv')
-            past_margin = extract_2012_data(result.fipscode, 'data/twentyTwelve.csv')
-            census = extract_census_data(result.fipscode, census_json)
+    # New England lists its towns under their county's FIPS code, and
+    # the county's own name isn't in either file
+    names = {}
+    for fipscode, name, statename in units:
+        names.setdefault(fipscode, set()).add(name)
+        county(fipscode)['statename'] = statename
 
-            this_row = {
-                'unemployment': unemployment,
-                'past_margin': past_margin,
-                'census': census
-            }
+    for fipscode, unit_names in names.items():
+        if len(unit_names) == 1:
+            county(fipscode)['name'] = unit_names.pop()
+
+    with open('data/fixed-data.json') as f:
+        for fipscode, row in json.load(f).items():
+            county(fipscode).update(
+                unemployment=float(row['unemployment'].strip()),
+                winner=row['winner'],
+                winner_advantage=row['winner-advantage']
+            )
+
+    for path in glob.glob('data/extra_data/*-extra.json'):
+        with open(path) as f:
+            for fipscode, row in json.load(f).items():
+                if row['unemployment'] is not None:
+                    county(fipscode)['unemployment'] = row['unemployment']
 
-            output[result.fipscode] = this_row
+                county(fipscode)['past_margin'] = row['past_margin']
+                county(fipscode).update(row['census'] or {})
 
+    for fipscode, census in load_census_data().items():
+        county(fipscode).update(census)
+
+    county_index.write_county_index(app_config.COUNTY_INDEX_PATH, counties)
+    logger.info('county index built for {0} counties'.format(len(counties)))
+
+@task
+def save_old_data():
+    """
+    Write data/extra_data/{state}-extra.json, each county's unemployment,
+    2012 margin and census figures, for every state in parallel.
+    """
+    unemployment = index_unemployment('data/unemployment.csv')
+    past_margins = index_2012_margins('data/twentyTwelve.csv')
+    census = load_census_data()
+
+    counties = models.Result.select(models.Result.statepostal, models.Result.fipscode).distinct().where(
+        models.Result.fipscode != None
+    ).order_by(models.Result.statepostal, models.Result.fipscode)
+
+    states = OrderedDict()
+    for county in counties.tuples():
+        states.setdefault(county[0], []).append(county[1])
+
+    Parallel(n_jobs=multiprocessing.cpu_count())(
+        delayed(_save_state_old_data)(
+            state,
+            OrderedDict((fipscode, (unemployment.get(fipscode), past_margins.get(fipscode), census.get(fipscode))) for fipscode in fipscodes)
+        ) for state, fipscodes in states.items()
+    )
+
+    logger.info('extra data written for {0} states'.format(len(states)))
+
+def _save_state_old_data(state, counties):
+    output = {}
+    for fipscode, (unemployment, past_margin, census) in counties.items():
+        output[fipscode] = {
+            'unemployment': unemployment,
+            'past_margin': past_margin,
+            'census': census
+        }
 
-        with open('data/extra_data/{0}-extra.json'.format(state.lower()), 'w') as datafile:
-            json.dump(output, datafile)
+    with open('data/extra_data/{0}-extra.json'.format(state.lower()), 'w') as datafile:
+        json.dump(output, datafile)
@@ -1,17 +1,22 @@
 import app_config
+import filecmp
 import logging
 import multiprocessing
 import os
+import profiler
 import re
 import shutil
 import simplejson as json
+import tempfile
 
+from collections import OrderedDict
 from datetime import date, datetime
+from itertools import groupby
 from fabric.api import execute, hide, local, task, settings, shell_env
 from fabric.state import env
 from joblib import Parallel, delayed
-from models import models
-from playhouse.shortcuts import model_to_dict
+from models import aggregates, county_index, models
+from peewee import DateTimeField, fn, JOIN
 from pytz import timezone
 from time import time
 
@@ -89,9 +94,24 @@ RACE_META_SELECTIONS = [
     models.RaceMeta.expected
 ]
 
+RACE_STATUS_SELECTIONS = [
+    models.RaceStatus.poll_closing,
+    models.RaceStatus.full_poll_closing,
+    models.RaceStatus.current_party,
+    models.RaceStatus.expected,
+    models.RaceStatus.npr_winner,
+    models.RaceStatus.pickup,
+    models.RaceStatus.expected_hit,
+    models.RaceStatus.expected_miss
+]
+
 ACCEPTED_PRESIDENTIAL_CANDIDATES = ['Clinton', 'Johnson', 'Stein', 'Trump', 'McMullin']
 ACCEPTED_PARTIES = ['Dem', 'GOP', 'Yes', 'No']
 
+# path-to-270.json splits uncalled electoral votes between these two
+PATH_CANDIDATES = ['Clinton', 'Trump']
+ELECTORAL_VOTES_TO_WIN = 270
+
 SELECTIONS_LOOKUP = {
     'president': PRESIDENTIAL_STATE_SELECTIONS,
     'governor': GOVERNOR_SELECTIONS,
@@ -100,9 +120,76 @@ SELECTIONS_LOOKUP = {
     'ballot_measures': BALLOT_MEASURE_SELECTIONS
 }
 
+# The join lets Postgres reorder rows, so keep AP's feed order explicitly:
+# the statewide row of a race, then its reporting units, in ballot order
+ROW_ORDER = [
+    models.Result.statepostal,
+    models.Result.raceid,
+    fn.COALESCE(models.Result.reportingunitname, ''),
+    models.Result.reportingunitid,
+    models.Result.ballotorder
+]
+
+# County files stream one county at a time, so each county's rows have to
+# come back together: the statewide rows first, then by fipscode
+COUNTY_ROW_ORDER = [
+    models.Result.level != 'state',
+    models.Result.fipscode,
+    models.Result.reportingunitid,
+    models.Result.ballotorder
+]
+COUNTY_CURSOR_ITERSIZE = 2000
+
+COUNTY_CENSUS_FIELDS = ['population', 'percent_white', 'percent_black', 'percent_hispanic', 'median_income', 'percent_bachelors', 'error']
+
+# Rows folded into each race's "Other": presidential candidates we don't
+# break out, and candidates outside the parties we do unless they match a
+# collation exception, where a NULL raceid or last matches any
+OTHER_CANDIDATE_SQL = """(
+    CASE WHEN COALESCE(selected."officename" = 'President', false)
+        THEN selected."last" IS NULL OR selected."last" NOT IN ({candidates})
+        ELSE (selected."party" IS NULL OR selected."party" NOT IN ({parties})) AND NOT EXISTS (
+            SELECT 1 FROM {exceptions} AS exception
+            WHERE (exception.raceid IS NULL OR exception.raceid = selected."raceid")
+            AND (exception.last IS NULL OR exception.last = selected."last")
+        )
+    END
+)""".format(
+    candidates=', '.join("'{0}'".format(candidate) for candidate in ACCEPTED_PRESIDENTIAL_CANDIDATES),
+    parties=', '.join("'{0}'".format(party) for party in ACCEPTED_PARTIES),
+    exceptions=models.CollationException._meta.db_table
+)
+
+RACE_META_FIELDS = [field.name for field in models.RaceMeta._meta.declared_fields if field in set(RACE_META_SELECTIONS)]
+
+def _select_rows(selections):
+    """
+    Select only the result columns in selections, with the race_status
+    columns, as ResultRows.
+    """
+    selected = set(selections)
+    columns = [field for field in models.Result._meta.declared_fields if field in selected]
+
+    results = models.ResultRowQuery(models.Result, *(columns + RACE_STATUS_SELECTIONS)).join(
+        models.RaceStatus, JOIN.LEFT_OUTER, on=(models.RaceStatus.result_id == models.Result.id)
+    ).order_by(*ROW_ORDER)
+
+    return results
+
+def _serialized_fields(selections):
+    """
+    Keys of a serialized result, in the same order model_to_dict gave them
+    """
+    selected = set(selections)
+    fields = [field.name for field in models.Result._meta.declared_fields if field in selected]
+
+    if models.Result.meta in selected:
+        fields.append('meta')
+
+    return fields
 
 def _select_presidential_state_results():
-    results = models.Result.select().where(
+    results = _select_rows(PRESIDENTIAL_STATE_SELECTIONS).where(
         (models.Result.level == 'state') | (models.Result.level == 'district'),
         models.Result.officename == 'President',
         models.Result.last << ACCEPTED_PRESIDENTIAL_CANDIDATES
@@ -111,7 +198,7 @@ def _select_presidential_state_results():
     return results
 
 def _select_presidential_national_results():
-    results = models.Result.select().where(
+    results = _select_rows(PRESIDENTIAL_STATE_SELECTIONS).where(
         models.Result.level == 'national',
         models.Result.officename == 'President',
         models.Result.last << ACCEPTED_PRESIDENTIAL_CANDIDATES
@@ -120,17 +207,16 @@ def _select_presidential_national_results():
     return results
 
 def _select_presidential_county_results(statepostal):
-    with models.db.execution_context() as ctx:
-        results = models.Result.select().where(
-            (models.Result.level == 'county') | (models.Result.level == 'state'),
-            models.Result.officename == 'President',
-            models.Result.statepostal == statepostal,
-        )
+    results = _select_rows(PRESIDENTIAL_COUNTY_SELECTIONS).where(
+        (models.Result.level == 'county') | (models.Result.level == 'state'),
+        models.Result.officename == 'President',
+        models.Result.statepostal == statepostal,
+    )
 
-        return results
+    return results
 
 def _select_governor_results():
-    results = models.Result.select().where(
+    results = _select_rows(GOVERNOR_SELECTIONS).where(
         models.Result.level == 'state',
         models.Result.officename == 'Governor'
     )
@@ -138,7 +224,7 @@ def _select_governor_results():
     return results
 
 def _select_selected_house_results():
-    results = models.Result.select().where(
+    results = _select_rows(HOUSE_SELECTIONS).where(
         models.Result.level == 'state',
         models.Result.officename == 'U.S. House',
         models.Result.raceid << app_config.SELECTED_HOUSE_RACES
@@ -147,7 +233,7 @@ def _select_selected_house_results():
     return results
 
 def _select_all_house_results():
-    results = models.Result.select().where(
+    results = _select_rows(HOUSE_SELECTIONS).where(
         models.Result.level == 'state',
         models.Result.officename == 'U.S. House',
     )
@@ -155,7 +241,7 @@ def _select_all_house_results():
     return results
 
 def _select_senate_results():
-    results = models.Result.select().where(
+    results = _select_rows(SENATE_SELECTIONS).where(
         models.Result.level == 'state',
         models.Result.officename == 'U.S. Senate'
     )
@@ -163,7 +249,7 @@ def _select_senate_results():
     return results
 
 def _select_ballot_measure_results():
-    results = models.Result.select().where(
+    results = _select_rows(BALLOT_MEASURE_SELECTIONS).where(
         models.Result.level == 'state',
         models.Result.is_ballot_measure == True
     )
@@ -171,69 +257,13 @@ def _select_ballot_measure_results():
     return results
 
 @task
+@models.query_site('render_top_level_numbers')
 def render_top_level_numbers():
-    # init with parties that already have seats
-    senate_bop = {
-        'total_seats': 100,
-        'majority': 51,
-        'uncalled_races': 34,
-        'last_updated': None,
-        'Dem': {
-            'seats': 34,
-            'pickups': 0,
-            'needed': 17,
-            'expected': 8
-        },
-        'GOP': {
-            'seats': 30,
-            'pickups': 0,
-            'needed': 21,
-            'expected': 14
-        },
-        'Other': {
-            'seats': 2,
-            'pickups': 0,
-            'needed': 49,
-            'expected': 0
-        }
-    }
-
-    house_bop = {
-        'total_seats': 435,
-        'majority': 218,
-        'uncalled_races': 435,
-        'last_updated': None,
-        'Dem': {
-            'seats': 0,
-            'pickups': 0,
-            'needed': 218,
-            'expected': 178
-        },
-        'GOP': {
-            'seats': 0,
-            'pickups': 0,
-            'needed': 218,
-            'expected': 202
-        },
-        'Other': {
-            'seats': 0,
-            'pickups': 0,
-            'needed': 218,
-            'expected': 0
-        }
-    }
-
-    presidential_results = _select_presidential_state_results()
-    senate_results = _select_senate_results()
-    house_results = _select_all_house_results()
-
-    electoral_totals = _calculate_electoral_votes(presidential_results)
-
-    for result in senate_results:
-        _calculate_bop(result, senate_bop)
-
-    for result in house_results:
-        _calculate_bop(result, house_bop)
+    # Totals are kept current as race_status refreshes, see models/aggregates.py
+    totals = aggregates.get_totals()
+    electoral_totals = totals['electoral_college']
+    senate_bop = totals['senate_bop']
+    house_bop = totals['house_bop']
 
     if senate_bop['last_updated'] > house_bop['last_updated'] or senate_bop['last_updated'] == house_bop['last_updated']:
         last_updated = senate_bop['last_updated']
@@ -252,115 +282,401 @@ def render_top_level_numbers():
     _write_json_file(data, 'top-level-results.json')
 
 @task
+@models.query_site('render_presidential_state_results')
 def render_presidential_state_results():
-    state_results = _select_presidential_state_results()
-    national_results = _select_presidential_national_results()
-    electoral_totals = _calculate_electoral_votes(state_results)
-    state_serialized_results = _serialize_by_key(state_results, PRESIDENTIAL_STATE_SELECTIONS, 'statepostal')
-    national_serialized_results = _serialize_by_key(national_results, PRESIDENTIAL_STATE_SELECTIONS, 'statepostal')
-
-    for result in national_serialized_results['results']['US']:
-        if result['last'] != 'Other':
-            result['npr_electwon'] = electoral_totals[result['last']]
-
-    all_results = {
-        'results': {**state_serialized_results['results'], **national_serialized_results['results']},
-        'last_updated': state_serialized_results['last_updated']
-    }
-
+    with models.consistent_snapshot():
+        state_results = _select_presidential_state_results()
+        national_results = _select_presidential_national_results()
+        electoral_totals = _calculate_electoral_votes(state_results)
+        state_serialized_results = _serialize_by_key(state_results, PRESIDENTIAL_STATE_SELECTIONS, 'statepostal')
+        national_serialized_results = _serialize_by_key(national_results, PRESIDENTIAL_STATE_SELECTIONS, 'statepostal')
+
+        for result in national_serialized_results['results']['US']:
+            if result['last'] != 'Other':
+                result['npr_electwon'] = electoral_totals[result['last']]
+
+        all_results = {
+            'results': {**state_serialized_results['results'], **national_serialized_results['results']},
+            'last_updated': state_serialized_results['last_updated']
+        }
 
-    _write_json_file(all_results, 'presidential-national.json')
+        _write_json_file(all_results, 'presidential-national.json')
 
 @task
+@models.query_site('render_presidential_county_results')
 def render_presidential_county_results():
-    states = models.Result.select(models.Result.statepostal).distinct()
+    if app_config.RENDER_COUNTY_EXTRA:
+        # opened before forking so the workers share it
+        county_index.get_county_index()
+
+    with models.consistent_snapshot() as snapshot_id:
+        states = models.Result.select(models.Result.statepostal).distinct()
+
+        with profiler.workers():
+            worker_stats = Parallel(n_jobs=NUM_CORES)(
+                delayed(_render_in_worker)(os.getpid(), profiler.profiling_until(), 'render_presidential_county_results', _render_county, state.statepostal, snapshot_id) for state in states
+            )
+            _merge_worker_stats(worker_stats)
+
+def _render_in_worker(parent_pid, profile_until, site, function, *args):
+    """
+    Run a render worker's function and hand back the queries it ran and,
+    while the daemon is being profiled, where it spent its time, so the
+    parent's stats and profile cover its workers. Nothing to hand back
+    when joblib ran it in the parent.
+    """
+    if os.getpid() == parent_pid:
+        with models.query_site(site):
+            function(*args)
+
+        return {}, {}
+
+    snapshot = models.db.stats.snapshot()
+
+    with profiler.worker_samples(profile_until, stage_of=models.db.stats.site_of) as samples:
+        with models.query_site(site):
+            function(*args)
+
+    return models.db.stats.since(snapshot), samples
+
+def _merge_worker_stats(worker_stats):
+    for sites, samples in worker_stats:
+        models.db.stats.merge(sites)
+        profiler.merge(samples)
+
+def _render_county(statepostal, snapshot_id=None):
+    with models.use_snapshot(snapshot_id):
+        results = _select_presidential_county_results(statepostal).order_by(*COUNTY_ROW_ORDER)
+        results = _group_rows(results, 'fipscode', collate_other=True)
+        rows = results.stream('{0}_counties'.format(statepostal.lower()), itersize=COUNTY_CURSOR_ITERSIZE)
+
+        extra = None
+        if app_config.RENDER_COUNTY_EXTRA:
+            margins = {}
+            rows = _record_county_margins(rows, margins)
+            extra = lambda: _get_county_extra(margins)
+
+        filename = 'presidential-{0}-counties.json'.format(statepostal.lower())
+        with open('{0}/{1}'.format(app_config.DATA_OUTPUT_FOLDER, filename), 'w') as f:
+            _stream_by_key(rows, PRESIDENTIAL_COUNTY_SELECTIONS, 'fipscode', f, extra=extra)
+
+def _record_county_margins(rows, margins):
+    """
+    Pass rows through, keeping each county's [Dem minus GOP votepct,
+    votes] in margins
+    """
+    for row in rows:
+        if row.level == 'county' and not row.is_other and row.party in ('Dem', 'GOP'):
+            margin = margins.setdefault(row.fipscode, [0.0, 0])
+            margin[0] += float(row.votepct or 0) * (1 if row.party == 'Dem' else -1)
+            margin[1] += row.votecount or 0
+
+        yield row
+
+def _get_county_extra(margins):
+    """
+    Reference data for the counties in margins, shaped like the
+    data/extra_data files, plus the shift in the Dem minus GOP margin
+    since 2012 in points
+    """
+    index = county_index.get_county_index()
+    extra = {}
+
+    for fipscode, (margin, votes) in margins.items():
+        county = index.get(fipscode)
+        if county is None:
+            continue
 
-    Parallel(n_jobs=NUM_CORES)(delayed(_render_county)(state.statepostal) for state in states)
+        census = dict((field, county[field]) for field in COUNTY_CENSUS_FIELDS)
 
-def _render_county(statepostal):
-    results = _select_presidential_county_results(statepostal)
-    serialized_results = _serialize_by_key(results, PRESIDENTIAL_COUNTY_SELECTIONS, 'fipscode', collate_other=True)
+        shift = None
+        if votes and county['winner_advantage'] is not None:
+            margin_2012 = county['winner_advantage'] * (1 if county['winner'] == 'Obama' else -1)
+            shift = round((margin - margin_2012) * 100, 1)
 
-    filename = 'presidential-{0}-counties.json'.format(statepostal.lower())
-    _write_json_file(serialized_results, filename)
+        extra[fipscode] = {
+            'unemployment': county['unemployment'],
+            'past_margin': county['past_margin'],
+            'census': census if census['population'] is not None else None,
+            'shift': shift
+        }
+
+    return extra
 
 @task
+@models.query_site('render_presidential_big_board')
 def render_presidential_big_board():
     results = _select_presidential_state_results()
-    serialized_results = _serialize_for_big_board(results, PRESIDENTIAL_STATE_SELECTIONS, key='statepostal')
-    _write_json_file(serialized_results, 'presidential-big-board.json')
+    _render_big_board(results, PRESIDENTIAL_STATE_SELECTIONS, 'presidential-big-board.json', key='statepostal')
 
 @task
+@models.query_site('render_governor_results')
 def render_governor_results():
     results = _select_governor_results()
-
-    serialized_results = _serialize_for_big_board(results, GOVERNOR_SELECTIONS)
-    _write_json_file(serialized_results, 'governor-national.json')
+    _render_big_board(results, GOVERNOR_SELECTIONS, 'governor-national.json')
 
 @task
+@models.query_site('render_house_results')
 def render_house_results():
     results = _select_selected_house_results()
-
-    serialized_results = _serialize_for_big_board(results, HOUSE_SELECTIONS)
-    _write_json_file(serialized_results, 'house-national.json')
+    _render_big_board(results, HOUSE_SELECTIONS, 'house-national.json')
 
 @task
+@models.query_site('render_senate_results')
 def render_senate_results():
     results = _select_senate_results()
-
-    serialized_results = _serialize_for_big_board(results, SENATE_SELECTIONS)
-    _write_json_file(serialized_results, 'senate-national.json')
+    _render_big_board(results, SENATE_SELECTIONS, 'senate-national.json')
 
 @task
+@models.query_site('render_ballot_measure_results')
 def render_ballot_measure_results():
     results = _select_ballot_measure_results()
+    _render_big_board(results, BALLOT_MEASURE_SELECTIONS, 'ballot-measures-national.json')
 
-    serialized_results = _serialize_for_big_board(results, BALLOT_MEASURE_SELECTIONS)
-    _write_json_file(serialized_results, 'ballot-measures-national.json')
+@task
+@models.query_site('render_race_estimates')
+def render_race_estimates():
+    """
+    Expected and outstanding votes for every state and district race, see
+    models.RaceEstimate
+    """
+    results = models.Result.select(
+        models.Result.raceid,
+        models.Result.level,
+        models.Result.officename,
+        models.Result.statepostal,
+        models.Result.reportingunitname,
+        models.Result.precinctsreportingpct,
+        models.Result.last,
+        models.Result.party,
+        models.Result.lastupdated,
+        models.RaceEstimate.expected_votes,
+        models.RaceEstimate.remaining_votes,
+        models.RaceEstimate.candidate_remaining,
+        models.RaceEstimate.lead_ratio
+    ).join(models.RaceEstimate, on=(models.RaceEstimate.result_id == models.Result.id)).where(
+        models.Result.level << ['state', 'district']
+    ).order_by(
+        models.Result.raceid, models.Result.statepostal, models.Result.reportingunitname, -models.Result.votecount
+    ).naive()
+
+    races = OrderedDict()
+    last_updated = None
+    unit_key = None
 
+    for result in results:
+        if (result.raceid, result.statepostal, result.reportingunitname) != unit_key:
+            unit_key = (result.raceid, result.statepostal, result.reportingunitname)
+            unit = {
+                'officename': result.officename,
+                'level': result.level,
+                'statepostal': result.statepostal,
+                'reportingunitname': result.reportingunitname,
+                'precinctsreportingpct': result.precinctsreportingpct,
+                'expected_votes': result.expected_votes,
+                'remaining_votes': result.remaining_votes,
+                'lead_ratio': result.lead_ratio,
+                'candidates': []
+            }
+            races.setdefault(result.raceid, []).append(unit)
+
+        unit['candidates'].append({
+            'last': result.last,
+            'party': result.party,
+            'remaining_votes': result.candidate_remaining
+        })
+
+        if not last_updated or result.lastupdated > last_updated:
+            last_updated = result.lastupdated
+
+    _write_json_file({'results': races, 'last_updated': last_updated or datetime.utcnow()}, 'race-estimates.json')
 
 @task
-def render_state_results():
-    states = models.Result.select(models.Result.statepostal).distinct()
+@models.query_site('render_path_to_270')
+def render_path_to_270():
+    """
+    Every way the uncalled states and Maine and Nebraska districts could
+    still split, see paths_to_270()
+    """
+    results = list(_select_presidential_state_results())
+    electoral_totals = _calculate_electoral_votes(results)
+
+    units = OrderedDict()
+    last_updated = None
+
+    for result in results:
+        if result.level == 'state' and result.statepostal in ('ME', 'NE'):
+            continue
+
+        unit = units.setdefault((result.statepostal, result.reportingunitname), {
+            'statepostal': result.statepostal,
+            'reportingunitname': result.reportingunitname,
+            'electoral_votes': result.electtotal,
+            'called': False,
+            'leader': None,
+            'votecount': 0
+        })
+
+        if result.is_npr_winner():
+            unit['called'] = True
+
+        if (result.votecount or 0) > unit['votecount']:
+            unit['leader'] = result.last
+            unit['votecount'] = result.votecount
+
+        if not last_updated or result.lastupdated > last_updated:
+            last_updated = result.lastupdated
+
+    uncalled = [unit for unit in units.values() if not unit['called']]
+    paths = paths_to_270(electoral_totals, [
+        (_unit_name(unit), unit['electoral_votes'], unit['leader']) for unit in uncalled
+    ])
+
+    for unit, unit_paths in zip(uncalled, paths['uncalled']):
+        unit_paths['statepostal'] = unit['statepostal']
+        unit_paths['reportingunitname'] = unit['reportingunitname']
+
+    paths['last_updated'] = last_updated or datetime.utcnow()
+
+    _write_json_file(paths, 'path-to-270.json')
+
+def paths_to_270(electoral_totals, units):
+    """
+    Count the ways units, (name, electoral votes, leader) triples, could
+    split between the two PATH_CANDIDATES on top of the electoral_totals
+    they have already won, and for each candidate how many of those splits
+    reach ELECTORAL_VOTES_TO_WIN, which units every one of them needs and
+    where they would finish if every unit went to its leader.
+
+    Instead of walking all 2 ** len(units) splits, counts[v] holds how
+    many of them give the first candidate exactly v of the uncalled
+    votes, which takes one pass per unit over at most 539 totals. Taking
+    a unit back out of the counts is another pass, which gives the paths
+    each candidate has when they win that unit.
+    """
+    first, second = PATH_CANDIDATES
+    remaining = sum(votes for name, votes, leader in units)
+
+    counts = [1] + [0] * remaining
+    for name, votes, leader in units:
+        for total in range(remaining, votes - 1, -1):
+            counts[total] += counts[total - votes]
+
+    # the first candidate wins with at least first_needed of the remaining
+    # votes, the second while the first gets at most first_ceiling
+    first_needed = max(0, ELECTORAL_VOTES_TO_WIN - electoral_totals[first])
+    first_ceiling = remaining - max(0, ELECTORAL_VOTES_TO_WIN - electoral_totals[second])
+
+    def count(counts, low, high):
+        return sum(counts[max(0, low):max(0, high + 1)])
+
+    candidates = OrderedDict()
+    for candidate, candidate_paths in ((first, count(counts, first_needed, remaining)), (second, count(counts, 0, first_ceiling))):
+        candidates[candidate] = {
+            'electoral_votes': electoral_totals[candidate],
+            'needed': max(0, ELECTORAL_VOTES_TO_WIN - electoral_totals[candidate]),
+            'leading': electoral_totals[candidate],
+            'paths': candidate_paths,
+            'must_win': []
+        }
+
+    uncalled = []
+    for name, votes, leader in units:
+        if leader in candidates:
+            candidates[leader]['leading'] += votes
+
+        # splits of the other units, by the first candidate's votes among them
+        without = counts[:remaining + 1 - votes]
+        for total in range(votes, len(without)):
+            without[total] -= without[total - votes]
+
+        unit_paths = OrderedDict([
+            (first, count(without, first_needed - votes, remaining)),
+            (second, count(without, 0, first_ceiling))
+        ])
+
+        for candidate, paths in unit_paths.items():
+            if paths and paths == candidates[candidate]['paths']:
+                candidates[candidate]['must_win'].append(name)
+
+        uncalled.append({'name': name, 'electoral_votes': votes, 'leader': leader, 'paths': unit_paths})
+
+    outcomes = 2 ** len(units)
+
+    return {
+        'candidates': candidates,
+        'outcomes': outcomes,
+        'no_majority': outcomes - sum(candidate['paths'] for candidate in candidates.values()),
+        'uncalled': uncalled
+    }
+
+def _unit_name(unit):
+    if unit['reportingunitname']:
+        return '{0} {1}'.format(unit['statepostal'], unit['reportingunitname'])
 
-    Parallel(n_jobs=NUM_CORES)(delayed(_render_state)(state.statepostal) for state in states)
+    return unit['statepostal']
 
-def _render_state(statepostal):
-    with models.db.execution_context() as ctx:
-        senate = models.Result.select().where(
+def _render_big_board(results, selections, filename, key='raceid'):
+    if app_config.RENDER_BACKEND == 'postgres':
+        sql, params = _big_board_sql(results, selections, key=key)
+        _write_json_sql(sql, params, filename)
+    else:
+        serialized_results = _serialize_for_big_board(results, selections, key=key)
+        _write_json_file(serialized_results, filename)
+
+
+@task
+@models.query_site('render_state_results')
+def render_state_results():
+    with models.consistent_snapshot() as snapshot_id:
+        states = models.Result.select(models.Result.statepostal).distinct()
+
+        with profiler.workers():
+            worker_stats = Parallel(n_jobs=NUM_CORES)(
+                delayed(_render_in_worker)(os.getpid(), profiler.profiling_until(), 'render_state_results', _render_state, state.statepostal, snapshot_id) for state in states
+            )
+            _merge_worker_stats(worker_stats)
+
+def _render_state(statepostal, snapshot_id=None):
+    with models.use_snapshot(snapshot_id):
+        senate = _select_rows(SENATE_SELECTIONS).where(
             models.Result.level == 'state',
             models.Result.officename == 'U.S. Senate',
             models.Result.statepostal == statepostal
         )
-        house = models.Result.select().where(
+        house = _select_rows(HOUSE_SELECTIONS).where(
             models.Result.level == 'state',
             models.Result.officename == 'U.S. House',
             models.Result.statepostal == statepostal
         )
-        governor = models.Result.select().where(
+        governor = _select_rows(GOVERNOR_SELECTIONS).where(
             models.Result.level == 'state',
             models.Result.officename == 'Governor',
             models.Result.statepostal == statepostal
         )
-        ballot_measures = models.Result.select().where(
+        ballot_measures = _select_rows(BALLOT_MEASURE_SELECTIONS).where(
             models.Result.level == 'state',
             models.Result.is_ballot_measure == True,
             models.Result.statepostal == statepostal
         )
 
+        queries = [('senate', senate), ('house', house), ('governor', governor), ('ballot_measures', ballot_measures)]
+        filename = '{0}.json'.format(statepostal.lower())
+
+        if app_config.RENDER_BACKEND == 'postgres':
+            _write_state_sql(queries, filename)
+            return
+
         state_results = {
             'results': {},
             'last_updated': None
         }
-        queries = [senate, house, governor, ballot_measures]
-        for query in queries:
-            results_key = [ k for k,v in locals().items() if v is query and k != 'query'][0]
+        for results_key, query in queries:
             selectors = SELECTIONS_LOOKUP[results_key]
             state_results['results'][results_key] = _serialize_by_key(query, selectors, 'raceid', collate_other=True)
             if not state_results['last_updated'] or state_results['results'][results_key]['last_updated'] > state_results['last_updated']:
                 state_results['last_updated'] = state_results['results'][results_key]['last_updated']
 
-        filename = '{0}.json'.format(statepostal.lower())
         _write_json_file(state_results, filename)
 
         
@@ -371,17 +687,18 @@ def _serialize_for_big_board(results, selections, key='raceid'):
     serialized_results = {
         'results': {}
     }
+    fields = _serialized_fields(selections)
 
     for result in results:
-        result_dict = model_to_dict(result, backrefs=True, only=selections)
+        result_dict = {field: getattr(result, field, None) for field in fields}
         if result.level not in uncallable_levels:
             _set_meta(result, result_dict)
 
         if result.officename in pickup_offices:
             _set_pickup(result, result_dict)
 
-        if not serialized_results['results'].get(result.meta[0].poll_closing):
-            serialized_results['results'][result.meta[0].poll_closing] = {}
+        if not serialized_results['results'].get(result.poll_closing):
+            serialized_results['results'][result.poll_closing] = {}
         
         # handle district-level presidential results
         if key == 'statepostal' and result.officename == 'President' and result.statepostal in ['ME', 'NE'] and result.level == 'state':
@@ -396,7 +713,7 @@ def _serialize_for_big_board(results, selections, key='raceid'):
         else:
             dict_key = result_dict[key]
 
-        time_bucket = serialized_results['results'][result.meta[0].poll_closing]
+        time_bucket = serialized_results['results'][result.poll_closing]
         if not time_bucket.get(dict_key):
             time_bucket[dict_key] = []
 
@@ -407,41 +724,88 @@ def _serialize_for_big_board(results, selections, key='raceid'):
 
 
 def _serialize_by_key(results, selections, key, collate_other=False):
-    with models.db.execution_context() as ctx:
-        serialized_results = {
-            'results': {}
-        }
+    serialized_results = {
+        'results': {}
+    }
+    fields = _serialized_fields(selections)
+    last_updated = None
 
-        for result in results:
-            result_dict = model_to_dict(result, backrefs=True, only=selections)
+    for result in _group_rows(results, key, collate_other=collate_other):
+        result_dict = _serialize_result(result, fields)
+        dict_key = _get_dict_key(result, key)
+        last_updated = _get_row_last_updated(result, last_updated)
 
-            if result.level not in uncallable_levels:
-                _set_meta(result, result_dict)
+        if not serialized_results['results'].get(dict_key):
+            serialized_results['results'][dict_key] = []
 
-            if result.officename in pickup_offices:
-                _set_pickup(result, result_dict)
+        serialized_results['results'][dict_key].append(result_dict)
 
-            # handle state results in the county files
-            if key == 'fipscode' and result.level == 'state':
-                dict_key = 'state'
-            else:
-                dict_key = result_dict[key]
+    serialized_results['last_updated'] = last_updated or datetime.utcnow()
+
+    return serialized_results
 
-            if not serialized_results['results'].get(dict_key):
-                serialized_results['results'][dict_key] = []
+def _stream_by_key(results, selections, key, f, extra=None):
+    """
+    Write rows from a _group_rows query to f one group at a time, as the
+    same JSON _serialize_by_key and _write_json_file would produce. extra
+    is called once the rows are written and what it returns added as
+    "extra".
+    """
+    fields = _serialized_fields(selections)
+    last_updated = None
 
-            serialized_results['results'][dict_key].append(result_dict)
+    f.write('{"results": {')
 
-        serialized_results['last_updated'] = get_last_updated(serialized_results)
+    for i, (dict_key, group) in enumerate(groupby(results, key=lambda result: _get_dict_key(result, key))):
+        serialized_group = []
+        for result in group:
+            serialized_group.append(_serialize_result(result, fields))
+            last_updated = _get_row_last_updated(result, last_updated)
 
-        if collate_other:
-            serialized_results = collate_other_candidates(serialized_results)
+        if i:
+            f.write(', ')
 
-        return serialized_results
+        f.write('{0}: '.format(json.dumps(dict_key)))
+        json.dump(serialized_group, f, use_decimal=True, cls=utils.APDatetimeEncoder)
+
+    f.write('}, "last_updated": ')
+    json.dump(last_updated or datetime.utcnow(), f, use_decimal=True, cls=utils.APDatetimeEncoder)
+
+    if extra is not None:
+        f.write(', "extra": ')
+        json.dump(extra(), f)
+
+    f.write('}')
+
+def _serialize_result(result, fields):
+    if result.is_other:
+        return {
+            'first': result.first,
+            'last': result.last,
+            'votecount': result.votecount,
+            'votepct': result.votepct,
+            'npr_winner': result.is_npr_winner()
+        }
+
+    result_dict = {field: getattr(result, field, None) for field in fields}
+
+    if result.level not in uncallable_levels:
+        _set_meta(result, result_dict)
+
+    if result.officename in pickup_offices:
+        _set_pickup(result, result_dict)
+
+    return result_dict
+
+def _get_dict_key(result, key):
+    # handle state results in the county files
+    if key == 'fipscode' and result.level == 'state':
+        return 'state'
+    else:
+        return getattr(result, key)
 
 def _set_meta(result, result_dict):
-    meta = models.RaceMeta.get(models.RaceMeta.result_id == result.id)
-    result_dict['meta'] = model_to_dict(meta, only=RACE_META_SELECTIONS)
+    result_dict['meta'] = {field: getattr(result, field) for field in RACE_META_FIELDS}
     result_dict['npr_winner'] = result.is_npr_winner()
 
 def _set_pickup(result, result_dict):
@@ -473,110 +837,440 @@ def _calculate_bop(result, bop):
 
     if result.is_pickup():
         bop[party]['pickups'] += 1
-        bop[result.meta[0].current_party]['pickups'] -= 1
+        bop[result.current_party]['pickups'] -= 1
 
     if result.is_expected():
         bop[party]['expected'] -= 1
 
     if result.is_not_expected():
-        bop[result.meta[0].expected]['expected'] -= 1
+        bop[result.expected]['expected'] -= 1
 
     if not bop['last_updated'] or result.lastupdated > bop['last_updated']:
         bop['last_updated'] = result.lastupdated
 
 
-def collate_other_candidates(serialized_results):
-    for key, val in serialized_results['results'].items():        
-        if isinstance(val, list):
-            other_votecount = 0
-            other_votepct = 0
-            other_winner = False
-            filtered = []
-            for result in val:
-                if result['officename'] == 'President':
-                    if result['last'] not in ACCEPTED_PRESIDENTIAL_CANDIDATES:
-                        other_votecount += result['votecount']
-                        other_votepct += result['votepct']
-                        if result.get('npr_winner') == True:
-                            other_winner = True
-                    else:
-                        filtered.append(result)
-                else:
-
-                    if result['party'] not in ACCEPTED_PARTIES and (result['raceid'] != '36602' and result['last'] != 'Babinec'):
-                        other_votecount += result['votecount']
-                        other_votepct += result['votepct']
-                        if result.get('npr_winner') == True:
-                            other_winner = True
-                    else:
-                        filtered.append(result)
-
-            filtered.append({
-                'first': '',
-                'last': 'Other',
-                'votecount': other_votecount,
-                'votepct': other_votepct,
-                'npr_winner': other_winner
-            })
-
-            serialized_results['results'][key] = filtered
-
-    return serialized_results
-
 def get_last_updated(serialized_results):
     last_updated = None
 
     for key, val in serialized_results['results'].items():
         if isinstance(val, list):
-            if val[0]['precinctsreporting'] > 0:
-                for result in val:
-                    if not last_updated or result['lastupdated'] > last_updated:
-                        last_updated = result['lastupdated']
+            last_updated = _get_group_last_updated(val, last_updated)
 
         elif isinstance(val, dict):
             for key, val in val.items():
-                if val[0]['precinctsreporting'] > 0:
-                    for result in val:
-                        if not last_updated or result['lastupdated'] > last_updated:
-                            last_updated = result['lastupdated']
+                last_updated = _get_group_last_updated(val, last_updated)
 
     if not last_updated:
         last_updated = datetime.utcnow()
 
     return last_updated
 
+def _get_group_last_updated(results, last_updated):
+    if results[0]['precinctsreporting'] > 0:
+        for result in results:
+            if not last_updated or result['lastupdated'] > last_updated:
+                last_updated = result['lastupdated']
+
+    return last_updated
+
+def _get_row_last_updated(result, last_updated):
+    if result.group_last_updated and (not last_updated or result.group_last_updated > last_updated):
+        return result.group_last_updated
+
+    return last_updated
+
+def _group_rows(results, key, collate_other=False):
+    """
+    Have the query return each key's rows together with the key's
+    last_updated, and with collate_other, its "Other" row
+    """
+    if key == 'fipscode':
+        # state results go in the county files under 'state'
+        group = """CASE WHEN selected."level" = 'state' THEN 'state' ELSE selected."fipscode" END"""
+    else:
+        group = 'selected."{0}"'.format(key)
+
+    return results.group_rows(group, other=OTHER_CANDIDATE_SQL if collate_other else None)
+
 def _write_json_file(serialized_results, filename):
     with open('{0}/{1}'.format(app_config.DATA_OUTPUT_FOLDER, filename), 'w') as f:
         json.dump(serialized_results, f, use_decimal=True, cls=utils.APDatetimeEncoder)
 
+"""
+Postgres render backend: the database builds the big board and state
+documents as JSON text and render only writes them out.
+"""
+# Result columns the document queries need besides the selections
+JSON_ROW_COLUMNS = [
+    models.Result.level,
+    models.Result.officename,
+    models.Result.party,
+    models.Result.last,
+    models.Result.raceid,
+    models.Result.statepostal,
+    models.Result.reportingunitname,
+    models.Result.precinctsreporting,
+    models.Result.lastupdated,
+    models.Result.votecount,
+    models.Result.votepct
+]
+
+# utils.APDatetimeEncoder's JSON string for a naive UTC timestamp
+AP_DATETIME_SQL = """'"' || (ARRAY[{months}])[extract(month FROM {ts})::int] || to_char({ts}, ' FMDD, YYYY, FMHH12:MI a.m.') || '"'"""
+AP_TIMESTAMP_SQL = "(({0}) AT TIME ZONE 'UTC' AT TIME ZONE 'US/Eastern')"
+
+NOW_SQL = "(now() AT TIME ZONE 'UTC')"
+
+BIG_BOARD_SQL = """
+WITH result_row AS (
+    SELECT n, poll_closing, {dict_key} AS dict_key, {skip} AS skip, {doc} AS doc, precinctsreporting, lastupdated
+    FROM ({rows}) AS selected
+), grouped AS (
+    SELECT
+        poll_closing,
+        dict_key,
+        min(n) AS n,
+        string_agg(doc, ', ' ORDER BY n) AS docs,
+        CASE WHEN (array_agg(precinctsreporting ORDER BY n))[1] > 0 THEN max(lastupdated) END AS lastupdated
+    FROM result_row
+    WHERE NOT skip
+    GROUP BY poll_closing, dict_key
+), bucket AS (
+    SELECT
+        poll_closing,
+        min(n) AS n,
+        (
+            SELECT string_agg({group_key} || ': [' || grouped.docs || ']', ', ' ORDER BY grouped.n)
+            FROM grouped
+            WHERE grouped.poll_closing IS NOT DISTINCT FROM result_row.poll_closing
+        ) AS docs
+    FROM result_row
+    GROUP BY poll_closing
+)
+SELECT '{{"results": {{' || COALESCE(string_agg({bucket_key} || ': {{' || COALESCE(docs, '') || '}}', ', ' ORDER BY n), '')
+    || '}}, "last_updated": ' || (SELECT {last_updated} FROM grouped) || '}}'
+FROM bucket
+"""
+
+BY_KEY_SQL = """
+WITH result_row AS (
+    SELECT n, {dict_key} AS dict_key, {doc} AS doc, {other} AS other, votecount, votepct, {npr_winner} AS npr_winner, precinctsreporting, lastupdated
+    FROM ({rows}) AS selected
+), grouped AS (
+    SELECT
+        dict_key,
+        min(n) AS n,
+        {docs} AS docs,
+        CASE WHEN (array_agg(precinctsreporting ORDER BY n))[1] > 0 THEN max(lastupdated) END AS lastupdated
+    FROM result_row
+    GROUP BY dict_key
+)
+SELECT
+    '{{"results": {{' || COALESCE(string_agg({group_key} || ': [' || docs || ']', ', ' ORDER BY n), '')
+        || '}}, "last_updated": ' || {last_updated} || '}}',
+    COALESCE(max(lastupdated), {now})
+FROM grouped
+"""
+
+# The "Other" entry closing each list
+OTHER_DOC_SQL = """COALESCE(string_agg(doc, ', ' ORDER BY n) FILTER (WHERE NOT other) || ', ', '')
+            || '{"first": "", "last": "Other", "votecount": ' || COALESCE(sum(votecount) FILTER (WHERE other), 0)
+            || ', "votepct": ' || COALESCE(sum(votepct) FILTER (WHERE other), 0)
+            || ', "npr_winner": ' || CASE WHEN bool_or(npr_winner) FILTER (WHERE other) THEN 'true' ELSE 'false' END || '}'"""
+
+NON_ASCII = re.compile('[\x7f-\U0010ffff]')
+
+def _sql_literal(value):
+    return "'{0}'".format(value.replace("'", "''").replace('%', '%%'))
+
+def _sql_list(values):
+    return ', '.join(_sql_literal(value) for value in values)
+
+def _sql_column(name):
+    return '"{0}"'.format(name)
+
+def _ap_datetime_sql(expression):
+    return AP_DATETIME_SQL.format(
+        months=_sql_list(utils.AP_MONTHS),
+        ts=AP_TIMESTAMP_SQL.format(expression)
+    )
+
+def _json_value_sql(field, column=None):
+    column = column or _sql_column(field.name)
+
+    if isinstance(field, DateTimeField):
+        value = _ap_datetime_sql(column)
+    else:
+        value = 'to_json({0})::text'.format(column)
+
+    return "COALESCE({0}, 'null')".format(value)
+
+def _json_bool_sql(column):
+    return "CASE WHEN {0} THEN 'true' ELSE 'false' END".format(column)
+
+def _json_object_sql(pairs, close=True):
+    """
+    SQL text expression for a JSON object from (key, value expression)
+    pairs, laid out the way simplejson writes a dict. Leave it open to
+    append more members.
+    """
+    pieces = []
+
+    for i, (key, value) in enumerate(pairs):
+        pieces.append(_sql_literal('{0}{1}: '.format('{' if i == 0 else ', ', json.dumps(key))))
+        pieces.append(value)
+
+    if close:
+        pieces.append(_sql_literal('}'))
+
+    return ' || '.join(pieces)
+
+def _json_row_sql(selections):
+    """
+    SQL text expression for the document _serialize_result makes of a row
+    """
+    selected = set(selections)
+    fields = [field for field in models.Result._meta.declared_fields if field in selected]
+
+    callable_level = '({0} IS NULL OR {0} NOT IN ({1}))'.format(_sql_column('level'), _sql_list(uncallable_levels))
+    meta = _json_object_sql([
+        (name, _json_value_sql(getattr(models.RaceStatus, name))) for name in RACE_META_FIELDS
+    ])
+    uncallable_meta = _sql_literal(', "meta": null' if models.Result.meta in selected else '')
+
+    row = _json_object_sql([(field.name, _json_value_sql(field)) for field in fields], close=False)
+
+    return """{row}
+        || CASE WHEN {callable_level} THEN ', "meta": ' || {meta} || ', "npr_winner": ' || {npr_winner} ELSE {uncallable_meta} END
+        || CASE WHEN {officename} IN ({pickup_offices}) THEN ', "pickup": ' || {pickup} ELSE '' END
+        || '}}'""".format(
+        row=row,
+        callable_level=callable_level,
+        meta=meta,
+        npr_winner=_json_bool_sql(_sql_column('npr_winner')),
+        uncallable_meta=uncallable_meta,
+        officename=_sql_column('officename'),
+        pickup_offices=_sql_list(pickup_offices),
+        pickup=_json_bool_sql(_sql_column('pickup'))
+    )
+
+def _json_rows(results, selections):
+    """
+    Reselect a _select_rows query with the columns the document queries
+    need, numbered in ROW_ORDER
+    """
+    selected = set(selections) | set(JSON_ROW_COLUMNS)
+    columns = [field for field in models.Result._meta.declared_fields if field in selected]
+    number = fn.row_number().over(order_by=ROW_ORDER).alias('n')
+
+    return results.select(*(columns + RACE_STATUS_SELECTIONS + [number])).order_by().sql()
+
+def _json_key_sql(expression):
+    # simplejson writes a None key as "null"
+    return """COALESCE(to_json({0})::text, '"null"')""".format(expression)
+
+def _big_board_sql(results, selections, key='raceid'):
+    """
+    The query that builds _serialize_for_big_board's document
+    """
+    rows, params = _json_rows(results, selections)
+
+    if key == 'statepostal':
+        dict_key = """CASE WHEN "reportingunitname" ~ '\\d$' THEN "statepostal" || '-' || right("reportingunitname", 1) ELSE "statepostal" END"""
+        skip = """COALESCE("officename" = 'President' AND "statepostal" IN ('ME', 'NE') AND "level" = 'state', false)"""
+    else:
+        dict_key = _sql_column(key)
+        skip = 'false'
+
+    sql = BIG_BOARD_SQL.format(
+        rows=rows,
+        dict_key=dict_key,
+        skip=skip,
+        doc=_json_row_sql(selections),
+        group_key=_json_key_sql('grouped.dict_key'),
+        bucket_key=_json_key_sql('poll_closing'),
+        last_updated=_ap_datetime_sql('COALESCE(max(lastupdated), {0})'.format(NOW_SQL))
+    )
+
+    return sql, params
+
+def _by_key_sql(results, selections, key, collate_other=False):
+    """
+    The query that builds _serialize_by_key's document, and its
+    last_updated timestamp
+    """
+    rows, params = _json_rows(results, selections)
+
+    npr_winner = '({0} IS NULL OR {0} NOT IN ({1})) AND COALESCE("npr_winner", false)'.format(
+        _sql_column('level'), _sql_list(uncallable_levels)
+    )
+
+    if collate_other:
+        docs = OTHER_DOC_SQL
+    else:
+        docs = "string_agg(doc, ', ' ORDER BY n)"
+
+    sql = BY_KEY_SQL.format(
+        rows=rows,
+        dict_key=_sql_column(key),
+        doc=_json_row_sql(selections),
+        other=OTHER_CANDIDATE_SQL,
+        npr_winner=npr_winner,
+        docs=docs,
+        group_key=_json_key_sql('dict_key'),
+        last_updated=_ap_datetime_sql('COALESCE(max(lastupdated), {0})'.format(NOW_SQL)),
+        now=NOW_SQL
+    )
+
+    return sql, params
+
+def _escape_non_ascii(match):
+    # simplejson's ensure_ascii escaping; Postgres leaves these characters raw
+    n = ord(match.group())
+
+    if n < 0x10000:
+        return '\\u{0:04x}'.format(n)
+
+    n -= 0x10000
+    return '\\u{0:04x}\\u{1:04x}'.format(0xd800 | ((n >> 10) & 0x3ff), 0xdc00 | (n & 0x3ff))
+
+def _fetch_json(sql, params):
+    """
+    Run a document query and return its JSON text, ASCII-escaped like
+    simplejson's output, and any other columns
+    """
+    row = models.db.execute_sql(sql, params).fetchone()
+    return (NON_ASCII.sub(_escape_non_ascii, row[0]),) + tuple(row[1:])
+
+def _write_json_sql(sql, params, filename):
+    document, = _fetch_json(sql, params)
+
+    with open('{0}/{1}'.format(app_config.DATA_OUTPUT_FOLDER, filename), 'w') as f:
+        f.write(document)
+
+def _write_state_sql(queries, filename):
+    """
+    Write a state file from one document query per (results_key, query)
+    """
+    last_updated = None
+
+    with open('{0}/{1}'.format(app_config.DATA_OUTPUT_FOLDER, filename), 'w') as f:
+        f.write('{"results": {')
+
+        for i, (results_key, query) in enumerate(queries):
+            sql, params = _by_key_sql(query, SELECTIONS_LOOKUP[results_key], 'raceid', collate_other=True)
+            document, section_last_updated = _fetch_json(sql, params)
+
+            if not last_updated or section_last_updated > last_updated:
+                last_updated = section_last_updated
+
+            if i:
+                f.write(', ')
+
+            f.write('{0}: {1}'.format(json.dumps(results_key), document))
+
+        f.write('}, "last_updated": ')
+        json.dump(last_updated, f, cls=utils.APDatetimeEncoder)
+        f.write('}')
+
 @task
 def render_all():
     shutil.rmtree('{0}'.format(app_config.DATA_OUTPUT_FOLDER))
     os.makedirs('{0}'.format(app_config.DATA_OUTPUT_FOLDER))
-    render_top_level_numbers()
-    render_presidential_state_results()
-    render_presidential_county_results()
-    render_presidential_big_board()
-    render_senate_results()
-    render_governor_results()
-    render_ballot_measure_results()
-    render_house_results()
-    render_state_results()
+
+    # every file, including the parallel workers', reads the same snapshot
+    with models.consistent_snapshot():
+        render_top_level_numbers()
+        render_presidential_state_results()
+        render_presidential_county_results()
+        render_presidential_big_board()
+        render_race_estimates()
+        render_senate_results()
+        render_governor_results()
+        render_ballot_measure_results()
+        render_house_results()
+        render_state_results()
+        render_path_to_270()
 
 @task
 def render_all_national():
-    render_top_level_numbers()
-    render_presidential_state_results()
-    render_presidential_big_board()
-    render_senate_results()
-    render_governor_results()
-    render_ballot_measure_results()
-    render_house_results()
-    render_state_results()
+    with models.consistent_snapshot():
+        render_top_level_numbers()
+        render_presidential_state_results()
+        render_presidential_big_board()
+        render_senate_results()
+        render_governor_results()
+        render_ballot_measure_results()
+        render_house_results()
+        render_state_results()
+        render_race_estimates()
+        render_path_to_270()
 
 @task
 def render_presidential_files():
-    render_top_level_numbers()
-    render_presidential_state_results()
-    render_presidential_county_results()
-    render_presidential_big_board()
+    with models.consistent_snapshot():
+        render_top_level_numbers()
+        render_presidential_state_results()
+        render_presidential_county_results()
+        render_presidential_big_board()
+        render_race_estimates()
+        render_path_to_270()
+
+@task
+def benchmark_backends(runs=3):
+    """
+    Time the big board and state documents on each render backend against
+    whatever is loaded (bootstrap a national fixture first), and check both
+    write the same bytes. States render serially so the numbers measure
+    serialization, not the worker pool.
+    """
+    runs = int(runs)
+    states = [state.statepostal for state in models.Result.select(models.Result.statepostal).distinct().order_by(models.Result.statepostal)]
+    renders = [
+        ('presidential big board', render_presidential_big_board),
+        ('senate', render_senate_results),
+        ('governor', render_governor_results),
+        ('ballot measures', render_ballot_measure_results),
+        ('house', render_house_results),
+        ('states', lambda: [_render_state(statepostal) for statepostal in states])
+    ]
+
+    backend, output_folder = app_config.RENDER_BACKEND, app_config.DATA_OUTPUT_FOLDER
+    folders = {}
+    timings = {}
+
+    try:
+        for name in ['python', 'postgres']:
+            app_config.RENDER_BACKEND = name
+            app_config.DATA_OUTPUT_FOLDER = folders[name] = tempfile.mkdtemp(prefix='render-{0}-'.format(name))
+
+            for label, render_documents in renders:
+                elapsed = []
+                for i in range(runs):
+                    start = time()
+                    render_documents()
+                    elapsed.append(time() - start)
+
+                timings[name, label] = min(elapsed)
+    finally:
+        app_config.RENDER_BACKEND, app_config.DATA_OUTPUT_FOLDER = backend, output_folder
+
+    for label, render_documents in renders:
+        python_time, postgres_time = timings['python', label], timings['postgres', label]
+        logger.info('{0:<24} python {1:8.1f}ms  postgres {2:8.1f}ms  {3:5.2f}x'.format(
+            label, python_time * 1000, postgres_time * 1000, python_time / postgres_time
+        ))
+
+    mismatches = [
+        filename for filename in sorted(os.listdir(folders['python']))
+        if not filecmp.cmp(os.path.join(folders['python'], filename), os.path.join(folders['postgres'], filename), shallow=False)
+    ]
+
+    if mismatches:
+        logger.error('backends wrote different bytes for {0}, kept in {1} and {2}'.format(', '.join(mismatches), folders['python'], folders['postgres']))
+    else:
+        logger.info('both backends wrote identical files')
+        for folder in folders.values():
+            shutil.rmtree(folder)
+
+    return timings
@@ -4,7 +4,7 @@ Commands related to syncing docs and spreadsheets from Google Drive.
 """
 
 import app_config
-import copytext
+import copy_cache
 
 from fabric.api import task
 from fabric.state import env
@@ -26,6 +26,7 @@ def update_copytext():
     """
     get_document(app_config.COPY_GOOGLE_DOC_KEY,
                     app_config.COPY_PATH)
+    copy_cache.refresh(app_config.COPY_PATH)
 
 
 @task
@@ -34,4 +35,5 @@ def update_calendar():
     Download calendar file.
     """
     get_document(app_config.CALENDAR_GOOGLE_DOC_KEY,
-                    app_config.CALENDAR_PATH)
\ No newline at end of file
+                    app_config.CALENDAR_PATH)
+    copy_cache.refresh(app_config.CALENDAR_PATH)
@@ -4,6 +4,8 @@ import app_config
 import boto
 from datetime import date, datetime
 import logging
+import os
+import shutil
 from pytz import timezone
 import simplejson as json
 from time import time
@@ -45,6 +47,38 @@ def get_bucket(bucket_name):
 
     return s3.get_bucket(bucket_name)
 
+def deploy_to_folder(output_folder, bucket):
+    """
+    deploy_data_folder against a local folder standing in for the bucket:
+    copy top-level-results.json, then sync the rest the way `aws s3 sync`
+    does, copying files whose size differs or that are newer than the
+    bucket's copy. Returns the number of files and bytes copied.
+    """
+    copied = []
+    filenames = sorted(os.listdir(output_folder))
+
+    if 'top-level-results.json' in filenames:
+        copied.append(_copy_to_folder(output_folder, bucket, 'top-level-results.json'))
+
+    for filename in filenames:
+        source, destination = os.path.join(output_folder, filename), os.path.join(bucket, filename)
+
+        if filename in copied:
+            continue
+
+        if os.path.exists(destination):
+            source_stat, destination_stat = os.stat(source), os.stat(destination)
+            if source_stat.st_size == destination_stat.st_size and source_stat.st_mtime <= destination_stat.st_mtime:
+                continue
+
+        copied.append(_copy_to_folder(output_folder, bucket, filename))
+
+    return len(copied), sum(os.path.getsize(os.path.join(bucket, filename)) for filename in copied)
+
+def _copy_to_folder(output_folder, bucket, filename):
+    shutil.copyfile(os.path.join(output_folder, filename), os.path.join(bucket, filename))
+    return filename
+
 @task
 def install_font(force='true'):
     """
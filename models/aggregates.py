@@ -0,0 +1,336 @@
+"""
+Running totals behind top-level-results.json.
+
+Aggregate holds the balance of power and electoral college numbers.
+AggregateApplied records what each result last contributed to them, so
+when race_status changes only the results whose status moved are
+subtracted out and added back in.
+"""
+import app_config
+import logging
+
+from collections import defaultdict, OrderedDict
+from copy import deepcopy
+from models import models
+from peewee import BooleanField, CharField, DateTimeField, IntegerField
+
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+# Seats that aren't up this cycle, and expected results from the calendar
+INITIAL_TOTALS = OrderedDict([
+    ('senate_bop', {
+        'total_seats': 100,
+        'majority': 51,
+        'uncalled_races': 34,
+        'last_updated': None,
+        'Dem': {
+            'seats': 34,
+            'pickups': 0,
+            'needed': 17,
+            'expected': 8
+        },
+        'GOP': {
+            'seats': 30,
+            'pickups': 0,
+            'needed': 21,
+            'expected': 14
+        },
+        'Other': {
+            'seats': 2,
+            'pickups': 0,
+            'needed': 49,
+            'expected': 0
+        }
+    }),
+    ('house_bop', {
+        'total_seats': 435,
+        'majority': 218,
+        'uncalled_races': 435,
+        'last_updated': None,
+        'Dem': {
+            'seats': 0,
+            'pickups': 0,
+            'needed': 218,
+            'expected': 178
+        },
+        'GOP': {
+            'seats': 0,
+            'pickups': 0,
+            'needed': 218,
+            'expected': 202
+        },
+        'Other': {
+            'seats': 0,
+            'pickups': 0,
+            'needed': 218,
+            'expected': 0
+        }
+    }),
+    ('electoral_college', {
+        'Clinton': 0,
+        'Trump': 0,
+        'Johnson': 0,
+        'Stein': 0,
+        'McMullin': 0,
+    })
+])
+
+BOP_PARTIES = ['Dem', 'GOP']
+
+# Advisory lock key so only one process applies deltas at a time
+AGGREGATES_LOCK = 2016110801
+
+APPLIED_COLUMNS = [
+    'name',
+    'party',
+    'current_party',
+    'expected',
+    'last',
+    'electoral_votes',
+    'npr_winner',
+    'pickup',
+    'expected_hit',
+    'expected_miss',
+    'lastupdated'
+]
+
+# Every result that counts toward a total, next to what it counted for
+# last time, where the two differ. Maine and Nebraska's statewide
+# presidential rows carry no votes of their own; their districts and
+# at-large rows do.
+CHANGED_SQL = """
+SELECT
+    COALESCE(current.result_id, applied.result_id),
+    {current_columns},
+    {applied_columns}
+FROM (
+    SELECT
+        result.id AS result_id,
+        CASE result.officename
+            WHEN 'U.S. Senate' THEN 'senate_bop'
+            WHEN 'U.S. House' THEN 'house_bop'
+            ELSE 'electoral_college'
+        END AS name,
+        result.party,
+        race_status.current_party,
+        race_status.expected,
+        result.last,
+        CASE WHEN result.level = 'state' AND result.statename IN ('Maine', 'Nebraska') THEN 0 ELSE result.electtotal END AS electoral_votes,
+        race_status.npr_winner,
+        race_status.pickup,
+        race_status.expected_hit,
+        race_status.expected_miss,
+        result.lastupdated
+    FROM result
+    JOIN race_status ON race_status.result_id = result.id
+    WHERE (result.level = 'state' AND result.officename IN ('U.S. Senate', 'U.S. House'))
+        OR (result.level IN ('state', 'district') AND result.officename = 'President' AND result.last IN %s)
+) current
+FULL JOIN aggregateapplied applied ON applied.result_id = current.result_id
+WHERE ({current_columns}) IS DISTINCT FROM ({applied_columns})
+""".format(
+    current_columns=', '.join('current.{0}'.format(column) for column in APPLIED_COLUMNS),
+    applied_columns=', '.join('applied.{0}'.format(column) for column in APPLIED_COLUMNS)
+)
+
+UPSERT_SQL = """
+INSERT INTO aggregate (name, key, field, value) VALUES (%s, %s, %s, %s)
+ON CONFLICT (name, key, field) DO UPDATE SET value = aggregate.value + EXCLUDED.value
+"""
+
+
+class Aggregate(models.BaseModel):
+    name = CharField()
+    key = CharField(default='')
+    field = CharField(default='')
+    value = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('name', 'key', 'field'), True),
+        )
+
+
+class AggregateApplied(models.BaseModel):
+    result_id = CharField(primary_key=True)
+    name = CharField()
+    party = CharField(null=True)
+    current_party = CharField(null=True)
+    expected = CharField(null=True)
+    last = CharField(null=True)
+    electoral_votes = IntegerField(null=True)
+    npr_winner = BooleanField()
+    pickup = BooleanField()
+    expected_hit = BooleanField()
+    expected_miss = BooleanField()
+    lastupdated = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('name', 'lastupdated'), False),
+        )
+
+
+def create_tables():
+    Aggregate.create_table()
+    AggregateApplied.create_table()
+
+
+def update_aggregates():
+    """
+    Apply the change in each result's contribution since the last update.
+    Rebuilds instead when the totals were never seeded from
+    INITIAL_TOTALS, since the deltas only make sense on top of them.
+    Returns the number of results that changed.
+    """
+    with models.db.transaction():
+        models.db.execute_sql('SELECT pg_advisory_xact_lock(%s)', (AGGREGATES_LOCK,))
+
+        seeded = set(Aggregate.select(Aggregate.name, Aggregate.key, Aggregate.field).tuples())
+        missing = set(_initial_keys()) - seeded
+
+        if missing:
+            logger.warning('aggregates are missing {0} initial totals, rebuilding'.format(len(missing)))
+            return _rebuild()
+
+        return _apply_changes()
+
+
+def rebuild_aggregates():
+    """
+    Reset the totals to their initial values and apply every result again.
+    """
+    with models.db.transaction():
+        models.db.execute_sql('SELECT pg_advisory_xact_lock(%s)', (AGGREGATES_LOCK,))
+
+        return _rebuild()
+
+
+def _rebuild():
+    Aggregate.delete().execute()
+    AggregateApplied.delete().execute()
+
+    for name, totals in INITIAL_TOTALS.items():
+        for key, field, value in _flatten(name, totals):
+            Aggregate.create(name=name, key=key, field=field, value=value)
+
+    return _apply_changes()
+
+
+def _apply_changes():
+    candidates = tuple(INITIAL_TOTALS['electoral_college'].keys())
+    changed = models.db.execute_sql(CHANGED_SQL, (candidates,)).fetchall()
+
+    if not changed:
+        return 0
+
+    n_columns = len(APPLIED_COLUMNS)
+    deltas = defaultdict(int)
+    current_rows = []
+
+    for row in changed:
+        result_id = row[0]
+        current = dict(zip(APPLIED_COLUMNS, row[1:n_columns + 1]))
+        applied = dict(zip(APPLIED_COLUMNS, row[n_columns + 1:]))
+
+        if applied['name'] is not None:
+            for aggregate_key, value in _contributions(applied):
+                deltas[aggregate_key] -= value
+
+        if current['name'] is not None:
+            for aggregate_key, value in _contributions(current):
+                deltas[aggregate_key] += value
+
+            current['result_id'] = result_id
+            current_rows.append(current)
+
+    for (name, key, field), value in deltas.items():
+        if value:
+            models.db.execute_sql(UPSERT_SQL, (name, key, field, value))
+
+    AggregateApplied.delete().where(
+        AggregateApplied.result_id << [row[0] for row in changed]
+    ).execute()
+
+    for i in range(0, len(current_rows), 500):
+        AggregateApplied.insert_many(current_rows[i:i + 500]).execute()
+
+    return len(changed)
+
+
+def get_totals():
+    """
+    Current totals, shaped like INITIAL_TOTALS
+    """
+    totals = deepcopy(INITIAL_TOTALS)
+
+    for aggregate in Aggregate.select():
+        if aggregate.name == 'electoral_college':
+            totals[aggregate.name][aggregate.key] = aggregate.value
+        elif aggregate.key:
+            totals[aggregate.name].setdefault(aggregate.key, {})[aggregate.field] = aggregate.value
+        else:
+            totals[aggregate.name][aggregate.field] = aggregate.value
+
+    for name in ['senate_bop', 'house_bop']:
+        last_updated = AggregateApplied.select(AggregateApplied.lastupdated).where(
+            AggregateApplied.name == name,
+            ~(AggregateApplied.lastupdated >> None)
+        ).order_by(AggregateApplied.lastupdated.desc()).limit(1).first()
+
+        if last_updated:
+            totals[name]['last_updated'] = last_updated.lastupdated
+
+    return totals
+
+
+def _initial_keys():
+    for name, totals in INITIAL_TOTALS.items():
+        for key, field, value in _flatten(name, totals):
+            yield name, key, field
+
+
+def _flatten(name, totals):
+    if name == 'electoral_college':
+        for key, value in totals.items():
+            yield key, '', value
+        return
+
+    for key, value in totals.items():
+        if isinstance(value, dict):
+            for field, party_value in value.items():
+                yield key, field, party_value
+        elif isinstance(value, int):
+            yield '', key, value
+
+
+def _contributions(row):
+    """
+    ((name, key, field), value) pairs one result adds to the totals
+    """
+    name = row['name']
+
+    if name == 'electoral_college':
+        if row['npr_winner']:
+            yield (name, row['last'], ''), row['electoral_votes'] or 0
+        return
+
+    party = row['party'] if row['party'] in BOP_PARTIES else 'Other'
+
+    if row['npr_winner']:
+        yield (name, party, 'seats'), 1
+        yield (name, party, 'needed'), -1
+        yield (name, '', 'uncalled_races'), -1
+
+    if row['pickup']:
+        yield (name, party, 'pickups'), 1
+
+        if row['current_party']:
+            yield (name, row['current_party'], 'pickups'), -1
+
+    if row['expected_hit']:
+        yield (name, party, 'expected'), -1
+
+    if row['expected_miss']:
+        yield (name, row['expected'], 'expected'), -1
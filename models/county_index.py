@@ -0,0 +1,171 @@
+"""
+County reference data packed for lookups without parsing.
+
+data.build_county_index writes every county's names, demographics and
+past results to app_config.COUNTY_INDEX_PATH as fixed-width records
+sorted by FIPS code, followed by a table of the strings they point to:
+
+    header   magic, version, record count, string table offset
+    records  5-byte FIPS code, then a float64 or a uint32 string offset
+             per field in FIELDS
+    strings  uint16 length and UTF-8 bytes, each
+
+CountyIndex memory-maps the file and binary searches the records, so
+opening it costs nothing and render workers forked after
+get_county_index() share its pages.
+"""
+import app_config
+import math
+import mmap
+import os
+import struct
+
+MAGIC = b'CNTY'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHII')
+
+# (name, 'f' for a float or 's' for a string), in record order
+FIELDS = (
+    ('name', 's'),
+    ('statename', 's'),
+    ('unemployment', 'f'),
+    ('past_margin', 's'),
+    ('winner', 's'),
+    ('winner_advantage', 'f'),
+    ('population', 'f'),
+    ('percent_white', 'f'),
+    ('percent_black', 'f'),
+    ('percent_hispanic', 'f'),
+    ('median_income', 'f'),
+    ('percent_bachelors', 'f'),
+    ('error', 'f')
+)
+
+RECORD = struct.Struct('<5s' + ''.join('d' if kind == 'f' else 'I' for name, kind in FIELDS))
+
+NO_STRING = 0xFFFFFFFF
+
+# Index opened in this process, see get_county_index()
+_county_index = None
+
+
+class CountyIndex(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self._count, self._strings = HEADER.unpack_from(self._map, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{0} is not a version {1} county index, run data.build_county_index'.format(path, VERSION))
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, fipscode):
+        return self._find(fipscode) is not None
+
+    def get(self, fipscode):
+        """
+        The county's fields by name, missing values as None, or None for
+        a county not in the index
+        """
+        offset = self._find(fipscode)
+        if offset is None:
+            return None
+
+        values = RECORD.unpack_from(self._map, offset)[1:]
+        county = {}
+
+        for (name, kind), value in zip(FIELDS, values):
+            if kind == 's':
+                county[name] = self._string(value)
+            else:
+                county[name] = None if math.isnan(value) else value
+
+        return county
+
+    def _find(self, fipscode):
+        key = fipscode.encode('ascii')
+        low, high = 0, self._count
+
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD.size
+            found = self._map[offset:offset + 5]
+
+            if found == key:
+                return offset
+            elif found < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return None
+
+    def _string(self, offset):
+        if offset == NO_STRING:
+            return None
+
+        start = self._strings + offset
+        length = struct.unpack_from('<H', self._map, start)[0]
+
+        return self._map[start + 2:start + 2 + length].decode('utf-8')
+
+
+def get_county_index():
+    """
+    The index at app_config.COUNTY_INDEX_PATH, opened once per process.
+    Call before forking workers so they share it.
+    """
+    global _county_index
+
+    if _county_index is None:
+        _county_index = CountyIndex(app_config.COUNTY_INDEX_PATH)
+
+    return _county_index
+
+
+def write_county_index(path, counties):
+    """
+    Write counties ({fipscode: {field: value}}) as an index at path.
+    Fields missing from a county are stored as missing.
+    """
+    strings = bytearray()
+    string_offsets = {}
+
+    def string_offset(value):
+        if value is None:
+            return NO_STRING
+
+        if value not in string_offsets:
+            encoded = str(value).encode('utf-8')
+            string_offsets[value] = len(strings)
+            strings.extend(struct.pack('<H', len(encoded)))
+            strings.extend(encoded)
+
+        return string_offsets[value]
+
+    records = bytearray()
+    for fipscode in sorted(counties):
+        county = counties[fipscode]
+        values = []
+
+        for name, kind in FIELDS:
+            value = county.get(name)
+
+            if kind == 's':
+                values.append(string_offset(value))
+            else:
+                values.append(float('nan') if value is None else float(value))
+
+        records.extend(RECORD.pack(fipscode.encode('ascii'), *values))
+
+    temp_path = '{0}.{1}'.format(path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(counties), HEADER.size + len(records)))
+        f.write(records)
+        f.write(strings)
+
+    os.rename(temp_path, path)
@@ -1,8 +1,17 @@
 import app_config
+import os
+import psycopg2
+import sys
+import threading
 
-from peewee import Model, PostgresqlDatabase
+from time import time
+
+from contextlib import contextmanager
+from models.query_stats import InstrumentedDatabase, query_site as _query_site
+from peewee import ExtQueryResultWrapper, Model, PostgresqlDatabase, SelectQuery, _ConnectionLocal, fn
 from peewee import BooleanField, CharField, DateField, DateTimeField, DecimalField, ForeignKeyField, IntegerField
 from slugify import slugify
+from playhouse.pool import PooledPostgresqlDatabase
 from playhouse.postgres_ext import JSONField
 
 import logging
@@ -12,13 +21,95 @@ logger.addHandler(logging.StreamHandler())
 
 # app_config.configure_targets('test')
 
-db = PostgresqlDatabase(
-    app_config.database['PGDATABASE'],
-    user=app_config.database['PGUSER'],
-    password=app_config.database['PGPASSWORD'],
-    host=app_config.database['PGHOST'],
-    port=app_config.database['PGPORT']
-)
+class ForkSafePooledPostgresqlDatabase(InstrumentedDatabase, PooledPostgresqlDatabase):
+    """
+    Connection pool that starts over in each process. After a fork (uwsgi
+    workers, joblib render workers) the child gets a fresh pool instead of
+    sharing the parent's sockets. The inherited connections are kept
+    referenced so they are never closed from the child, which would end
+    the parent's sessions.
+    """
+    def __init__(self, *args, **kwargs):
+        self._pid = os.getpid()
+        self._inherited = []
+        super(ForkSafePooledPostgresqlDatabase, self).__init__(*args, **kwargs)
+
+    # Transaction state lives here too, so a child forked mid-transaction
+    # starts outside of it rather than popping the parent's
+    @property
+    def _local(self):
+        self._check_pid()
+        return self._process_local
+
+    @_local.setter
+    def _local(self, value):
+        self._process_local = value
+
+    def _check_pid(self):
+        if self._pid == os.getpid():
+            return
+
+        self._inherited.append((self._connections, self._process_local))
+        self._pid = os.getpid()
+        self._connections = []
+        self._in_use = {}
+        self._closed = set()
+        self._process_local = _ConnectionLocal()
+        self._conn_lock = threading.Lock()
+
+    def connect(self):
+        self._check_pid()
+        super(ForkSafePooledPostgresqlDatabase, self).connect()
+
+    def get_conn(self):
+        self._check_pid()
+        return super(ForkSafePooledPostgresqlDatabase, self).get_conn()
+
+    def push_execution_context(self, transaction):
+        self._check_pid()
+        super(ForkSafePooledPostgresqlDatabase, self).push_execution_context(transaction)
+
+    # psycopg2 opens a transaction on the first query, and a connection
+    # handed back inside it would stay "idle in transaction", or aborted
+    # after a failed query, for whoever gets it next
+    def _close(self, conn, close_conn=False):
+        if not close_conn and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close_conn = True
+
+        super(ForkSafePooledPostgresqlDatabase, self)._close(conn, close_conn)
+
+
+class InstrumentedPostgresqlDatabase(InstrumentedDatabase, PostgresqlDatabase):
+    pass
+
+
+if app_config.DATABASE_POOL:
+    db = ForkSafePooledPostgresqlDatabase(
+        app_config.database['PGDATABASE'],
+        max_connections=app_config.DATABASE_POOL_MAX_CONNECTIONS,
+        stale_timeout=app_config.DATABASE_POOL_STALE_TIMEOUT,
+        user=app_config.database['PGUSER'],
+        password=app_config.database['PGPASSWORD'],
+        host=app_config.database['PGHOST'],
+        port=app_config.database['PGPORT']
+    )
+else:
+    db = InstrumentedPostgresqlDatabase(
+        app_config.database['PGDATABASE'],
+        user=app_config.database['PGUSER'],
+        password=app_config.database['PGPASSWORD'],
+        host=app_config.database['PGHOST'],
+        port=app_config.database['PGPORT']
+    )
+
+def query_site(name):
+    """
+    Count queries run inside against name, see models/query_stats.py
+    """
+    return _query_site(db.stats, name)
 
 class BaseModel(Model):
     """
@@ -106,6 +197,223 @@ class Result(BaseModel):
             return False        
 
 
+class ResultRow(object):
+    """
+    Lightweight result row for rendering. Holds only the selected columns,
+    flattened with the race_status columns, so the winner and pickup flags
+    come precomputed instead of a query per row. Columns that weren't
+    selected read as None.
+    """
+    __slots__ = [field.name for field in Result._meta.declared_fields] + [
+        'accept_ap',
+        'override_winner',
+        'poll_closing',
+        'full_poll_closing',
+        'first_results',
+        'current_party',
+        'expected',
+        'npr_winner',
+        'pickup',
+        'expected_hit',
+        'expected_miss',
+        'is_other',
+        'group_last_updated'
+    ]
+
+    def __init__(self, conv, row):
+        for i, name, converter in conv:
+            setattr(self, name, row[i] if converter is None else converter(row[i]))
+
+    def __getattr__(self, name):
+        if name in ResultRow.__slots__:
+            return None
+
+        raise AttributeError(name)
+
+    def is_npr_winner(self):
+        return bool(self.npr_winner)
+
+    def is_pickup(self):
+        return bool(self.pickup)
+
+    def is_expected(self):
+        return bool(self.expected_hit)
+
+    def is_not_expected(self):
+        return bool(self.expected_miss)
+
+
+class ResultRowWrapper(ExtQueryResultWrapper):
+    def initialize(self, description):
+        super(ResultRowWrapper, self).initialize(description)
+
+        # Names, parties and places repeat on every candidate and reporting
+        # unit row, so share one copy of each string
+        self.conv = [
+            (i, name, _intern if isinstance(getattr(self.model, name, None), CharField) else converter)
+            for i, name, converter in self.conv
+        ]
+
+    def process_row(self, row):
+        return ResultRow(self.conv, row)
+
+
+def _intern(value):
+    if value is None:
+        return None
+
+    return sys.intern(value)
+
+
+# Columns group_rows() reads whether or not they were selected
+ROW_GROUP_COLUMNS = [
+    Result.first,
+    Result.last,
+    Result.level,
+    Result.officename,
+    Result.party,
+    Result.raceid,
+    Result.fipscode,
+    Result.statepostal,
+    Result.precinctsreporting,
+    Result.lastupdated,
+    Result.votecount,
+    Result.votepct
+]
+
+# group_rows() wraps the query it groups as "selected"
+ROW_GROUPS_SQL = """
+WITH selected AS (
+    {rows}
+), grouped AS (
+    SELECT
+        flagged.*,
+        min(n) OVER (PARTITION BY row_group) AS group_n,
+        CASE WHEN first_value(precinctsreporting) OVER (PARTITION BY row_group ORDER BY n) > 0
+            THEN max(lastupdated) OVER (PARTITION BY row_group)
+        END AS group_last_updated
+    FROM (
+        SELECT selected.*, {group} AS row_group, {other} AS is_other
+        FROM selected
+    ) AS flagged
+)
+SELECT {columns}, is_other, group_last_updated
+FROM (
+    SELECT {columns}, is_other, group_last_updated, group_n, n
+    FROM grouped
+    WHERE NOT is_other
+    {other_rows}
+) AS collated
+ORDER BY group_n, n
+"""
+
+OTHER_ROWS_SQL = """
+    UNION ALL
+    SELECT {columns}, true, group_last_updated, group_n, max(n) + 1
+    FROM grouped
+    GROUP BY row_group, group_n, group_last_updated
+"""
+
+# How the Other row sums up the rows folded into it. Any other column
+# comes from the group's first row.
+OTHER_ROW_COLUMNS = {
+    'first': "''",
+    'last': "'Other'",
+    'votecount': 'COALESCE(sum(votecount) FILTER (WHERE is_other), 0)',
+    'votepct': 'COALESCE(sum(votepct) FILTER (WHERE is_other), 0)',
+    'npr_winner': 'COALESCE(bool_or(npr_winner) FILTER (WHERE is_other), false)'
+}
+
+
+class ResultRowQuery(SelectQuery):
+    """
+    Select query that returns ResultRow objects instead of Result instances.
+    """
+    _row_groups = None
+
+    def _get_result_wrapper(self):
+        return ResultRowWrapper
+
+    def _clone_attributes(self, query):
+        query = super(ResultRowQuery, self)._clone_attributes(query)
+        query._row_groups = self._row_groups
+        return query
+
+    def group_rows(self, group, other=None):
+        """
+        Bring each group's rows together, groups in the order their first
+        row comes, and set group_last_updated on every row to the group's
+        latest update if it has started reporting.
+
+        group is a SQL expression over the query's columns, qualified as
+        "selected". Rows matching the other predicate are folded into a
+        single row closing their group, with is_other set and the votes
+        summed.
+        """
+        query = self.clone()
+        query._row_groups = (group, other)
+        return query
+
+    def sql(self):
+        if not self._row_groups:
+            return super(ResultRowQuery, self).sql()
+
+        group, other = self._row_groups
+        columns = [node._alias or node.db_column for node in self._select]
+
+        query = self.clone()
+        query._row_groups = None
+        number = fn.row_number().over(order_by=self._order_by).alias('n')
+        rows, params = query.select(*(
+            list(self._select) +
+            [field for field in ROW_GROUP_COLUMNS if field.db_column not in columns] +
+            [number]
+        )).order_by().sql()
+
+        if other:
+            other_rows = OTHER_ROWS_SQL.format(columns=', '.join(
+                OTHER_ROW_COLUMNS.get(column, '(array_agg("{0}" ORDER BY n))[1]'.format(column)) for column in columns
+            ))
+        else:
+            other_rows = ''
+
+        sql = ROW_GROUPS_SQL.format(
+            rows=rows,
+            group=group,
+            other=other or 'false',
+            columns=', '.join('"{0}"'.format(column) for column in columns),
+            other_rows=other_rows
+        )
+
+        return sql, params
+
+    def stream(self, name, itersize=2000):
+        """
+        Iterate over the rows through a named server-side cursor, fetching
+        itersize rows at a time and keeping none of them. Must run inside a
+        transaction, e.g. use_snapshot().
+        """
+        sql, params = self.sql()
+        cursor = self.database.get_conn().cursor(name)
+        cursor.itersize = itersize
+        cursor.execute(sql, params)
+
+        wrapper = ResultRowWrapper(self.model_class, cursor, self.get_query_meta())
+        start = time()
+        rows = 0
+        try:
+            for row in cursor:
+                if not wrapper._initialized:
+                    wrapper.initialize(cursor.description)
+                    wrapper._initialized = True
+
+                rows += 1
+                yield wrapper.process_row(row)
+        finally:
+            cursor.close()
+            self.database.stats.record(time() - start, rows)
+
+
 class Call(BaseModel):
     call_id = ForeignKeyField(Result, related_name='call')
     accept_ap = BooleanField(default=True)
@@ -114,8 +422,283 @@ class Call(BaseModel):
 
 class RaceMeta(BaseModel):
     result_id = ForeignKeyField(Result, related_name='meta')
+    poll_closing = CharField(null=True, index=True)
+    full_poll_closing = CharField(null=True)
+    first_results = CharField(null=True)
+    current_party = CharField(null=True)
+    expected = CharField(null=True)
+
+
+class CollationException(BaseModel):
+    """
+    Candidates shown on their own even though render would fold them into
+    "Other", loaded from data/collation_exceptions.csv. A row without a
+    raceid or last matches every race or candidate.
+    """
+    raceid = CharField(null=True)
+    last = CharField(null=True)
+
+    class Meta:
+        indexes = (
+            (('raceid', 'last'), True),
+        )
+
+
+class RaceStatus(BaseModel):
+    """
+    The race_status materialized view: the call, race meta and NPR winner
+    flags for every callable result, with the Result.is_* logic done in
+    SQL. Call refresh_race_status() after results or calls change; the
+    daemon's results load picks up calls made in the admin.
+    """
+    result_id = CharField(primary_key=True)
+    accept_ap = BooleanField()
+    override_winner = BooleanField()
     poll_closing = CharField(null=True)
     full_poll_closing = CharField(null=True)
     first_results = CharField(null=True)
     current_party = CharField(null=True)
     expected = CharField(null=True)
+    npr_winner = BooleanField()
+    pickup = BooleanField()
+    expected_hit = BooleanField()
+    expected_miss = BooleanField()
+
+    class Meta:
+        db_table = 'race_status'
+
+
+RACE_STATUS_SQL = """
+CREATE MATERIALIZED VIEW race_status AS
+SELECT
+    result.id AS result_id,
+    call.accept_ap,
+    call.override_winner,
+    racemeta.poll_closing,
+    racemeta.full_poll_closing,
+    racemeta.first_results,
+    racemeta.current_party,
+    racemeta.expected,
+    winner.npr_winner,
+    winner.npr_winner AND result.party IS DISTINCT FROM racemeta.current_party AS pickup,
+    winner.npr_winner AND result.party IS NOT DISTINCT FROM racemeta.expected AS expected_hit,
+    winner.npr_winner AND COALESCE(
+        (racemeta.expected = 'Dem' AND result.party IS DISTINCT FROM 'Dem') OR
+        (racemeta.expected = 'GOP' AND result.party IS DISTINCT FROM 'GOP'),
+        false
+    ) AS expected_miss
+FROM result
+JOIN call ON call.call_id_id = result.id
+LEFT JOIN racemeta ON racemeta.result_id_id = result.id
+CROSS JOIN LATERAL (
+    SELECT COALESCE(call.override_winner, false) OR COALESCE(
+        call.accept_ap AND CASE WHEN result.level = 'district' THEN result.electwon > 0 ELSE result.winner END,
+        false
+    ) AS npr_winner
+) winner
+WHERE result.level IN ('state', 'national', 'district')
+"""
+
+
+def create_race_status():
+    db.execute_sql('DROP MATERIALIZED VIEW IF EXISTS race_status')
+    db.execute_sql(RACE_STATUS_SQL)
+    db.execute_sql('CREATE UNIQUE INDEX race_status_result_id ON race_status (result_id)')
+
+
+def refresh_race_status():
+    """
+    Recompute race_status without blocking readers, and apply whatever
+    changed to the top-level aggregates in the same transaction.
+    """
+    from models import aggregates
+
+    with db.transaction():
+        db.execute_sql('REFRESH MATERIALIZED VIEW CONCURRENTLY race_status')
+        aggregates.update_aggregates()
+
+
+class TurnoutBaseline(BaseModel):
+    """
+    Votes cast in 2012 by state (fipscode null) or county, loaded from
+    data/turnout-2012.csv when it exists.
+    """
+    statepostal = CharField()
+    fipscode = CharField(max_length=5, null=True)
+    votes = IntegerField()
+
+    class Meta:
+        indexes = (
+            (('statepostal', 'fipscode'), True),
+        )
+
+
+class RaceEstimate(BaseModel):
+    """
+    The race_estimate materialized view: expected and outstanding votes
+    for every state, district and county result. A reporting unit is
+    expected to end with its votes so far plus its 2012 turnout times the
+    share of precincts still out, or without a baseline its votes scaled
+    up by the share of precincts in. Outstanding votes are split between
+    candidates as the counted ones were. lead_ratio is the leader's
+    margin over the outstanding votes: above 1 the lead is safe even if
+    the runner-up won every vote left. Call refresh_race_estimate() after
+    results change.
+    """
+    result_id = CharField(primary_key=True)
+    expected_votes = IntegerField(null=True)
+    remaining_votes = IntegerField(null=True)
+    candidate_remaining = IntegerField(null=True)
+    lead_ratio = DecimalField(null=True)
+
+    class Meta:
+        db_table = 'race_estimate'
+
+
+RACE_ESTIMATE_SQL = """
+CREATE MATERIALIZED VIEW race_estimate AS
+WITH ranked AS (
+    SELECT
+        result.id,
+        result.raceid,
+        result.level,
+        result.reportingunitid,
+        COALESCE(result.votecount, 0) AS votecount,
+        COALESCE(result.precinctsreportingpct, 0) AS reporting,
+        COALESCE(state_baseline.votes, county_baseline.votes) AS baseline,
+        row_number() OVER (
+            PARTITION BY result.raceid, result.level, result.reportingunitid
+            ORDER BY result.votecount DESC NULLS LAST, result.id
+        ) AS place
+    FROM result
+    LEFT JOIN (
+        SELECT statepostal, max(votes) AS votes FROM turnoutbaseline WHERE fipscode IS NULL GROUP BY statepostal
+    ) AS state_baseline ON result.level = 'state' AND state_baseline.statepostal = result.statepostal
+    LEFT JOIN turnoutbaseline AS county_baseline ON result.level = 'county'
+        AND county_baseline.statepostal = result.statepostal AND county_baseline.fipscode = result.fipscode
+    WHERE result.level IN ('state', 'district', 'county')
+), unit AS (
+    SELECT
+        ranked.*,
+        sum(votecount) OVER reporting_unit AS votes,
+        max(reporting) OVER reporting_unit AS unit_reporting,
+        COALESCE(max(votecount) FILTER (WHERE place = 1) OVER reporting_unit, 0) -
+            COALESCE(max(votecount) FILTER (WHERE place = 2) OVER reporting_unit, 0) AS lead,
+        max(baseline) OVER reporting_unit AS unit_baseline
+    FROM ranked
+    WINDOW reporting_unit AS (PARTITION BY raceid, level, reportingunitid)
+), expected AS (
+    SELECT
+        unit.*,
+        CASE
+            WHEN unit_baseline IS NOT NULL THEN votes + (1 - unit_reporting) * unit_baseline
+            WHEN unit_reporting > 0 THEN votes / unit_reporting
+        END AS expected_votes
+    FROM unit
+)
+SELECT
+    id AS result_id,
+    round(expected_votes)::integer AS expected_votes,
+    round(expected_votes - votes)::integer AS remaining_votes,
+    round((expected_votes - votes) * votecount / NULLIF(votes, 0))::integer AS candidate_remaining,
+    round(lead / NULLIF(expected_votes - votes, 0), 3) AS lead_ratio
+FROM expected
+"""
+
+
+def create_race_estimate():
+    db.execute_sql('DROP MATERIALIZED VIEW IF EXISTS race_estimate')
+    db.execute_sql(RACE_ESTIMATE_SQL)
+    db.execute_sql('CREATE UNIQUE INDEX race_estimate_result_id ON race_estimate (result_id)')
+
+
+def refresh_race_estimate():
+    """
+    Recompute race_estimate without blocking readers
+    """
+    db.execute_sql('REFRESH MATERIALIZED VIEW CONCURRENTLY race_estimate')
+
+
+# (pid, snapshot id) of the consistent_snapshot this process is inside
+_active_snapshot = None
+
+
+@contextmanager
+def consistent_snapshot():
+    """
+    Run the block in one REPEATABLE READ transaction and yield its exported
+    snapshot id. Pass the id to use_snapshot() in other processes to read
+    exactly the same data, whatever is loaded meanwhile. Nested calls in
+    the same process share the outer snapshot.
+    """
+    global _active_snapshot
+
+    if _active_snapshot and _active_snapshot[0] == os.getpid():
+        yield _active_snapshot[1]
+        return
+
+    with db.transaction():
+        _begin_repeatable_read()
+        snapshot_id = db.execute_sql('SELECT pg_export_snapshot()').fetchone()[0]
+        _active_snapshot = (os.getpid(), snapshot_id)
+
+        try:
+            yield snapshot_id
+        finally:
+            _active_snapshot = None
+
+
+@contextmanager
+def use_snapshot(snapshot_id):
+    """
+    Run the block in a transaction that reads from a snapshot exported by
+    consistent_snapshot(). The exporting transaction must still be open.
+    Without a snapshot id the block gets a snapshot of its own.
+    """
+    global _active_snapshot
+
+    if snapshot_id is None:
+        with consistent_snapshot():
+            yield
+        return
+
+    with db.transaction():
+        _begin_repeatable_read()
+        db.execute_sql('SET TRANSACTION SNAPSHOT %s', (snapshot_id,))
+        _active_snapshot = (os.getpid(), snapshot_id)
+
+        try:
+            yield
+        finally:
+            _active_snapshot = None
+
+
+def _begin_repeatable_read():
+    # psycopg2 opens a transaction for any earlier select, and the
+    # isolation level can only be set before a transaction's first query
+    if db.transaction_depth() == 1:
+        db.get_conn().rollback()
+
+    db.execute_sql('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+
+# Indexes for the render and admin queries. These are built by
+# data.create_indexes rather than create_table so they can be added
+# concurrently to a database that is already taking results. The foreign
+# key and poll_closing entries use the names create_table gives them. The
+# search entries serve the calls admin's prefix search, see app_utils.
+CALLABLE_LEVELS_PREDICATE = "level IN ('state', 'national', 'district')"
+
+INDEXES = [
+    ('result_callable_office_state', 'result (officename, statepostal, raceid) WHERE {0}'.format(CALLABLE_LEVELS_PREDICATE)),
+    ('result_callable_ballot_measure', 'result (statepostal) WHERE {0} AND is_ballot_measure'.format(CALLABLE_LEVELS_PREDICATE)),
+    ('result_callable_search_last', 'result (lower(last) text_pattern_ops) WHERE {0}'.format(CALLABLE_LEVELS_PREDICATE)),
+    ('result_callable_search_first', 'result (lower(first) text_pattern_ops) WHERE {0}'.format(CALLABLE_LEVELS_PREDICATE)),
+    ('result_callable_search_seatname', 'result (lower(seatname) text_pattern_ops) WHERE {0}'.format(CALLABLE_LEVELS_PREDICATE)),
+    ('result_callable_search_statename', 'result (lower(statename) text_pattern_ops) WHERE {0}'.format(CALLABLE_LEVELS_PREDICATE)),
+    ('result_office_state_level', 'result (officename, statepostal, level)'),
+    ('result_state_fipscode', 'result (statepostal, fipscode)'),
+    ('call_call_id_id', 'call (call_id_id)'),
+    ('racemeta_result_id_id', 'racemeta (result_id_id)'),
+    ('racemeta_poll_closing', 'racemeta (poll_closing)')
+]
@@ -0,0 +1,161 @@
+"""
+Query counts, time and rows by calling site.
+
+The database counts every statement it runs against the innermost
+query_site() in effect (a render task, an admin route), and logs the
+statement and its EXPLAIN plan when one runs longer than
+app_config.SLOW_QUERY_THRESHOLD. Counting is a few additions per query,
+so it stays on in production.
+
+Each process keeps its own counts. Render workers hand theirs back to
+the task that started them with since() and merge().
+"""
+import app_config
+import logging
+import threading
+
+from contextlib import ContextDecorator
+from time import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+DEFAULT_SITE = 'other'
+
+EXPLAINABLE = ('SELECT', 'WITH')
+
+
+class QueryStats(object):
+    """
+    Totals by site: [queries, seconds, rows]
+    """
+    def __init__(self):
+        self.sites = {}
+
+        # Site stacks by thread, readable from other threads (the profiler)
+        self._stacks = {}
+
+    @property
+    def current_site(self):
+        return self.site_of(threading.get_ident())
+
+    def site_of(self, thread_id):
+        stack = self._stacks.get(thread_id)
+        return stack[-1] if stack else DEFAULT_SITE
+
+    def push(self, name):
+        self._stacks.setdefault(threading.get_ident(), []).append(name)
+
+    def pop(self):
+        thread_id = threading.get_ident()
+        self._stacks[thread_id].pop()
+
+        if not self._stacks[thread_id]:
+            del self._stacks[thread_id]
+
+    def record(self, seconds, rows, site=None):
+        totals = self.sites.setdefault(site or self.current_site, [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += max(rows, 0)
+
+    def snapshot(self):
+        return dict((site, list(totals)) for site, totals in self.sites.items())
+
+    def since(self, snapshot):
+        """
+        Totals of the queries run since snapshot was taken
+        """
+        changed = {}
+        for site, totals in self.sites.items():
+            before = snapshot.get(site, [0, 0.0, 0])
+            if totals[0] != before[0]:
+                changed[site] = [now - then for now, then in zip(totals, before)]
+
+        return changed
+
+    def merge(self, sites):
+        for site, (queries, seconds, rows) in sites.items():
+            totals = self.sites.setdefault(site, [0, 0.0, 0])
+            totals[0] += queries
+            totals[1] += seconds
+            totals[2] += rows
+
+    def log_summary(self, label, sites):
+        """
+        Log one line for label and one for each site, slowest first
+        """
+        if not sites:
+            logger.info('{0}: no queries'.format(label))
+            return
+
+        logger.info('{0}: {1} queries, {2:.1f}ms, {3} rows'.format(
+            label,
+            sum(totals[0] for totals in sites.values()),
+            sum(totals[1] for totals in sites.values()) * 1000,
+            sum(totals[2] for totals in sites.values())
+        ))
+
+        for site, (queries, seconds, rows) in sorted(sites.items(), key=lambda item: -item[1][1]):
+            logger.info('    {0:<36} {1:6} queries {2:10.1f}ms {3:8} rows'.format(site, queries, seconds * 1000, rows))
+
+
+class query_site(ContextDecorator):
+    """
+    Count the queries run inside as the named site. Works as a decorator.
+    """
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.push(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.pop()
+        return False
+
+
+class InstrumentedDatabase(object):
+    """
+    Database mixin that times every execute_sql call into self.stats
+    """
+    def __init__(self, *args, **kwargs):
+        self.stats = QueryStats()
+        super(InstrumentedDatabase, self).__init__(*args, **kwargs)
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        start = time()
+        cursor = None
+
+        try:
+            cursor = super(InstrumentedDatabase, self).execute_sql(sql, params, require_commit)
+            return cursor
+        finally:
+            elapsed = time() - start
+            self.stats.record(elapsed, cursor.rowcount if cursor is not None else 0)
+
+            if cursor is not None and elapsed * 1000 >= app_config.SLOW_QUERY_THRESHOLD:
+                self._log_slow_query(sql, params, elapsed)
+
+    def _log_slow_query(self, sql, params, elapsed):
+        logger.warning('slow query in {0}, {1:.1f}ms: {2}'.format(self.stats.current_site, elapsed * 1000, sql))
+
+        if not sql.lstrip().upper().startswith(EXPLAINABLE):
+            return
+
+        # in a savepoint, so a failed EXPLAIN leaves the transaction usable
+        cursor = self.get_cursor()
+        cursor.execute('SAVEPOINT explain_slow_query')
+        try:
+            cursor.execute('EXPLAIN {0}'.format(sql), params or ())
+            logger.warning('\n'.join(row[0] for row in cursor.fetchall()))
+            cursor.execute('RELEASE SAVEPOINT explain_slow_query')
+        except Exception as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT explain_slow_query')
+            logger.warning('could not explain slow query: {0}'.format(e))
+        finally:
+            # outside a transaction the savepoint opened one, close it
+            if not self.transaction_depth():
+                self.commit()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+"""
+A sampling profiler that can be switched on in a running process.
+
+While it runs, a background thread records every other thread's stack
+app_config.PROFILER_INTERVAL seconds apart, filed under the stage the
+thread was in (its innermost models.query_site()). When it stops it
+writes one file per stage in the collapsed stack format flamegraph.pl
+and speedscope read:
+
+    {SERVER_LOG_PATH}/profiles/{name}-{timestamp}/{stage}.collapsed
+
+Sampling only reads frames, so it can run during live coverage.
+
+Render workers are separate processes, so frames there can't be read
+from the daemon. Each render task carries profiling_until() to its worker,
+which samples itself with worker_samples() until the task ends or the
+window closes and hands the stacks back. merge() files them with the
+daemon's own, and the files wait for any workers() block still running
+to finish, for up to app_config.PROFILER_MAX_SECONDS.
+"""
+
+import app_config
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from time import sleep, time
+
+logging.basicConfig(format=app_config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(app_config.LOG_LEVEL)
+
+# The profiler sampling in this process, see profiling_until() and merge()
+_running = None
+
+# workers() blocks running in this process
+_workers = 0
+_workers_done = threading.Condition()
+
+
+class SamplingProfiler(object):
+    def __init__(self, name, stage_of=None, interval=None):
+        self.name = name
+        self.stage_of = stage_of or (lambda thread_id: 'all')
+        self.interval = interval or app_config.PROFILER_INTERVAL
+        self._thread = None
+        self._labels = {}
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._merged = []
+        self.until = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds):
+        """
+        Sample for seconds in the background. Returns False if the
+        profiler is already running.
+        """
+        global _running
+
+        if self.running:
+            return False
+
+        self.until = time() + seconds
+        self._merged = []
+        _running = self
+
+        self._thread = threading.Thread(target=self._run, args=(seconds,), name='sampling-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info('profiling {0} for {1}s'.format(self.name, seconds))
+
+        return True
+
+    def install_signal(self, signum=signal.SIGUSR2):
+        """
+        Profile for app_config.PROFILER_SECONDS whenever the process gets
+        signum, e.g. `kill -USR2 <pid>`.
+        """
+        signal.signal(signum, lambda signum, frame: self.start(app_config.PROFILER_SECONDS))
+
+    def _run(self, seconds):
+        global _running
+
+        samples = self.sample(seconds)
+
+        with _workers_done:
+            _workers_done.wait_for(lambda: _workers == 0, timeout=app_config.PROFILER_MAX_SECONDS)
+
+        with self._lock:
+            _running = None
+            self.until = None
+
+            for merged in self._merged:
+                for stage, stacks in merged.items():
+                    samples[stage].update(stacks)
+
+        self.write(samples)
+
+    def merge(self, samples):
+        """
+        Add samples taken in another process, if still running
+        """
+        with self._lock:
+            if self.until is None:
+                return False
+
+            self._merged.append(samples)
+            return True
+
+    def sample(self, seconds):
+        """
+        Collapsed stacks counted by stage
+        """
+        samples = defaultdict(Counter)
+        own_id = threading.get_ident()
+        deadline = time() + seconds
+
+        while time() < deadline and not self._stop.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                samples[self.stage_of(thread_id)][self._collapse(frame)] += 1
+
+            sleep(self.interval)
+
+        return samples
+
+    def write(self, samples):
+        folder = os.path.join(app_config.SERVER_LOG_PATH, 'profiles', '{0}-{1}'.format(
+            self.name, datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        ))
+        os.makedirs(folder, exist_ok=True)
+
+        for stage, stacks in samples.items():
+            filename = '{0}.collapsed'.format(re.sub(r'[^\w.-]+', '-', stage))
+            with open(os.path.join(folder, filename), 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write('{0} {1}\n'.format(stack, count))
+
+        logger.info('wrote {0} samples in {1} stages to {2}'.format(
+            sum(sum(stacks.values()) for stacks in samples.values()), len(samples), folder
+        ))
+
+        return folder
+
+    def _collapse(self, frame):
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+
+        return ';'.join(reversed(labels))
+
+    def _label(self, code):
+        label = self._labels.get(code)
+
+        if label is None:
+            label = self._labels[code] = '{0} ({1}:{2})'.format(
+                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+            )
+
+        return label
+
+
+def profiling_until():
+    """
+    When the profiler sampling in this process stops, or None
+    """
+    profiler = _running
+    return profiler.until if profiler else None
+
+
+def merge(samples):
+    """
+    File samples from a worker with the profiler sampling in this process
+    """
+    profiler = _running
+    if profiler and samples:
+        profiler.merge(samples)
+
+
+@contextmanager
+def workers():
+    """
+    Keep a profile that is running from being written until the block,
+    which hands out profiling_until() to workers and merges what they
+    send back, is done
+    """
+    global _workers
+
+    with _workers_done:
+        _workers += 1
+
+    try:
+        yield
+    finally:
+        with _workers_done:
+            _workers -= 1
+            _workers_done.notify_all()
+
+
+@contextmanager
+def worker_samples(until, stage_of=None):
+    """
+    Sample this process while the block runs, up to until (a time()), and
+    fill the yielded dict with the collapsed stacks by stage for merge()
+    in the parent. Without until, or once it has passed, does nothing.
+    """
+    samples = {}
+
+    if not until or time() >= until:
+        yield samples
+        return
+
+    sampler = SamplingProfiler('worker', stage_of=stage_of)
+    thread = threading.Thread(target=lambda: samples.update(sampler.sample(until - time())), name='sampling-profiler')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        yield samples
+    finally:
+        sampler._stop.set()
+        thread.join()
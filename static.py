@@ -8,7 +8,7 @@ import subprocess
 from flask import abort, make_response
 
 import app_config
-import copytext
+import copy_cache
 from flask import Blueprint
 from render_utils import BetterJSONEncoder, flatten_app_config
 
@@ -42,7 +42,7 @@ def _app_config_js():
 # Render copytext
 @static.route('/js/copy.js')
 def _copy_js():
-    copy = 'window.COPY = ' + copytext.Copy(app_config.COPY_PATH).json()
+    copy = 'window.COPY = ' + copy_cache.get_copy(app_config.COPY_PATH).json()
 
     return make_response(copy, 200, { 'Content-Type': 'application/javascript' })
 
@@ -3,12 +3,26 @@
 import app_config
 import app_utils
 import calendar
+import copy_cache
+import math
+import multiprocessing
+import os
+import profiler
+import shutil
+import simplejson as json
+import tempfile
+import threading
 import time
+import tracemalloc
 import unittest
 
-from fabfile import data, render
-from models import models
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+from fabfile import bench, daemons, data, fixtures, render, utils
+from models import aggregates, county_index, models
 from peewee import *
+from playhouse.shortcuts import model_to_dict
 
 # class ResultsLoadingTestCase(unittest.TestCase):
 #     """
@@ -108,5 +122,1091 @@ class ResultsRenderingTestCase(unittest.TestCase):
 
         self.assertEqual(len(serialized_results.keys()), 67)
 
+class IndexUsageTestCase(unittest.TestCase):
+    """
+    Test that the hot queries can be answered without scanning result
+    """
+    def _explain(self, query):
+        sql, params = query.sql()
+        with models.db.transaction():
+            models.db.execute_sql('SET LOCAL enable_seqscan = off')
+            cursor = models.db.execute_sql('EXPLAIN {0}'.format(sql), params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def assertIndexed(self, query):
+        plan = self._explain(query)
+        self.assertNotIn('Seq Scan on result', plan)
+        self.assertTrue(any(name in plan for name, definition in models.INDEXES), plan)
+
+    def test_indexes_exist(self):
+        cursor = models.db.execute_sql('SELECT indexname FROM pg_indexes')
+        index_names = [row[0] for row in cursor.fetchall()]
+
+        for name, definition in models.INDEXES:
+            self.assertIn(name, index_names)
+
+    def test_presidential_selections(self):
+        self.assertIndexed(render._select_presidential_state_results())
+        self.assertIndexed(render._select_presidential_national_results())
+        self.assertIndexed(render._select_presidential_county_results('UT'))
+
+    def test_office_selections(self):
+        self.assertIndexed(render._select_governor_results())
+        self.assertIndexed(render._select_selected_house_results())
+        self.assertIndexed(render._select_all_house_results())
+        self.assertIndexed(render._select_senate_results())
+
+    def test_ballot_measure_selection(self):
+        self.assertIndexed(render._select_ballot_measure_results())
+        self.assertIndexed(models.Result.select().where(
+            models.Result.level == 'state',
+            models.Result.is_ballot_measure == True,
+            models.Result.statepostal == 'CA'
+        ))
+
+    def test_county_fipscode_lookup(self):
+        self.assertIndexed(models.Result.select().where(
+            models.Result.statepostal == 'FL',
+            models.Result.fipscode == '12086'
+        ))
+
+    def test_calls_admin_selection(self):
+        race_keys, total = app_utils.filter_races('U.S. House', statepostal='FL')
+        self.assertIndexed(app_utils.filter_results('U.S. House', race_keys))
+
+    def test_calls_admin_search(self):
+        self.assertIndexed(models.Result.select().where(
+            models.Result.level << app_utils.CALLABLE_LEVELS,
+            app_utils._search_clause('Nguyen')
+        ))
+
+        race_keys, total = app_utils.filter_races('U.S. Senate', search='ALA')
+        self.assertEqual(set(statepostal for statepostal, raceid, reportingunitname in race_keys), set(['AK', 'AL']))
+
+        race_keys, total = app_utils.filter_races('U.S. Senate', search='%')
+        self.assertEqual(total, 0)
+
+def _backend_pid():
+    with models.db.execution_context() as ctx:
+        return models.db.execute_sql('SELECT pg_backend_pid()').fetchone()[0]
+
+def _count_results(snapshot_id):
+    with models.use_snapshot(snapshot_id):
+        return models.Result.select().count()
+
+def _insert_result(result_id):
+    with models.db.transaction():
+        models.Result.create(id=result_id, statepostal='ZZ')
+
+class DatabasePoolTestCase(unittest.TestCase):
+    """
+    Test pooled connections are reused in a process but never shared across a fork
+    """
+    def setUp(self):
+        if not app_config.DATABASE_POOL:
+            self.skipTest('database pooling is disabled')
+
+    def test_connection_reuse(self):
+        self.assertEqual(_backend_pid(), _backend_pid())
+
+    def test_fork_gets_new_connection(self):
+        parent_pid = _backend_pid()
+
+        with multiprocessing.get_context('fork').Pool(2) as pool:
+            child_pids = pool.starmap_async(_backend_pid, [()] * 4).get(timeout=30)
+
+        self.assertNotIn(parent_pid, child_pids)
+        self.assertLessEqual(len(set(child_pids)), 2)
+        self.assertEqual(_backend_pid(), parent_pid)
+
+    def test_failed_request_releases_connection(self):
+        import app
+        import psycopg2
+
+        # one pooled connection, so the next request gets the failed one's
+        models.db.close_all()
+
+        with app.app.test_request_context('/{0}/calls/senate/'.format(app_config.PROJECT_SLUG)):
+            app.app.preprocess_request()
+
+            with self.assertRaises(psycopg2.ProgrammingError):
+                models.db.execute_sql('SELECT no_such_column FROM result')
+
+        self.assertEqual(len(models.db._connections), 1)
+        connection = models.db._connections[0][1]
+        self.assertEqual(connection.get_transaction_status(), psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+        response = app.app.test_client().get('/{0}/calls/senate/'.format(app_config.PROJECT_SLUG))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(connection.get_transaction_status(), psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+class ResultRowTestCase(unittest.TestCase):
+    """
+    Test render rows serialize like full Result instances
+    """
+    def _model_dicts(self, query, selections):
+        model_dicts = []
+
+        for result in query:
+            result_dict = model_to_dict(result, backrefs=True, only=selections)
+            if result.level not in render.uncallable_levels:
+                result_dict['meta'] = model_to_dict(result.meta[0], only=render.RACE_META_SELECTIONS)
+                result_dict['npr_winner'] = result.is_npr_winner()
+            if result.officename in render.pickup_offices:
+                result_dict['pickup'] = result.is_pickup()
+
+            model_dicts.append(result_dict)
+
+        return model_dicts
+
+    def test_senate_rows_match_models(self):
+        rows = render._select_senate_results()
+        serialized_results = render._serialize_by_key(rows, render.SENATE_SELECTIONS, 'raceid')
+        row_dicts = [result for val in serialized_results['results'].values() for result in val]
+
+        query = models.Result.select().where(
+            models.Result.level == 'state',
+            models.Result.officename == 'U.S. Senate'
+        ).order_by(*render.ROW_ORDER)
+        model_dicts = self._model_dicts(query, render.SENATE_SELECTIONS)
+
+        self.assertEqual(len(row_dicts), len(model_dicts))
+        for row_dict, model_dict in zip(row_dicts, model_dicts):
+            self.assertEqual(list(row_dict.items()), list(model_dict.items()))
+
+    def test_county_rows_match_models(self):
+        rows = render._select_presidential_county_results('FL')
+        row_dicts = [result for val in render._serialize_by_key(rows, render.PRESIDENTIAL_COUNTY_SELECTIONS, 'fipscode')['results'].values() for result in val]
+
+        query = models.Result.select().where(
+            (models.Result.level == 'county') | (models.Result.level == 'state'),
+            models.Result.officename == 'President',
+            models.Result.statepostal == 'FL'
+        ).order_by(*render.ROW_ORDER)
+        model_dicts = self._model_dicts(query, render.PRESIDENTIAL_COUNTY_SELECTIONS)
+
+        self.assertEqual(len(row_dicts), len(model_dicts))
+        for row_dict, model_dict in zip(row_dicts, model_dicts):
+            self.assertEqual(list(row_dict.items()), list(model_dict.items()))
+
+    def test_county_rows_allocate_less(self):
+        def allocated(select):
+            tracemalloc.start()
+            results = list(select())
+            size, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return peak
+
+        model_peak = allocated(lambda: models.Result.select().where(
+            (models.Result.level == 'county') | (models.Result.level == 'state'),
+            models.Result.officename == 'President',
+            models.Result.statepostal == 'TX'
+        ))
+        row_peak = allocated(lambda: render._select_presidential_county_results('TX'))
+
+        self.assertLess(row_peak, model_peak / 2)
+
+class CountyStreamingTestCase(unittest.TestCase):
+    """
+    Test county files streamed from a server-side cursor
+    """
+    def setUp(self):
+        os.makedirs(app_config.DATA_OUTPUT_FOLDER, exist_ok=True)
+
+    def _serialize_county(self, statepostal):
+        results = render._select_presidential_county_results(statepostal).order_by(*render.COUNTY_ROW_ORDER)
+        serialized_results = render._serialize_by_key(results, render.PRESIDENTIAL_COUNTY_SELECTIONS, 'fipscode', collate_other=True)
+        return json.dumps(serialized_results, use_decimal=True, cls=utils.APDatetimeEncoder)
+
+    def test_streamed_file_matches_serialized(self):
+        render._render_county('FL')
+
+        with open('{0}/presidential-fl-counties.json'.format(app_config.DATA_OUTPUT_FOLDER)) as f:
+            self.assertEqual(f.read(), self._serialize_county('FL'))
+
+    def test_streaming_memory(self):
+        tracemalloc.start()
+        self._serialize_county('TX')
+        size, serialized_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        render._render_county('TX')
+        size, streamed_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertLess(streamed_peak, serialized_peak / 4)
+
+    def test_county_extra(self):
+        app_config.RENDER_COUNTY_EXTRA = True
+        try:
+            render._render_county('FL')
+        finally:
+            app_config.RENDER_COUNTY_EXTRA = False
+
+        with open('{0}/presidential-fl-counties.json'.format(app_config.DATA_OUTPUT_FOLDER)) as f:
+            counties = json.load(f)
+
+        self.assertEqual(set(counties['extra']), set(counties['results']) - set(['state']))
+
+        extra = counties['extra']['12086']
+        self.assertEqual(extra['past_margin'], 'D +24')
+        self.assertGreater(extra['census']['population'], 2000000)
+
+        dem, gop = [
+            float(result['votepct']) for last in ('Clinton', 'Trump')
+            for result in counties['results']['12086'] if result['last'] == last
+        ]
+        self.assertAlmostEqual(extra['shift'], (dem - gop - 0.237304) * 100, places=0)
+
+class RaceStatusTestCase(unittest.TestCase):
+    """
+    Test the race_status view agrees with the Result winner logic
+    """
+    def _assert_matches_models(self, results):
+        statuses = {status.result_id: status for status in models.RaceStatus.select()}
+
+        for result in results:
+            status = statuses[result.id]
+            self.assertEqual(status.npr_winner, result.is_npr_winner(), result.id)
+            self.assertEqual(status.pickup, result.is_pickup(), result.id)
+            self.assertEqual(status.expected_hit, result.is_expected(), result.id)
+            self.assertEqual(status.expected_miss, result.is_not_expected(), result.id)
+
+    def test_status_after_call_changes(self):
+        results = models.Result.select().where(
+            (models.Result.officename == 'U.S. Senate') | (models.Result.officename == 'President'),
+            models.Result.level << ['state', 'district']
+        )
+
+        with models.db.transaction() as txn:
+            for i, call in enumerate(models.Call.select()):
+                call.accept_ap = i % 3 != 0
+                call.override_winner = i % 5 == 0
+                call.save()
+
+            models.refresh_race_status()
+            self._assert_matches_models(results)
+
+            txn.rollback()
+
+    def test_call_npr_updates_race(self):
+        import app
+        import app_utils
+
+        loser = models.Result.select().where(
+            models.Result.level == 'state',
+            models.Result.officename == 'U.S. Senate',
+            models.Result.winner == False
+        ).get()
+        race = models.Result.select().where(
+            models.Result.level == 'state',
+            models.Result.raceid == loser.raceid,
+            models.Result.statepostal == loser.statepostal
+        )
+        race_key = (loser.statepostal, loser.raceid, loser.reportingunitname)
+
+        try:
+            client = app.app.test_client()
+            response = client.post('/{0}/calls/senate/call-npr'.format(app_config.PROJECT_SLUG), data={'result_id': loser.id})
+            self.assertEqual(response.status_code, 200)
+
+            calls = models.Call.select().where(models.Call.call_id << [result.id for result in race])
+            self.assertEqual([call.call_id.id for call in calls if call.override_winner], [loser.id])
+            self.assertFalse(any(call.accept_ap for call in calls))
+
+            admin = app_utils.filter_results('U.S. Senate', [race_key])
+            self.assertEqual([result.id for result in admin if result.npr_winner], [loser.id])
+
+            # the view catches up on the daemon's next load
+            models.refresh_race_status()
+            winners = models.RaceStatus.select().where(
+                models.RaceStatus.result_id << [result.id for result in race],
+                models.RaceStatus.npr_winner == True
+            )
+            self.assertEqual([status.result_id for status in winners], [loser.id])
+
+            response = client.post('/{0}/calls/senate/accept-ap'.format(app_config.PROJECT_SLUG), data={
+                'race_id': loser.raceid,
+                'statepostal': loser.statepostal,
+                'reportingunit': '',
+                'level': 'state'
+            })
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(all(call.accept_ap for call in calls.clone()))
+        finally:
+            models.Call.update(accept_ap=True, override_winner=False).where(
+                models.Call.call_id << [result.id for result in race]
+            ).execute()
+            models.refresh_race_status()
+
+class CreateCallsTestCase(unittest.TestCase):
+    """
+    Test rebuilding calls keeps the calls already made
+    """
+    def test_calls_kept(self):
+        with models.db.transaction() as txn:
+            count = models.Call.select().count()
+
+            called = models.Call.select().order_by(models.Call.id).first()
+            called.accept_ap = False
+            called.override_winner = True
+            called.save()
+
+            models.Call.delete().where(models.Call.id != called.id, models.Call.id << models.Call.select(models.Call.id).limit(10)).execute()
+
+            data.create_calls()
+
+            called = models.Call.get(models.Call.call_id == called.call_id)
+            self.assertEqual(models.Call.select().count(), count)
+            self.assertFalse(called.accept_ap)
+            self.assertTrue(called.override_winner)
+
+            txn.rollback()
+
+
+class RaceMetaTestCase(unittest.TestCase):
+    """
+    Test race meta reports races missing from the calendar
+    """
+    def test_missing_seat_reported(self):
+        with models.db.transaction() as txn:
+            senate = models.Result.select().where(
+                models.Result.level == 'state',
+                models.Result.officename == 'U.S. Senate'
+            ).first()
+            models.Result.update(statepostal='ZZ').where(models.Result.raceid == senate.raceid).execute()
+
+            with self.assertLogs('fabfile.data', level='WARNING') as logs:
+                data.create_race_meta()
+
+            meta = models.RaceMeta.get(models.RaceMeta.result_id == senate.id)
+            self.assertEqual(models.RaceMeta.select().count(), models.Call.select().count())
+            self.assertIsNone(meta.current_party)
+            self.assertIn('race {0} incomplete: no poll times for ZZ, no senate seat for ZZ'.format(senate.raceid), logs.output[0])
+
+            txn.rollback()
+
+
+class RaceEstimateTestCase(unittest.TestCase):
+    """
+    Test expected and outstanding votes
+    """
+    def _florida(self):
+        results = models.Result.select(models.Result, models.RaceEstimate.expected_votes, models.RaceEstimate.remaining_votes,
+                                       models.RaceEstimate.candidate_remaining, models.RaceEstimate.lead_ratio).join(
+            models.RaceEstimate, on=(models.RaceEstimate.result_id == models.Result.id)
+        ).where(
+            models.Result.level == 'state',
+            models.Result.statepostal == 'FL',
+            models.Result.officename == 'President'
+        ).order_by(-models.Result.votecount).naive()
+
+        return list(results)
+
+    def test_estimates(self):
+        with models.db.transaction() as txn:
+            models.Result.update(precinctsreportingpct=0.25).where(models.Result.statepostal == 'FL').execute()
+            models.refresh_race_estimate()
+
+            results = self._florida()
+            votes = sum(result.votecount for result in results)
+            self.assertEqual(results[0].expected_votes, votes * 4)
+            self.assertEqual(results[0].remaining_votes, votes * 3)
+            self.assertAlmostEqual(results[0].candidate_remaining, results[0].votecount * 3, delta=1)
+            self.assertAlmostEqual(float(results[0].lead_ratio), (results[0].votecount - results[1].votecount) / (votes * 3), places=3)
+
+            models.TurnoutBaseline.create(statepostal='FL', fipscode=None, votes=8000000)
+            models.refresh_race_estimate()
+
+            results = self._florida()
+            self.assertEqual(results[0].expected_votes, votes + 6000000)
+
+            txn.rollback()
+
+        models.refresh_race_estimate()
+
+    def test_load_without_statistics(self):
+        with models.db.transaction() as txn:
+            # as on a database bootstrap_db has just created
+            models.db.execute_sql("DELETE FROM pg_statistic WHERE starelid = 'result'::regclass")
+
+            start = time.time()
+            data._replace_results('init', os.path.join(app_config.ELEX_OUTPUT_FOLDER, 'results.csv'))
+
+            self.assertLess(time.time() - start, 30)
+            self.assertEqual(models.RaceEstimate.select().count(), models.Result.select().where(
+                models.Result.level << ['state', 'district', 'county']
+            ).count())
+
+            txn.rollback()
+
+
+class PathTo270TestCase(unittest.TestCase):
+    """
+    Test counting the paths to 270 left in the uncalled states
+    """
+    def test_paths(self):
+        units = [('FL', 29, 'Trump'), ('PA', 20, 'Clinton'), ('NH', 4, 'Clinton'), ('ME District 2', 1, None)]
+        paths = render.paths_to_270({'Clinton': 245, 'Trump': 239, 'Johnson': 0}, units)
+
+        # Clinton needs 25: FL and any of the rest, or PA, NH and ME-2
+        self.assertEqual(paths['candidates']['Clinton']['paths'], 9)
+        self.assertEqual(paths['candidates']['Clinton']['must_win'], [])
+        self.assertEqual(paths['candidates']['Clinton']['leading'], 269)
+        # Trump needs 31: FL and more than ME-2
+        self.assertEqual(paths['candidates']['Trump']['paths'], 6)
+        self.assertEqual(paths['candidates']['Trump']['must_win'], ['FL'])
+        self.assertEqual(paths['candidates']['Trump']['leading'], 268)
+        # FL and ME-2 to Trump is 269-269
+        self.assertEqual(paths['outcomes'], 16)
+        self.assertEqual(paths['no_majority'], 1)
+
+        self.assertEqual(paths['uncalled'][0]['paths'], {'Clinton': 8, 'Trump': 6})
+        self.assertEqual(paths['uncalled'][3]['paths'], {'Clinton': 5, 'Trump': 3})
+
+    def test_must_win(self):
+        units = [('FL', 29, 'Trump'), ('OH', 18, 'Trump'), ('NH', 4, 'Clinton')]
+        paths = render.paths_to_270({'Clinton': 230, 'Trump': 257}, units)
+
+        self.assertEqual(paths['candidates']['Clinton']['must_win'], ['FL', 'OH'])
+        self.assertEqual(paths['candidates']['Clinton']['paths'], 2)
+        self.assertEqual(paths['candidates']['Trump']['must_win'], [])
+        self.assertEqual(paths['candidates']['Trump']['paths'], 6)
+
+    def test_null_votecount(self):
+        os.makedirs(app_config.DATA_OUTPUT_FOLDER, exist_ok=True)
+
+        with models.db.transaction() as txn:
+            models.Result.update(votecount=None).where(
+                models.Result.officename == 'President',
+                models.Result.level == 'state',
+                models.Result.statepostal == 'CA',
+                models.Result.last == 'Clinton'
+            ).execute()
+
+            render.render_path_to_270()
+            txn.rollback()
+
+        with open('{0}/path-to-270.json'.format(app_config.DATA_OUTPUT_FOLDER)) as f:
+            paths = json.load(f)
+
+        california = [unit for unit in paths['uncalled'] if unit['statepostal'] == 'CA'][0]
+        self.assertEqual(california['leader'], 'Trump')
+
+
+class AggregatesTestCase(unittest.TestCase):
+    """
+    Test incrementally maintained totals against a full recount
+    """
+    def _recount(self):
+        recount = deepcopy(aggregates.INITIAL_TOTALS)
+
+        for result in render._select_senate_results():
+            render._calculate_bop(result, recount['senate_bop'])
+
+        for result in render._select_all_house_results():
+            render._calculate_bop(result, recount['house_bop'])
+
+        recount['electoral_college'] = render._calculate_electoral_votes(render._select_presidential_state_results())
+        return recount
+
+    def test_totals_match_recount(self):
+        self.assertEqual(aggregates.get_totals(), self._recount())
+
+    def test_totals_follow_call_changes(self):
+        with models.db.transaction() as txn:
+            for i, call in enumerate(models.Call.select()):
+                call.accept_ap = i % 3 != 0
+                call.override_winner = i % 5 == 0
+                call.save()
+
+            models.refresh_race_status()
+            incremental = aggregates.get_totals()
+            self.assertEqual(incremental, self._recount())
+
+            aggregates.rebuild_aggregates()
+            self.assertEqual(aggregates.get_totals(), incremental)
+
+            txn.rollback()
+
+    def test_unchanged_refresh_applies_nothing(self):
+        with models.db.transaction() as txn:
+            models.db.execute_sql('REFRESH MATERIALIZED VIEW CONCURRENTLY race_status')
+            self.assertEqual(aggregates.update_aggregates(), 0)
+            txn.rollback()
+
+    def test_update_rebuilds_unseeded_totals(self):
+        with models.db.transaction() as txn:
+            # as on a database whose totals were never seeded
+            aggregates.Aggregate.delete().execute()
+            aggregates.AggregateApplied.delete().execute()
+
+            with self.assertLogs('models.aggregates', level='WARNING'):
+                self.assertGreater(aggregates.update_aggregates(), 0)
+
+            self.assertEqual(aggregates.get_totals(), self._recount())
+            txn.rollback()
+
+class PostgresBackendTestCase(unittest.TestCase):
+    """
+    Test the Postgres render backend writes what the Python one does
+    """
+    def _python_json(self, serialized_results):
+        return json.dumps(serialized_results, use_decimal=True, cls=utils.APDatetimeEncoder)
+
+    def test_big_board_matches(self):
+        for results, selections, key in [
+            (render._select_presidential_state_results(), render.PRESIDENTIAL_STATE_SELECTIONS, 'statepostal'),
+            (render._select_senate_results(), render.SENATE_SELECTIONS, 'raceid'),
+            (render._select_selected_house_results(), render.HOUSE_SELECTIONS, 'raceid')
+        ]:
+            document, = render._fetch_json(*render._big_board_sql(results, selections, key=key))
+            self.assertEqual(document, self._python_json(render._serialize_for_big_board(results, selections, key=key)))
+
+    def test_state_section_matches(self):
+        results = render._select_rows(render.HOUSE_SELECTIONS).where(
+            models.Result.level == 'state',
+            models.Result.officename == 'U.S. House'
+        )
+
+        document, last_updated = render._fetch_json(*render._by_key_sql(results, render.HOUSE_SELECTIONS, 'raceid', collate_other=True))
+        serialized_results = render._serialize_by_key(results, render.HOUSE_SELECTIONS, 'raceid', collate_other=True)
+
+        self.assertEqual(document, self._python_json(serialized_results))
+        self.assertEqual(last_updated, serialized_results['last_updated'])
+
+    def test_escaping_matches(self):
+        results = render._select_senate_results()
+
+        with models.db.transaction() as txn:
+            result = models.Result.select().where(models.Result.level == 'state', models.Result.officename == 'U.S. Senate').get()
+            result.first = '"Q" \\ \t \x7f'
+            result.save()
+
+            document, = render._fetch_json(*render._big_board_sql(results, render.SENATE_SELECTIONS))
+            self.assertEqual(document, self._python_json(render._serialize_for_big_board(results, render.SENATE_SELECTIONS)))
+
+            txn.rollback()
+
+    def test_non_ascii_escaping_matches(self):
+        text = 'Pe\u00f1a \u2014 \U0001f600'
+        self.assertEqual(render.NON_ASCII.sub(render._escape_non_ascii, text), json.dumps(text)[1:-1])
+
+class SnapshotTestCase(unittest.TestCase):
+    """
+    Test render workers read the snapshot render started with
+    """
+    def test_workers_ignore_later_loads(self):
+        try:
+            with models.consistent_snapshot() as snapshot_id:
+                count = models.Result.select().count()
+
+                with multiprocessing.get_context('fork').Pool(2) as pool:
+                    pool.apply_async(_insert_result, ('snapshot-test',)).get(timeout=30)
+                    counts = pool.starmap_async(_count_results, [(snapshot_id,)] * 4).get(timeout=30)
+
+                self.assertEqual(counts, [count] * 4)
+                self.assertEqual(models.Result.select().count(), count)
+
+                with models.consistent_snapshot() as nested_snapshot_id:
+                    self.assertEqual(nested_snapshot_id, snapshot_id)
+
+            self.assertEqual(models.Result.select().count(), count + 1)
+        finally:
+            models.Result.delete().where(models.Result.id == 'snapshot-test').execute()
+
+class CollationTestCase(unittest.TestCase):
+    """
+    Test "Other" rows collated by the query
+    """
+    def _serialize_race(self, raceid):
+        results = render._select_rows(render.HOUSE_SELECTIONS).where(
+            models.Result.level == 'state',
+            models.Result.officename == 'U.S. House',
+            models.Result.raceid == raceid
+        )
+        return render._serialize_by_key(results, render.HOUSE_SELECTIONS, 'raceid', collate_other=True)['results'][raceid]
+
+    def test_other_sums_minor_parties(self):
+        minor = models.Result.select().where(
+            models.Result.level == 'state',
+            models.Result.officename == 'U.S. House',
+            ~(models.Result.party << render.ACCEPTED_PARTIES)
+        ).first()
+        race = models.Result.select().where(
+            models.Result.level == 'state',
+            models.Result.officename == 'U.S. House',
+            models.Result.raceid == minor.raceid
+        )
+        others = [result for result in race if result.party not in render.ACCEPTED_PARTIES]
+
+        with models.db.transaction() as txn:
+            models.CollationException.delete().execute()
+            serialized = self._serialize_race(minor.raceid)
+
+            self.assertEqual([result['last'] for result in serialized[:-1]], [result.last for result in race.order_by(*render.ROW_ORDER) if result not in others])
+            self.assertEqual(serialized[-1]['last'], 'Other')
+            self.assertEqual(serialized[-1]['votecount'], sum(result.votecount for result in others))
+            self.assertEqual(serialized[-1]['votepct'], sum(result.votepct for result in others))
+
+            models.CollationException.create(raceid=minor.raceid, last=minor.last)
+            serialized = self._serialize_race(minor.raceid)
+
+            self.assertIn(minor.last, [result['last'] for result in serialized[:-1]])
+            self.assertEqual(len(serialized), race.count() + 1 - len([result for result in others if result.last != minor.last]))
+
+            txn.rollback()
+
+    def test_seeded_exceptions(self):
+        # the seeded rows keep every candidate in race 36602 and every
+        # Babinec, as the condition they replaced did
+        serialized = self._serialize_race('36602')
+        self.assertIn(('Nguyen', 'Lib'), [(result['last'], result['party']) for result in serialized[:-1]])
+
+        minor = models.Result.select().where(
+            models.Result.level == 'state',
+            models.Result.officename == 'U.S. House',
+            models.Result.raceid != '36602',
+            ~(models.Result.party << render.ACCEPTED_PARTIES)
+        ).first()
+
+        with models.db.transaction() as txn:
+            models.Result.update(last='Babinec').where(models.Result.id == minor.id).execute()
+            serialized = self._serialize_race(minor.raceid)
+
+            self.assertIn('Babinec', [result['last'] for result in serialized[:-1]])
+
+            txn.rollback()
+
+    def test_county_other_rows(self):
+        results = render._select_presidential_county_results('FL')
+        serialized_results = render._serialize_by_key(results, render.PRESIDENTIAL_COUNTY_SELECTIONS, 'fipscode', collate_other=True)
+
+        for key, group in serialized_results['results'].items():
+            self.assertEqual(group[-1]['last'], 'Other', key)
+            self.assertEqual([result['last'] for result in group[:-1] if result['last'] not in render.ACCEPTED_PRESIDENTIAL_CANDIDATES], [], key)
+
+class ExtraDataTestCase(unittest.TestCase):
+    """
+    Test the county indexes behind the extra data files
+    """
+    def test_indexes(self):
+        with tempfile.TemporaryDirectory() as folder:
+            margins_path = os.path.join(folder, 'twentyTwelve.csv')
+            with open(margins_path, 'w') as f:
+                f.write('fipscode,last,level,votepct\n')
+                f.write('01001,Obama,township,0.9\n')
+                f.write('01001,Obama,county,0.4\n')
+                f.write('01001,Romney,county,0.55\n')
+                f.write('01003,Obama,county,0.6\n')
+
+            self.assertEqual(data.index_2012_margins(margins_path), {'01001': 'R +15'})
+
+        unemployment = data.index_unemployment('data/unemployment.csv')
+        self.assertEqual(unemployment['01001'], 5.2)
+
+    def test_census_matches_per_county(self):
+        with tempfile.TemporaryDirectory() as folder:
+            shutil.copy('data/census/AL.json', folder)
+            census = data.load_census_data(folder)
+
+        with open('data/census/AL.json') as f:
+            census_json = json.load(f)
+
+        self.assertEqual(len(census), len(census_json))
+
+        for fipscode in census_json:
+            expected = data.extract_census_data(fipscode, census_json)
+            for name, value in expected.items():
+                self.assertEqual(census[fipscode][name], value, msg=fipscode)
+
+    def test_bachelors_error_counts_degree_cells(self):
+        with open('data/census/AL.json') as f:
+            census_json = json.load(f)
+
+        fipscode = next(iter(census_json))
+        education = next(iter(census_json[fipscode]['data'].values()))['B15001']
+        expected = math.sqrt(sum(education['error'][cell] ** 2 for cell in data.BACHELORS_CELLS)) / education['estimate']['B15001001']
+
+        # associate's degrees, not a bachelor's
+        education['error']['B15001049'] *= 1000
+
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'AL.json'), 'w') as f:
+                json.dump(census_json, f)
+
+            census = data.load_census_data(folder)
+
+        self.assertAlmostEqual(data.extract_census_data(fipscode, census_json)['error'], expected)
+        self.assertAlmostEqual(census[fipscode]['error'], expected)
+
+
+class CensusStubHandler(BaseHTTPRequestHandler):
+    """
+    Census Reporter stand-in: fails the first request, then answers with
+    every geography asked for except 05000US99999
+    """
+    requests = []
+
+    def do_GET(self):
+        geo_ids = parse_qs(urlparse(self.path).query)['geo_ids'][0].split(',')
+        self.requests.append(geo_ids)
+
+        if len(self.requests) == 1:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        payload = {
+            'release': {'id': 'acs2014_5yr'},
+            'tables': {},
+            'geography': dict((geo_id, {'name': geo_id}) for geo_id in geo_ids),
+            'data': dict((geo_id, {'B01003': {'estimate': {'B01003001': 100}}}) for geo_id in geo_ids if geo_id != '05000US99999')
+        }
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(payload).encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class CensusFetchTestCase(unittest.TestCase):
+    """
+    Test census fetching against a local stub
+    """
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), CensusStubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server.server_port)
+
+        self.retry_delay = data.CENSUS_RETRY_DELAY
+        self.rate = data.CENSUS_REQUESTS_PER_SECOND
+        data.CENSUS_RETRY_DELAY = 0.01
+        data.CENSUS_REQUESTS_PER_SECOND = 100
+        CensusStubHandler.requests = []
+
+    def tearDown(self):
+        data.CENSUS_RETRY_DELAY = self.retry_delay
+        data.CENSUS_REQUESTS_PER_SECOND = self.rate
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_and_resume(self):
+        states = {
+            'AL': ['01{0:03d}'.format(i) for i in range(1, 24, 2)],
+            'ZZ': ['99999']
+        }
+
+        with tempfile.TemporaryDirectory() as folder:
+            failed = data.fetch_census_data(states, self.url, os.path.join(folder, 'cache'), folder)
+
+            self.assertEqual(failed, ['05000US99999'])
+            self.assertEqual(len(CensusStubHandler.requests), 3)
+
+            with open(os.path.join(folder, 'AL.json')) as f:
+                census_json = json.load(f)
+
+            self.assertEqual(sorted(census_json), states['AL'])
+            self.assertEqual(list(census_json['01001']['data']), ['05000US01001'])
+
+            # only the failed county is asked for again
+            CensusStubHandler.requests = [['retried']]
+            data.fetch_census_data(states, self.url, os.path.join(folder, 'cache'), folder)
+            self.assertEqual(CensusStubHandler.requests[1:], [['05000US99999']])
+
+
+class CountyIndexTestCase(unittest.TestCase):
+    """
+    Test counties read back from the packed index
+    """
+    def test_lookup(self):
+        counties = {
+            '01003': {'name': 'Baldwin', 'statename': 'Alabama', 'population': 200111.0, 'past_margin': 'R +54'},
+            '01001': {'name': 'Autauga', 'statename': 'Alabama', 'unemployment': 5.2, 'past_margin': 'R +46'},
+            '56045': {'name': 'Weston', 'statename': 'Wyoming', 'unemployment': 3.9}
+        }
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'counties.idx')
+            county_index.write_county_index(path, counties)
+            index = county_index.CountyIndex(path)
+
+            self.assertEqual(len(index), 3)
+            self.assertNotIn('01002', index)
+            self.assertIsNone(index.get('99999'))
+
+            autauga = index.get('01001')
+            self.assertEqual(autauga['name'], 'Autauga')
+            self.assertEqual(autauga['unemployment'], 5.2)
+            self.assertIsNone(autauga['population'])
+
+            self.assertEqual(index.get('01003')['population'], 200111.0)
+            self.assertEqual(index.get('56045')['statename'], 'Wyoming')
+            self.assertIsNone(index.get('56045')['past_margin'])
+
+
+class FixturesTestCase(unittest.TestCase):
+    """
+    Test the synthetic election generator
+    """
+    def test_generated_night(self):
+        with tempfile.TemporaryDirectory() as output:
+            fixtures.generate(output, scale='1', steps='2')
+
+            with open(os.path.join(output, 'manifest.json')) as f:
+                manifest = json.load(f)
+            self.assertEqual([step['folder'] for step in manifest['steps']], ['step-000', 'step-001'])
+
+            with open(os.path.join(output, 'step-001', 'init.json')) as f:
+                races = json.load(f)['races']
+            with open(os.path.join(output, 'step-001', 'districts.json')) as f:
+                districts = json.load(f)['races'][0]['reportingUnits']
+
+        self.assertTrue(set(race['officeID'] for race in races).issuperset(['P', 'S', 'H', 'G']))
+
+        president = races[0]
+        levels = set(unit['level'] for unit in president['reportingUnits'])
+        self.assertEqual(levels, set(['national', 'state', 'subunit']))
+
+        national = [unit for unit in president['reportingUnits'] if unit['level'] == 'national'][0]
+        self.assertEqual(sum(candidate['electWon'] for candidate in national['candidates']), 538)
+        self.assertEqual(sorted(set(unit['statePostal'] for unit in districts)), ['ME', 'NE'])
+
+class BenchTestCase(unittest.TestCase):
+    """
+    Test the benchmark's bucket stand-in and regression check
+    """
+    def test_deploy_to_bucket_syncs_changes(self):
+        with tempfile.TemporaryDirectory() as output_folder, tempfile.TemporaryDirectory() as bucket:
+            for filename in ['top-level-results.json', 'a.json', 'b.json']:
+                with open(os.path.join(output_folder, filename), 'w') as f:
+                    f.write('{}')
+
+            self.assertEqual(utils.deploy_to_folder(output_folder, bucket), (3, 6))
+
+            with open(os.path.join(output_folder, 'a.json'), 'w') as f:
+                f.write('{"a": 1}')
+
+            self.assertEqual(utils.deploy_to_folder(output_folder, bucket), (2, 10))
+
+    def test_compare_thresholds(self):
+        with tempfile.TemporaryDirectory() as folder:
+            history = os.path.join(folder, 'history.json')
+            entries = [
+                {'timestamp': '1', 'branch': 'master', 'commit': 'a', 'scale': 1, 'metrics': {'render.x.ms': 200, 'render.x.queries': 10, 'ingest.init.rows_per_s': 1000}},
+                {'timestamp': '2', 'branch': 'work', 'commit': 'b', 'scale': 1, 'metrics': {'render.x.ms': 300, 'render.x.queries': 10, 'ingest.init.rows_per_s': 950}}
+            ]
+            with open(history, 'w') as f:
+                json.dump(entries, f)
+
+            self.assertEqual(bench._compare(history, entries[1], 'master'), [('render.x.ms', 200, 300)])
+            self.assertEqual(bench._compare(history, entries[1], 'other'), [])
+
+    def test_compare_named_threshold(self):
+        with tempfile.TemporaryDirectory() as folder:
+            history = os.path.join(folder, 'history.json')
+            entries = [
+                {'timestamp': '1', 'branch': 'master', 'commit': 'a', 'scale': 1, 'metrics': {'render.x.ms': 200, 'render.render_race_estimates.ms': 200}},
+                {'timestamp': '2', 'branch': 'work', 'commit': 'b', 'scale': 1, 'metrics': {'render.x.ms': 228, 'render.render_race_estimates.ms': 228}}
+            ]
+            with open(history, 'w') as f:
+                json.dump(entries, f)
+
+            self.assertEqual(bench._compare(history, entries[1], 'master'), [('render.x.ms', 200, 228)])
+
+            entries[0]['metrics'] = {'render.x.ms': 30, 'render.render_path_to_270.ms': 30}
+            entries[1]['metrics'] = {'render.x.ms': 50, 'render.render_path_to_270.ms': 50}
+            with open(history, 'w') as f:
+                json.dump(entries, f)
+
+            self.assertEqual(bench._compare(history, entries[1], 'master'), [('render.render_path_to_270.ms', 30, 50)])
+
+class ReplayTestCase(unittest.TestCase):
+    """
+    Test the replay clock picks due steps and points elex at them
+    """
+    def test_cycle_loads_due_step(self):
+        with tempfile.TemporaryDirectory() as fixture:
+            with open(os.path.join(fixture, 'manifest.json'), 'w') as f:
+                json.dump({'steps': [
+                    {'folder': 'step-000', 'timestamp': '2016-11-09T00:00:00Z'},
+                    {'folder': 'step-001', 'timestamp': '2016-11-09T01:00:00Z'},
+                    {'folder': 'step-002', 'timestamp': '2016-11-09T02:00:00Z'}
+                ]}, f)
+
+            night = daemons.Replay(fixture, 3600)
+            night.started = time.time() - 1.5
+
+            with night.cycle('fast'):
+                self.assertIn(os.path.join(fixture, 'step-001'), app_config.FAST_ELEX_FLAGS)
+                night.started -= 1
+
+            self.assertNotIn(fixture, app_config.FAST_ELEX_FLAGS)
+            self.assertEqual((night.cycles[0]['step'], night.cycles[0]['backlog']), (1, 1))
+            self.assertGreater(night.cycles[0]['freshness'], 0)
+            self.assertFalse(night.finished)
+
+class QueryStatsTestCase(unittest.TestCase):
+    """
+    Test queries are counted by site and slow ones explained
+    """
+    def test_counts_by_site(self):
+        snapshot = models.db.stats.snapshot()
+
+        with models.query_site('test-site'):
+            list(models.Result.select().where(models.Result.level == 'state').limit(5))
+            models.Result.select().count()
+
+        sites = models.db.stats.since(snapshot)
+        self.assertEqual(sites['test-site'][0], 2)
+        self.assertEqual(sites['test-site'][2], 6)
+
+    def test_worker_queries_handed_back(self):
+        output_folder = app_config.DATA_OUTPUT_FOLDER
+
+        with tempfile.TemporaryDirectory() as app_config.DATA_OUTPUT_FOLDER:
+            try:
+                in_parent, parent_samples = render._render_in_worker(os.getpid(), None, 'render_state_results', render._render_state, 'FL')
+                in_worker, worker_samples = render._render_in_worker(None, None, 'render_state_results', render._render_state, 'FL')
+            finally:
+                app_config.DATA_OUTPUT_FOLDER = output_folder
+
+        self.assertEqual(in_parent, {})
+        self.assertEqual(list(in_worker.keys()), ['render_state_results'])
+        self.assertGreaterEqual(in_worker['render_state_results'][0], 4)
+        self.assertEqual(worker_samples, {})
+
+    def test_slow_query_explained(self):
+        threshold = app_config.SLOW_QUERY_THRESHOLD
+        app_config.SLOW_QUERY_THRESHOLD = 0
+
+        try:
+            with self.assertLogs('models.query_stats', level='WARNING') as logs:
+                models.Result.select().where(models.Result.level == 'state').first()
+        finally:
+            app_config.SLOW_QUERY_THRESHOLD = threshold
+
+        self.assertIn('slow query in other', logs.output[0])
+        self.assertIn('Scan', logs.output[1])
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """
+    Test the sampling profiler files stacks by stage
+    """
+    def test_samples_by_stage(self):
+        done = threading.Event()
+
+        def busy():
+            with models.query_site('busy-stage'):
+                done.wait()
+
+        thread = threading.Thread(target=busy)
+        thread.start()
+
+        try:
+            samples = profiler.SamplingProfiler('test', stage_of=models.db.stats.site_of, interval=0.005).sample(0.1)
+        finally:
+            done.set()
+            thread.join()
+
+        self.assertIn('busy-stage', samples)
+        self.assertTrue(all('busy (test_data.py:' in stack for stack in samples['busy-stage']))
+
+        log_path = app_config.SERVER_LOG_PATH
+
+        with tempfile.TemporaryDirectory() as app_config.SERVER_LOG_PATH:
+            try:
+                folder = profiler.SamplingProfiler('test').write(samples)
+
+                with open(os.path.join(folder, 'busy-stage.collapsed')) as f:
+                    stack, count = f.readline().rsplit(' ', 1)
+            finally:
+                app_config.SERVER_LOG_PATH = log_path
+
+        self.assertGreater(int(count), 0)
+
+    def test_worker_samples_merged(self):
+        output_folder = app_config.DATA_OUTPUT_FOLDER
+        log_path = app_config.SERVER_LOG_PATH
+        sampler = profiler.SamplingProfiler('test', interval=0.005)
+
+        with tempfile.TemporaryDirectory() as app_config.DATA_OUTPUT_FOLDER, tempfile.TemporaryDirectory() as app_config.SERVER_LOG_PATH:
+            try:
+                sampler.start(1)
+                self.assertEqual(profiler.profiling_until(), sampler.until)
+
+                # as a worker would, handed the daemon's window
+                sites, samples = render._render_in_worker(None, profiler.profiling_until(), 'render_state_results', render._render_state, 'FL')
+                render._merge_worker_stats([(sites, samples)])
+
+                sampler._thread.join()
+                folder = os.path.join(app_config.SERVER_LOG_PATH, 'profiles', os.listdir(os.path.join(app_config.SERVER_LOG_PATH, 'profiles'))[0])
+
+                with open(os.path.join(folder, 'render_state_results.collapsed')) as f:
+                    stacks = f.read()
+            finally:
+                app_config.DATA_OUTPUT_FOLDER = output_folder
+                app_config.SERVER_LOG_PATH = log_path
+
+        self.assertIn('_render_state (render.py:', stacks)
+        self.assertIsNone(profiler.profiling_until())
+
+
+class CopyCacheTestCase(unittest.TestCase):
+    """
+    Test parsed workbooks are read from the cache until they change
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_folder = app_config.COPY_CACHE_FOLDER
+        app_config.COPY_CACHE_FOLDER = os.path.join(self.folder, 'cache')
+
+        self.path = os.path.join(self.folder, 'calendar.xlsx')
+        shutil.copy(app_config.CALENDAR_PATH, self.path)
+
+    def tearDown(self):
+        app_config.COPY_CACHE_FOLDER = self.cache_folder
+        copy_cache._copies.pop(self.path, None)
+        shutil.rmtree(self.folder)
+
+    def _mark_cache(self):
+        cached = copy_cache._read_cache(self.path)
+        cached['sheets'] = [['cached', ['key', 'value'], [['from', 'cache']]]]
+        copy_cache._write_cache(self.path, cached)
+        copy_cache._copies.pop(self.path)
+
+    def test_cache_used_until_refresh(self):
+        parsed = copy_cache.get_copy(self.path)
+        self.assertEqual(parsed['poll_times']['AL']['time_est'], '8:00 p.m.')
+        self.assertIs(copy_cache.get_copy(self.path), parsed)
+
+        self._mark_cache()
+        self.assertEqual(str(copy_cache.get_copy(self.path)['cached']['from']), 'cache')
+
+        # a new mtime with the same contents keeps the cache
+        os.utime(self.path, (0, 0))
+        self.assertEqual(str(copy_cache.get_copy(self.path)['cached']['from']), 'cache')
+
+        self.assertEqual(copy_cache.refresh(self.path).json(), parsed.json())
+
+    def test_same_name_in_other_folder(self):
+        other_path = os.path.join(self.folder, 'other', 'calendar.xlsx')
+        os.makedirs(os.path.dirname(other_path))
+        shutil.copy(self.path, other_path)
+
+        copy_cache.get_copy(self.path)
+        self._mark_cache()
+
+        try:
+            self.assertEqual(copy_cache.get_copy(other_path)['poll_times']['AL']['time_est'], '8:00 p.m.')
+            self.assertEqual(str(copy_cache.get_copy(self.path)['cached']['from']), 'cache')
+        finally:
+            copy_cache._copies.pop(other_path, None)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -5,8 +5,8 @@ var $uncallNPR;
 var $overlay;
 var $body;
 
-var ACCEPT_AP_URL = document.location.href + 'accept-ap';
-var CALL_NPR_URL = document.location.href + 'call-npr'
+var ACCEPT_AP_URL = document.location.pathname + 'accept-ap';
+var CALL_NPR_URL = document.location.pathname + 'call-npr'
 
 var pageRefresh = null;
 